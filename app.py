@@ -1,58 +1,485 @@
+import hmac
+import importlib
 import logging
+import math
 import os
-import uvicorn
+import threading
+import time
 
-from pathlib import Path
-from fastapi import FastAPI, Form, Request, Response, responses
+from contextlib import asynccontextmanager
+from urllib.parse import urlencode
+
+from dotenv import load_dotenv
+from fastapi import Depends, FastAPI, File, Form, Request, Response, UploadFile, responses
+from fastapi.concurrency import run_in_threadpool
 from twilio.twiml.messaging_response import MessagingResponse
 
-from constants import DirectoryPath, TokensAndURLs
+from cluster import FORWARDED_HEADER, get_cluster
+from constants import (BatchSettings, ConcurrencySettings, ImageServingSettings, JobQueueSettings, RateLimitSettings,
+                       ServerSettings)
 from image_handler import ImageManager
-from chat_history_manager import ChatHistoryManager
-from merge_images import MergeImages
+from image_pipeline import UnsupportedImageError
+from image_serving import get_output_image_server
+from chat_history_manager import ChatHistoryManager, get_chat_history_log
+from garment_catalog import CatalogIngestError, get_garment_catalog
+from gradio_pool import gradio_pool_metrics, start_gradio_pools, stop_gradio_pools
+from http_client import get_media_download_client
+from image_workers import get_image_worker_pool
+from job_queue import create_job_queue
+from metadata_store import get_metadata_store
+from output_storage import get_output_storage
+from rate_limiter import BUSY, SHED, admit_try_on, get_rate_limiter
+from result_cache import get_result_cache
+from session_state import READY
+from speculative import get_speculative_preprocessor
+from storage_lifecycle import start_storage_lifecycle, stop_storage_lifecycle
+from try_on_router import get_try_on_router
+from try_on_jobs import BATCH_JOBS, VIRTUAL_TRY_ON_JOB, register_try_on_handlers
+from telemetry import (ADMISSION_DECISIONS, RATE_LIMITED, STAGE_SECONDS, MetricsMiddleware, get_metrics_registry,
+                       span, trace)
+from user_locks import get_user_locks
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
 
-@app.get("/get_image/{image_name}")
-def get_image(image_name: str):
+@asynccontextmanager
+async def lifespan(app):
+    """Start the app's background work before serving and stop it once serving ends."""
+    on_startup()
+    yield
+    on_shutdown()
+    await get_cluster().close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+# Imported lazily by the modules that use them, and in the background once the app has started
+HEAVY_MODULES = ("numpy", "PIL.Image", "httpx", "twilio.rest")
+# What a forwarded request and its reply keep of their headers
+FORWARDED_REQUEST_HEADERS = ("content-type", "if-none-match", "range", "x-twilio-signature")
+FORWARDED_RESPONSE_HEADERS = (
+    "content-type", "etag", "cache-control", "content-disposition", "content-range", "accept-ranges", "location"
+)
+
+UNSUPPORTED_IMAGE_REPLY = "Sorry, I can't read that file. Please send the photo as a JPEG, PNG or WebP image."
+SHED_REPLY = "We're very busy right now. Your images are saved, send any message in a few minutes to start your try-on."
+
+
+def collect_component_metrics():
+    """Gauges and counters kept by the components themselves, read at scrape time."""
+    cache = get_result_cache().stats()
+    workers = get_image_worker_pool().metrics()
+    families = [
+        ("tryon_job_queue_depth", "gauge", "Jobs waiting to start",
+         [({}, get_job_queue().backend.depth())]),
+        ("tryon_result_cache_lookups_total", "counter", "Result cache lookups by outcome", [
+            ({"result": "hot_hit"}, cache["hot_hits"]),
+            ({"result": "disk_hit"}, cache["disk_hits"]),
+            ({"result": "miss"}, cache["misses"])
+        ]),
+        ("tryon_result_cache_bytes", "gauge", "Bytes of results on disk", [({}, cache["disk_bytes"])]),
+        ("tryon_image_workers_in_flight", "gauge", "Image tasks running or queued", [({}, workers["in_flight"])]),
+        ("tryon_image_workers_capacity", "gauge", "Image tasks accepted at once", [({}, workers["capacity"])]),
+        ("tryon_image_workers_rejected_total", "counter", "Image tasks rejected as busy",
+         [({}, workers["rejected"])])
+    ]
+    pools = gradio_pool_metrics()
+    families.append(("tryon_gradio_clients", "gauge", "Gradio clients by state", [
+        ({"backend": pool["backend"], "state": state}, pool[state]) for pool in pools for state in ("idle", "in_use")
+    ]))
+    families.append(("tryon_gradio_checkout_timeouts_total", "counter", "Gradio checkouts that timed out", [
+        ({"backend": pool["backend"]}, pool["checkout_timeouts"]) for pool in pools
+    ]))
+    status = get_try_on_router().backend_status()
+    families.append(("tryon_backend_error_rate", "gauge", "Recent error rate of each try-on backend", [
+        ({"backend": name}, backend["error_rate"]) for name, backend in status.items()
+    ]))
+    families.append(("tryon_backend_circuit_open", "gauge", "1 while the backend's circuit is not closed", [
+        ({"backend": name}, int(backend["circuit"] != "closed")) for name, backend in status.items()
+    ]))
+    return families
+
+
+get_metrics_registry().add_collector(collect_component_metrics)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Return the process-wide JobQueue, with the try-on handlers registered."""
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                job_queue = create_job_queue()
+                register_try_on_handlers(job_queue)
+                _job_queue = job_queue
+    return _job_queue
+
+
+def warm_heavy_imports():
+    """Import the slow modules before the first message needs them, without holding up startup."""
+    for module_name in HEAVY_MODULES:
+        try:
+            importlib.import_module(module_name)
+        except ImportError as e:
+            logger.log(level=logging.WARNING, msg=f"Could not import {module_name} ahead of use. Error: [{e}]")
+
+
+def on_startup():
+    # Credentials are read when first used, so the .env file only has to be loaded before serving
+    load_dotenv()
+    start_storage_lifecycle()
+    get_metadata_store().prune_message_responses(time.time() - ConcurrencySettings.MESSAGE_RETENTION_SECONDS.value)
+    get_rate_limiter().prune(time.time() - RateLimitSettings.IDLE_BUCKET_SECONDS.value)
+    if JobQueueSettings.TRY_ON_MODE.value == VIRTUAL_TRY_ON_JOB:
+        start_gradio_pools()
+    get_job_queue().start()
+    threading.Thread(target=warm_heavy_imports, name="warm-imports", daemon=True).start()
+
+
+def on_shutdown():
+    get_job_queue().stop()
+    stop_gradio_pools()
+    get_try_on_router().shutdown()
+    get_chat_history_log().flush()
+    get_media_download_client().close()
+    get_image_worker_pool().shutdown()
+    get_speculative_preprocessor().shutdown()
+    stop_storage_lifecycle()
+
+
+async def forward_to_node(request, node_id, form=None):
+    """Answer a request with the reply of the node that owns its user or image.
+
+    The body is already parsed by the time a handler runs, so a form is sent on re-encoded.
+    """
+    headers = {name: value for name, value in request.headers.items() if name in FORWARDED_REQUEST_HEADERS}
+    content = None
+    if form is not None:
+        content = urlencode(list(form.multi_items()))
+        headers["content-type"] = "application/x-www-form-urlencoded"
+    try:
+        reply = await get_cluster().forward(node_id, request.method, request.url.path, headers, content)
+    except Exception as e:
+        logger.log(level=logging.ERROR, msg=f"Could not forward {request.url.path} to node {node_id}. Error: [{e}]")
+        return responses.JSONResponse(content={"error": f"Node {node_id} is unavailable"}, status_code=503)
+    headers = {name: value for name, value in reply.headers.items() if name.lower() in FORWARDED_RESPONSE_HEADERS}
+    return Response(content=reply.content, status_code=reply.status_code, headers=headers)
+
+
+@app.api_route("/get_image/{image_name}", methods=["GET", "HEAD"])
+async def get_image(image_name: str, request: Request):
+    image_server = get_output_image_server()
+    output_storage = get_output_storage()
+    image_path = image_server.resolve(image_name)
+    cluster = get_cluster()
+    output_node = cluster.output_node(image_name)
+    if image_path is None and not cluster.is_local(output_node) and FORWARDED_HEADER not in request.headers:
+        # Written on another node, which also tracks its storage backend copy
+        return await forward_to_node(request, output_node)
+    if image_path is None:
+        # Older outputs may only be kept by the storage backend
+        remote_url = await run_in_threadpool(output_storage.remote_url, image_name)
+        if remote_url is not None:
+            await run_in_threadpool(output_storage.mark_served, image_name)
+            return responses.RedirectResponse(remote_url, status_code=307)
+        logger.log(level=logging.ERROR, msg=f"Did not find the output image: {image_name}")
+        return responses.JSONResponse(content={"error": "Image not found"}, status_code=404)
+    # The first fetch (Twilio's, for the reply) lets the sweep release the inputs
+    await run_in_threadpool(output_storage.mark_served, image_name)
+
+    stat, etag = image_server.cached_description(image_path)
+    if etag is None:
+        # First request for this file version, hash it off the event loop
+        stat, etag = await run_in_threadpool(image_server.describe, image_path)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": ImageServingSettings.CACHE_CONTROL.value,
+        "Content-Disposition": "inline"
+    }
+    if image_server.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    media_type = image_server.media_type(image_path)
+    if "range" not in request.headers and stat.st_size <= image_server.thumbnail_max_bytes:
+        content = image_server.cached_small_image_bytes(image_path, stat)
+        if content is None:
+            # Not in memory yet, read it off the event loop
+            content = await run_in_threadpool(image_server.small_image_bytes, image_path, stat)
+        headers["Content-Length"] = str(len(content))
+        return Response(
+            content=b"" if request.method == "HEAD" else content, headers=headers, media_type=media_type
+        )
+    # Streams the file with sendfile where available and handles Range and HEAD itself
+    return responses.FileResponse(image_path, headers=headers, media_type=media_type, stat_result=stat)
+
+
+@app.get("/metrics")
+def metrics():
+    return Response(content=get_metrics_registry().render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/job_status/{job_id}")
+async def job_status(job_id: str, request: Request):
+    job = await run_in_threadpool(get_job_queue().get_job, job_id)
+    if job is None and FORWARDED_HEADER not in request.headers:
+        # Jobs are queued on the node of their user, which may be another one
+        for node_id in get_cluster().other_nodes():
+            reply = await forward_to_node(request, node_id)
+            if reply.status_code == 200:
+                return reply
+    if job is None:
+        return responses.JSONResponse(content={"error": "Job not found"}, status_code=404)
+    return job.to_dict()
+
+
+def catalog_admin_denied(request):
+    """An error response unless the request carries the catalog admin token, None when it does."""
+    # Read on use, the .env file is loaded by the app's startup hook
+    token = os.getenv("CATALOG_ADMIN_TOKEN")
+    if not token:
+        return responses.JSONResponse(content={"error": "Catalog administration is disabled"}, status_code=403)
+    if not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {token}"):
+        return responses.JSONResponse(content={"error": "Not authorized"}, status_code=401)
+    return None
+
+
+async def replicate_catalog_write(request, path, data=None, files=None):
+    """Apply a catalog write on every other node, returning the nodes that did not take it."""
+    headers = {"authorization": request.headers.get("authorization", "")}
+    failed_nodes = await get_cluster().broadcast(request.method, path, headers, data=data, files=files)
+    if failed_nodes:
+        logger.log(level=logging.ERROR, msg=f"Catalog write {request.method} {path} failed on nodes {failed_nodes}")
+    return failed_nodes
+
+
+@app.post("/catalog/garments")
+async def add_catalog_garment(
+    request: Request,
+    name: str = Form(...),
+    media_url: str = Form(None),
+    image: UploadFile = File(None),
+    garment_id: str = Form(None)
+):
+    denied = catalog_admin_denied(request)
+    if denied is not None:
+        return denied
+    forwarded = FORWARDED_HEADER in request.headers
+    if garment_id is not None and not forwarded:
+        return responses.JSONResponse(content={"error": "garment_id is picked by the catalog"}, status_code=400)
+    catalog = get_garment_catalog()
     try:
-        image_path = Path(os.path.join(DirectoryPath.OUTPUT_DIR.value, image_name))
-        if image_path.exists():
-            with open(image_path, "rb") as image_file:
-                image_bytes = image_file.read()
-            headers = {
-                "Content-Type": "image/jpeg",
-                "Content-Disposition": "inline"
-            }
-            return Response(content=image_bytes, headers=headers)
+        if image is not None:
+            garment = await run_in_threadpool(catalog.ingest_from_file, name, image.file, garment_id)
+        elif media_url:
+            garment = await run_in_threadpool(catalog.ingest_from_url, name, media_url, None, garment_id)
         else:
-            raise "Image not found"
+            return responses.JSONResponse(content={"error": "Provide an image or a media_url"}, status_code=400)
+    except CatalogIngestError as e:
+        return responses.JSONResponse(content={"error": str(e)}, status_code=400)
     except Exception as e:
-        logger.log(level=logging.ERROR, msg=f"Did not find the output image. Error : {e}")
-        return {"error": "Image not found"}, 404
+        logger.log(level=logging.ERROR, msg=f"Could not add garment to the catalog. Error : {e}")
+        return responses.JSONResponse(content={"error": "Could not add the garment"}, status_code=500)
+    if not forwarded and get_cluster().enabled:
+        # Every node answers catalog picks of its own users, each keeps a copy under the same id
+        data = {"name": name, "garment_id": garment["garment_id"]}
+        files = None
+        if image is not None:
+            await image.seek(0)
+            files = {"image": (image.filename, await image.read(), image.content_type)}
+        else:
+            data["media_url"] = media_url
+        unreplicated_nodes = await replicate_catalog_write(request, request.url.path, data, files)
+        garment = dict(garment, unreplicated_nodes=unreplicated_nodes)
+    return garment
+
+
+@app.get("/catalog/garments")
+def list_catalog_garments():
+    return get_garment_catalog().list_garments()
+
+
+@app.get("/catalog/garments/{garment_id}")
+def get_catalog_garment(garment_id: str):
+    garment = get_garment_catalog().get_garment(garment_id)
+    if garment is None:
+        return responses.JSONResponse(content={"error": "Garment not found"}, status_code=404)
+    return garment
+
+
+@app.get("/catalog/garments/{garment_id}/thumbnail")
+def get_catalog_garment_thumbnail(garment_id: str):
+    thumbnail_path = get_garment_catalog().thumbnail_path(garment_id)
+    if thumbnail_path is None:
+        return responses.JSONResponse(content={"error": "Garment not found"}, status_code=404)
+    return responses.FileResponse(thumbnail_path, media_type="image/jpeg")
+
+
+@app.delete("/catalog/garments/{garment_id}")
+async def delete_catalog_garment(garment_id: str, request: Request):
+    denied = catalog_admin_denied(request)
+    if denied is not None:
+        return denied
+    catalog = get_garment_catalog()
+    if await run_in_threadpool(catalog.get_garment, garment_id) is None:
+        return responses.JSONResponse(content={"error": "Garment not found"}, status_code=404)
+    await run_in_threadpool(catalog.delete_garment, garment_id)
+    if FORWARDED_HEADER in request.headers or not get_cluster().enabled:
+        return {"deleted": garment_id}
+    return {"deleted": garment_id, "unreplicated_nodes": await replicate_catalog_write(request, request.url.path)}
+
+
+async def twilio_media_urls(request: Request):
+    """Every MediaUrlN of the message, WhatsApp allows up to 10 media per message."""
+    form = await request.form()
+    num_media = int(form.get("NumMedia") or 0)
+    return [form[f"MediaUrl{index}"] for index in range(num_media) if form.get(f"MediaUrl{index}")]
 
 
 # Webhook to handle messages from Twilio
 @app.post("/webhook")
-def webhook(
+async def webhook(
     request: Request,
     From: str = Form(...),
     Body: str = Form(...),
     MessageSid: str = Form(...),
     NumMedia: int = Form(0),
-    MediaUrl0: str = Form(None)
+    media_urls: list = Depends(twilio_media_urls)
 ):
-    from_number = From
+    cluster = get_cluster()
+    home_node = cluster.home_node(From)
+    if not cluster.is_local(home_node) and FORWARDED_HEADER not in request.headers:
+        # The user's images and jobs live on their home node, which answers for it
+        return await forward_to_node(request, home_node, await request.form())
+    # Messages of one user are handled one at a time across every worker process, and a
+    # redelivered MessageSid gets the original reply instead of being processed again
+    with trace(MessageSid):
+        waiting_since = time.perf_counter()
+        async with get_user_locks("webhook").async_lock(From):
+            STAGE_SECONDS.observe(time.perf_counter() - waiting_since, stage="user_lock_wait")
+            twiml = await run_in_threadpool(get_metadata_store().get_message_response, MessageSid)
+            if twiml is not None:
+                logger.log(level=logging.INFO, msg=f"Replaying the reply to already processed message {MessageSid}")
+            else:
+                retry_after = await run_in_threadpool(get_rate_limiter().acquire_user_message, From)
+                if retry_after:
+                    RATE_LIMITED.inc(limit="user_messages")
+                    twiml, completed = await run_in_threadpool(rate_limited_reply, From, Body, retry_after), True
+                else:
+                    with span("handle_message"):
+                        twiml, completed = await handle_message(From, Body, NumMedia, media_urls)
+                if completed:
+                    await run_in_threadpool(
+                        get_metadata_store().save_message_response, MessageSid, From, twiml, time.time()
+                    )
+    return Response(content=twiml, media_type="application/xml")
+
+
+def rate_limited_reply(from_number, Body, retry_after):
+    # The message is turned away but still part of the conversation
+    ChatHistoryManager.update_chat_history(from_number, {"user_message": Body.strip().lower()})
+    output_response = (f"You're sending messages faster than I can keep up. Please wait "
+                       f"{math.ceil(retry_after)} seconds and send that again.")
+    response = MessagingResponse()
+    response.message(output_response)
+    ChatHistoryManager.update_chat_history(from_number, {"bot_response": output_response})
+    return str(response)
+
+
+def recent_job_seconds():
+    """Recent typical duration of a try-on job, None when only queue positions should count."""
+    if JobQueueSettings.TRY_ON_MODE.value != VIRTUAL_TRY_ON_JOB:
+        # Merges take milliseconds, the queue depth is all that matters
+        return None
+    latencies = [
+        backend["p50"] for backend in get_try_on_router().backend_status().values()
+        if backend["p50"] is not None and backend["circuit"] == "closed"
+    ]
+    return min(latencies) if latencies else None
+
+
+def start_try_on(image_manager_obj, from_number):
+    """Admit, queue or turn away the try-on of the user's unused images, returning the reply."""
+    job_queue = get_job_queue()
+    start_rate, start_burst = None, 0.0
+    if RateLimitSettings.ENABLED.value:
+        start_rate, start_burst = get_rate_limiter().global_try_on_share()
+    decision, position, expected_wait = admit_try_on(
+        job_queue.backend.depth(), job_queue.capacity(), recent_job_seconds(), start_rate, start_burst
+    )
+    if decision == SHED:
+        ADMISSION_DECISIONS.inc(decision=decision)
+        # Nothing is claimed, the images start a try-on with the user's next message
+        logger.log(level=logging.WARNING, msg=f"Shed a try-on of {from_number} at queue position {position} "
+                   f"(expected wait {expected_wait:.0f}s)")
+        return SHED_REPLY
+    retry_after = get_rate_limiter().acquire_user_try_on(from_number)
+    if retry_after:
+        RATE_LIMITED.inc(limit="user_try_ons")
+        return (f"Your images are saved. You can start another try-on in {math.ceil(retry_after)} seconds, "
+                f"just send any message then.")
+    ADMISSION_DECISIONS.inc(decision=decision)
+
+    # Claim the images and hand the try-on to a worker
+    person_entry, garment_entries = image_manager_obj.fetch_try_on_entries(BatchSettings.MAX_GARMENTS.value)
+    try:
+        job = enqueue_try_on(job_queue, from_number, person_entry, garment_entries)
+    except Exception:
+        # The user keeps their images, their next message starts the try-on again
+        image_manager_obj.return_entries([person_entry] + garment_entries)
+        raise
+    if len(garment_entries) == 1:
+        output_response = (f"Got both images! Your virtual try-on is being prepared "
+                           f"and will be sent shortly. (Job ID: {job.job_id})")
+    else:
+        output_response = (f"Got your person image and {len(garment_entries)} garments! Your virtual "
+                           f"try-ons are being prepared and will be sent shortly. (Job ID: {job.job_id})")
+    if decision == BUSY:
+        output_response = (f"We're busy right now, your try-on is queued at position {position} and will be "
+                           f"sent as soon as it's ready. (Job ID: {job.job_id})")
+    return output_response
+
+
+def enqueue_try_on(job_queue, from_number, person_entry, garment_entries):
+    """Queue the try-on of claimed entries, a batch job when there are several garments."""
+    payload = {
+        "person_image": person_entry["image_location"],
+        # Results are cached under the match hash, shared by near-duplicate photos
+        "person_hash": person_entry["match_hash"],
+        "person_image_id": person_entry["id"]
+    }
+    if len(garment_entries) == 1:
+        payload["garment_image"] = garment_entries[0]["image_location"]
+        payload["garment_hash"] = garment_entries[0]["match_hash"]
+        payload["garment_image_id"] = garment_entries[0]["id"]
+        return job_queue.enqueue(from_number, JobQueueSettings.TRY_ON_MODE.value, payload)
+    # Several garments are tried on the same person in one batch, in the order they were sent
+    payload["garments"] = [
+        {"garment_image": entry["image_location"], "garment_hash": entry["match_hash"],
+         "garment_image_id": entry["id"]}
+        for entry in reversed(garment_entries)
+    ]
+    return job_queue.enqueue(from_number, BATCH_JOBS[JobQueueSettings.TRY_ON_MODE.value], payload)
+
+
+async def handle_message(from_number, Body, NumMedia, media_urls):
+    """Process one incoming message, returning the TwiML reply and whether it completed without error.
+
+    Runs on the event loop, which only awaits: media downloads directly, and everything that takes
+    SQLite transactions, user locks or chat history files in the threadpool, so a slow lock holder
+    holds up its own user and not every message on this worker.
+    """
     message_body = Body.strip().lower()  # Convert to lowercase and remove leading/trailing spaces
     image_manager_obj = ImageManager(user_id=from_number)
-    response = MessagingResponse()
     try:
         chat_entry = {'user_message': message_body}
-        ChatHistoryManager.update_chat_history(from_number, chat_entry)
+        await run_in_threadpool(ChatHistoryManager.update_chat_history, from_number, chat_entry)
 
         image_type = None
         # Determine image type based on message content
@@ -60,71 +487,105 @@ def webhook(
             image_type = "garment"
         elif 'person' in message_body:
             image_type = "person"
-        # Case 1: Image and type provided together
-        if NumMedia > 0 and MediaUrl0 and image_type:
-            try:
-                image_manager_obj.download_image(MediaUrl0, image_type)
-                output_response = f"Got your {image_type} image."
-                if image_type == "garment" and not image_manager_obj.has_unused_image("person"):
-                    output_response += " Also, please provide the person image."
-                elif image_type == "person" and not image_manager_obj.has_unused_image("garment"):
-                    output_response += " Also, please provide the garment image."
-            except Exception as e:
-                logger.log(level=logging.ERROR, msg=f"Error downloading image: {e}")
-                output_response = "Failed to process the image. Please try again."
-
-        # Case 2: Only image provided, no type specified
-        elif NumMedia > 0 and MediaUrl0:
-            try:
-                image_manager_obj.download_image(MediaUrl0, None)
-                output_response = "Please specify the image type for the uploaded image."
-            except Exception as e:
-                logger.log(msg=f"Error downloading image without type: {e}")
-                output_response = "Failed to process the image. Please try again."
-
-        # Case 3: Type specified but no image provided
-        elif image_type and NumMedia == 0:
+        download_error = None
+        if NumMedia > 0 and media_urls:
             try:
-                if not image_manager_obj.has_unused_image(None):
-                    output_response = f"""Please send the {image_type} image to proceed."""
-                    response.message(output_response)
-                    return Response(content=str(response), media_type="application/xml")
-                else:
-                    image_manager_obj.rename_image(old_image_type=None, new_image_type=image_type)
-                    # Check if the complementary image is needed for virtual try-on
-                    if image_type == "garment" and not image_manager_obj.has_unused_image("person"):
-                        output_response = "Also, please provide the person image."
-                    elif image_type == "person" and not image_manager_obj.has_unused_image("garment"):
-                        output_response = "Also, please provide the garment image."
-                    else:
-                        pass
+                await image_manager_obj.download_images_async(media_urls, image_type)
             except Exception as e:
-                logger.log(level=logging.ERROR, msg=f"Error processing image type without image: {e}")
-                output_response = "Failed to process your request. Please try again."
-        # Case 4: No valid image or type information provided
-        else:
-            output_response = "Please provide an image along with its type (garment or person) to use the virtual try-on service."
-
-        if image_manager_obj.has_unused_image("garment") and image_manager_obj.has_unused_image("person"):
-            merge_images_obj = MergeImages(user_id=from_number)
-            # Both images are available, process the virtual try-on
-            file_path = merge_images_obj.merge_images()
-            image_name = os.path.basename(file_path)
-            media_url = f"{TokensAndURLs.BASE_URL.value}/get_image/{image_name}"
-            output_response = "Here is the virtual try-on image!"
-            response.message(output_response).media(media_url)
-        else:
-            response.message(output_response)
-        ChatHistoryManager.update_chat_history(from_number, {"bot_response": output_response})
-        return Response(content=str(response), media_type="application/xml")
+                download_error = e
+        return await run_in_threadpool(
+            reply_to_message, image_manager_obj, from_number, message_body, image_type, NumMedia, media_urls,
+            download_error
+        )
     except Exception as e:
         logger.log(level=logging.ERROR, msg=f"Unexpected error in webhook handler: {e}")
         output_response = "An error occurred while processing your request. Please try again later."
+        response = MessagingResponse()
         response.message(output_response)
-        ChatHistoryManager.update_chat_history(from_number, {"bot_response": output_response})
-        return Response(content=str(response), media_type="application/xml")
+        await run_in_threadpool(ChatHistoryManager.update_chat_history, from_number, {"bot_response": output_response})
+        # Not recorded as processed, so a redelivery gets another attempt
+        return str(response), False
 
 
+def reply_to_message(image_manager_obj, from_number, message_body, image_type, NumMedia, media_urls, download_error):
+    """The reply to a message whose media, if any, were downloaded with download_error as the outcome."""
+    response = MessagingResponse()
+    catalog_garment_ids = get_garment_catalog().find_garment_ids(message_body) if NumMedia == 0 else []
+    # Case 1: Image and type provided together
+    if NumMedia > 0 and media_urls and image_type:
+        if isinstance(download_error, UnsupportedImageError):
+            logger.log(level=logging.ERROR, msg=f"Rejected an upload: {download_error}")
+            output_response = UNSUPPORTED_IMAGE_REPLY
+        elif download_error is not None:
+            logger.log(level=logging.ERROR, msg=f"Error downloading image: {download_error}")
+            output_response = "Failed to process the image. Please try again."
+        else:
+            if len(media_urls) > 1:
+                output_response = f"Got your {len(media_urls)} {image_type} images."
+            else:
+                output_response = f"Got your {image_type} image."
+            if image_type == "garment" and not image_manager_obj.has_unused_image("person"):
+                output_response += " Also, please provide the person image."
+            elif image_type == "person" and not image_manager_obj.has_unused_image("garment"):
+                output_response += " Also, please provide the garment image."
+
+    # Case 2: Only image provided, no type specified
+    elif NumMedia > 0 and media_urls:
+        if isinstance(download_error, UnsupportedImageError):
+            logger.log(level=logging.ERROR, msg=f"Rejected an upload: {download_error}")
+            output_response = UNSUPPORTED_IMAGE_REPLY
+        elif download_error is not None:
+            logger.log(msg=f"Error downloading image without type: {download_error}")
+            output_response = "Failed to process the image. Please try again."
+        else:
+            output_response = "Please specify the image type for the uploaded image."
+
+    # Case 3: A catalog garment picked by ID instead of an upload
+    elif catalog_garment_ids:
+        try:
+            for catalog_garment_id in catalog_garment_ids:
+                get_garment_catalog().select_for_user(from_number, catalog_garment_id)
+            noun = "garments" if len(catalog_garment_ids) > 1 else "garment"
+            output_response = f"Selected {noun} {', '.join(catalog_garment_ids)} from the catalog."
+            if not image_manager_obj.has_unused_image("person"):
+                output_response += " Also, please provide the person image."
+        except Exception as e:
+            logger.log(level=logging.ERROR, msg=f"Error selecting catalog garment: {e}")
+            output_response = "Failed to process your request. Please try again."
+
+    # Case 4: Type specified but no image provided
+    elif image_type and NumMedia == 0:
+        try:
+            if not image_manager_obj.has_unused_image(None):
+                output_response = f"""Please send the {image_type} image to proceed."""
+                response.message(output_response)
+                return str(response), True
+            else:
+                image_manager_obj.rename_all_images(old_image_type=None, new_image_type=image_type)
+                # Check if the complementary image is needed for virtual try-on
+                if image_type == "garment" and not image_manager_obj.has_unused_image("person"):
+                    output_response = "Also, please provide the person image."
+                elif image_type == "person" and not image_manager_obj.has_unused_image("garment"):
+                    output_response = "Also, please provide the garment image."
+                else:
+                    pass
+        except Exception as e:
+            logger.log(level=logging.ERROR, msg=f"Error processing image type without image: {e}")
+            output_response = "Failed to process your request. Please try again."
+    # Case 5: No valid image or type information provided
+    else:
+        output_response = "Please provide an image along with its type (garment or person) to use the virtual try-on service."
+
+    if image_manager_obj.session().state == READY:
+        output_response = start_try_on(image_manager_obj, from_number)
+    response.message(output_response)
+    ChatHistoryManager.update_chat_history(from_number, {"bot_response": output_response})
+    return str(response), True
+
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import uvicorn
+
+    # Several workers need the app as an import string, each worker process imports it itself
+    uvicorn.run("app:app", host=ServerSettings.HOST.value, port=ServerSettings.PORT.value,
+                workers=ServerSettings.WORKERS.value)
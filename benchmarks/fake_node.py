@@ -0,0 +1,22 @@
+"""The app wired to the local stand-ins, for benchmarks that run it as a real server.
+
+uvicorn imports benchmarks.fake_node:app in every worker process, which reads:
+    BENCH_MEDIA_BASE      base URL of the fake media server
+    BENCH_MODEL_LATENCY   seconds the fake try-on backend takes
+    BENCH_DELIVERY_LOG    JSON lines file every reply is appended to
+"""
+import os
+
+from benchmarks.fakes import install_fakes
+
+install_fakes(
+    os.environ["BENCH_MEDIA_BASE"], model_latency=float(os.environ.get("BENCH_MODEL_LATENCY", "0.5")),
+    delivery_log=os.environ["BENCH_DELIVERY_LOG"]
+)
+
+# Imported once the fakes are in place
+import app as app_module
+
+# The router already points at the fake backend, there are no gradio clients to warm
+app_module.start_gradio_pools = lambda: None
+app = app_module.app
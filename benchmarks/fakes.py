@@ -0,0 +1,168 @@
+"""Local stand-ins for Twilio and the gradio backends, shared by the benchmarks.
+
+media server   answers /media/<name> with a phone-sized JPEG and /result/<name> with a model
+               output, each after a configurable latency, like Twilio's media host and the
+               gradio file server
+Twilio client  replaces the REST client behind TwilioMessenger and records every send, also to a
+               JSON lines file when the app runs in other processes
+try-on backend a FakeTryOnBackend that returns a /result URL on the media server
+S3 client      the slice of a boto3 S3 client that S3OutputBackend uses, backed by a directory
+"""
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+
+def photo_bytes(size):
+    from benchmarks.merge_benchmark import make_photo
+
+    buffer = io.BytesIO()
+    make_photo(buffer, size)
+    return buffer.getvalue()
+
+
+def serve_media(port, latency, photo_size=(1512, 2016)):
+    import uvicorn
+
+    from starlette.applications import Starlette
+    from starlette.responses import Response
+    from starlette.routing import Route
+
+    photo = photo_bytes(photo_size)
+    result = photo_bytes((768, 1024))
+
+    async def media(request):
+        await asyncio.sleep(latency)
+        # Bytes after the JPEG end marker are ignored by decoders but give every URL its own
+        # content hash, so the blob store does not deduplicate every upload into one file
+        return Response(photo + request.path_params["name"].encode(), media_type="image/jpeg")
+
+    async def model_result(request):
+        await asyncio.sleep(latency)
+        return Response(result, media_type="image/jpeg")
+
+    app = Starlette(routes=[Route("/media/{name}", media), Route("/result/{name}", model_result)])
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Media server did not start on port {port}")
+
+
+@contextmanager
+def media_server(latency, photo_size=(1512, 2016)):
+    """Run serve_media in its own process, yielding its base URL."""
+    port = free_port()
+    process = multiprocessing.get_context("spawn").Process(
+        target=serve_media, args=(port, latency, photo_size), daemon=True
+    )
+    process.start()
+    try:
+        wait_for_port(port)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.join()
+
+
+class FakeTwilioClient:
+    """The slice of twilio.rest.Client that TwilioMessenger uses, recording when each user got a reply."""
+
+    def __init__(self, latency=0.0, delivery_log=None):
+        self.latency = latency
+        self.delivery_log = delivery_log
+        self.sent = []
+        self._lock = threading.Lock()
+        self._replied = threading.Condition(self._lock)
+        self.messages = SimpleNamespace(create=self.create)
+
+    def create(self, from_=None, to=None, body=None, media_url=None):
+        time.sleep(self.latency)
+        with self._replied:
+            self.sent.append({"to": to, "body": body, "media_url": media_url, "at": time.perf_counter()})
+            self._replied.notify_all()
+        if self.delivery_log:
+            # One short append per line, so lines from several processes do not interleave
+            with open(self.delivery_log, "a") as file:
+                file.write(json.dumps({"to": to, "body": body, "media_url": media_url, "at": time.time()}) + "\n")
+        return SimpleNamespace(sid=f"SM{uuid.uuid4().hex}")
+
+    def wait_for(self, count, timeout):
+        """Block until count messages were sent, returning False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._replied:
+            while len(self.sent) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._replied.wait(remaining)
+        return True
+
+
+class FakeS3Client:
+    """Keeps objects under root_dir/<bucket>/<key> and signs nothing."""
+
+    def __init__(self, root_dir, base_url="http://s3.local"):
+        self.root_dir = root_dir
+        self.base_url = base_url
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root_dir, bucket, key)
+
+    def upload_file(self, filename, bucket, key, ExtraArgs=None):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(filename, path)
+
+    def delete_object(self, Bucket, Key):
+        # Like S3, deleting a missing key is not an error
+        path = self._path(Bucket, Key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn=3600):
+        return f"{self.base_url}/{Params['Bucket']}/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+
+    def exists(self, bucket, key):
+        return os.path.exists(self._path(bucket, key))
+
+
+def install_fakes(media_base, model_latency=0.5, twilio_latency=0.0, delivery_log=None, upload_latency=0.0):
+    """Point TwilioMessenger and the try-on router at local fakes, returning the fake Twilio client.
+
+    Call before the app handles anything, in the process that runs the app.
+    """
+    import try_on_router
+    from twilio_messenger import TwilioMessenger
+
+    twilio = FakeTwilioClient(twilio_latency, delivery_log)
+    TwilioMessenger._client = twilio
+    backend = try_on_router.FakeTryOnBackend(
+        "fake_gradio", latency=model_latency, result=f"{media_base}/result/output.jpeg",
+        upload_latency=upload_latency
+    )
+    try_on_router._try_on_router = try_on_router.TryOnRouter([backend])
+    return twilio
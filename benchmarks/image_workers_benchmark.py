@@ -0,0 +1,114 @@
+"""Batch merge wall time for the ways of handing the decoded person image to image workers.
+
+Run from the repository root:  python -m benchmarks.image_workers_benchmark [--garments 6]
+
+one worker     the whole batch in a single worker process, the person decoded once
+pickled        the person decoded in one worker, its pixels pickled to every garment task
+shared memory  the person decoded into a SharedPanel, garment tasks attach it by name
+"""
+import argparse
+import os
+import pickle
+import tempfile
+import time
+
+from benchmarks.merge_benchmark import make_photo
+from image_pipeline import (
+    compose_side_by_side, decode_panel_to_shared, encode_jpeg, load_panel, merge_with_shared_panel
+)
+from image_workers import ImageWorkerPool, ImageWorkersBusyError, SharedPanel
+from constants import MergeSettings
+
+BOX = (MergeSettings.PANEL_WIDTH.value, MergeSettings.PANEL_HEIGHT.value)
+
+
+def merge_all_in_one_worker(person_path, garment_paths, output_paths):
+    person_pixels = load_panel(person_path, BOX)
+    for garment_path, output_path in zip(garment_paths, output_paths):
+        encode_jpeg(compose_side_by_side([person_pixels, load_panel(garment_path, BOX)], BOX), output_path)
+    return output_paths
+
+
+def merge_with_pickled_panel(person_pixels, garment_path, output_path):
+    encode_jpeg(compose_side_by_side([person_pixels, load_panel(garment_path, BOX)], BOX), output_path)
+    return output_path
+
+
+def decode_panel(image_path):
+    return load_panel(image_path, BOX)
+
+
+def sleep_task(seconds):
+    time.sleep(seconds)
+
+
+def run_one_worker(pool, person_path, garment_paths, output_paths):
+    pool.run(merge_all_in_one_worker, person_path, garment_paths, output_paths)
+    return 0
+
+
+def run_pickled(pool, person_path, garment_paths, output_paths):
+    person_pixels = pool.run(decode_panel, person_path)
+    pool.map(merge_with_pickled_panel, [person_pixels] * len(garment_paths), garment_paths, output_paths)
+    # The pixels cross the pipe once back from the decode and once to every garment task
+    return len(pickle.dumps(person_pixels)) * (1 + len(garment_paths))
+
+
+def run_shared(pool, person_path, garment_paths, output_paths):
+    shared_panel = SharedPanel.allocate((BOX[1], BOX[0], 3))
+    try:
+        person_panel = pool.run(decode_panel_to_shared, person_path, shared_panel)
+        pool.map(merge_with_shared_panel, [person_panel] * len(garment_paths), garment_paths, output_paths)
+    finally:
+        shared_panel.unlink()
+    return len(pickle.dumps(person_panel)) * (1 + len(garment_paths))
+
+
+STRATEGIES = {"one worker": run_one_worker, "pickled": run_pickled, "shared memory": run_shared}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--garments", type=int, default=6)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    pool = ImageWorkerPool(max_workers=args.workers)
+    with tempfile.TemporaryDirectory() as work_dir:
+        person_path = os.path.join(work_dir, "person.jpeg")
+        make_photo(person_path, (3024, 4032))
+        garment_paths = []
+        for index in range(args.garments):
+            garment_paths.append(os.path.join(work_dir, f"garment_{index}.jpeg"))
+            make_photo(garment_paths[-1], (1500 + 50 * index, 1500))
+        output_paths = [os.path.join(work_dir, f"out_{index}.jpeg") for index in range(args.garments)]
+
+        # Start every worker process before timing anything
+        pool.map(sleep_task, [0.2] * args.workers)
+        print(f"{args.garments} garments, {args.workers} workers")
+        print(f"{'strategy':<14} {'ms/batch':>10} {'pickled KB':>11}")
+        for name, strategy in STRATEGIES.items():
+            started = time.perf_counter()
+            for _ in range(args.repeats):
+                pickled_bytes = strategy(pool, person_path, garment_paths, output_paths)
+            elapsed = (time.perf_counter() - started) / args.repeats
+            print(f"{name:<14} {elapsed * 1000:>10.1f} {pickled_bytes / 1024:>11.1f}")
+    pool.shutdown()
+
+    # Backpressure: one worker, one queued task, anything beyond waits briefly and is rejected
+    pool = ImageWorkerPool(max_workers=1, max_queued=1, submit_timeout=0.1)
+    accepted = []
+    for _ in range(4):
+        try:
+            accepted.append(pool.submit(sleep_task, 0.5))
+        except ImageWorkersBusyError:
+            pass
+    print(f"backpressure   accepted {len(accepted)} of 4, metrics {pool.metrics()}")
+    for future in accepted:
+        future.result()
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Time and peak memory of the merge step per input size.
+
+Run from the repository root:  python -m benchmarks.merge_benchmark
+Each case runs in a fresh process so peak RSS is not shared between cases.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from PIL import Image
+
+from image_pipeline import merge_side_by_side
+
+# (label, person size, garment size), phone photos are 3024x4032 (12MP)
+CASES = [
+    ("1MP", (864, 1152), (1000, 1000)),
+    ("5MP", (1944, 2592), (1500, 1500)),
+    ("12MP", (3024, 4032), (2000, 2000)),
+]
+
+
+def legacy_merge(person_image_path, garment_image_path, output_path):
+    """The original full-resolution paste, kept for comparison."""
+    person_image = Image.open(person_image_path)
+    garment_image = Image.open(garment_image_path)
+    combined_image = Image.new('RGB', (person_image.width + garment_image.width,
+                                       max(person_image.height, garment_image.height)))
+    combined_image.paste(person_image, (0, 0))
+    combined_image.paste(garment_image, (person_image.width, 0))
+    combined_image.save(output_path)
+
+
+IMPLEMENTATIONS = {"legacy": legacy_merge, "pipeline": merge_side_by_side}
+
+
+def make_photo(path, size):
+    # Smooth gradients with light sensor-like noise compress roughly like a real photo
+    gradient = Image.merge("RGB", [
+        Image.linear_gradient("L").resize(size),
+        Image.radial_gradient("L").resize(size),
+        Image.linear_gradient("L").rotate(90).resize(size),
+    ])
+    noise = Image.effect_noise(size, 12).convert("RGB")
+    Image.blend(gradient, noise, 0.15).save(path, "JPEG", quality=90)
+
+
+def peak_rss_kib():
+    """High-water RSS of this process in KiB.
+
+    VmHWM is preferred on Linux because ru_maxrss survives exec and would report
+    the parent's peak in a freshly spawned worker.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_case(implementation, person_path, garment_path, output_path, repeats, results):
+    merge = IMPLEMENTATIONS[implementation]
+    rss_before = peak_rss_kib()
+    started = time.perf_counter()
+    for _ in range(repeats):
+        merge(person_path, garment_path, output_path)
+    elapsed = (time.perf_counter() - started) / repeats
+    rss_after = peak_rss_kib()
+    results.put((elapsed, (rss_after - rss_before) / 1024, os.path.getsize(output_path)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as work_dir:
+        print(f"{'case':<6} {'impl':<9} {'ms/merge':>10} {'peak MB':>9} {'output KB':>10}")
+        for label, person_size, garment_size in CASES:
+            person_path = os.path.join(work_dir, f"person_{label}.jpeg")
+            garment_path = os.path.join(work_dir, f"garment_{label}.jpeg")
+            make_photo(person_path, person_size)
+            make_photo(garment_path, garment_size)
+            for implementation in IMPLEMENTATIONS:
+                results = context.Queue()
+                output_path = os.path.join(work_dir, f"out_{label}_{implementation}.jpeg")
+                process = context.Process(
+                    target=run_case,
+                    args=(implementation, person_path, garment_path, output_path, args.repeats, results)
+                )
+                process.start()
+                elapsed, peak_mb, output_bytes = results.get()
+                process.join()
+                print(f"{label:<6} {implementation:<9} {elapsed * 1000:>10.1f} {peak_mb:>9.1f} {output_bytes / 1024:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Throughput of the scale-out modes as processes are added, measured over real HTTP.
+
+Run from the repository root:
+    python -m benchmarks.scale_out                              both modes at 1, 2 and 4 processes
+    python -m benchmarks.scale_out --mode nodes --processes 1,3
+
+workers  one node running `uvicorn --workers N`, the worker processes share the node's SQLite stores
+nodes    N single-worker nodes, each with its own data directory and CLUSTER_NODES naming all of
+         them. Every user's messages go to the nodes round-robin, so most are forwarded to the
+         user's home node.
+
+Each user sends a person and a garment photo, and the conversation ends when a server process's
+fake Twilio client logs the result. The load grows with the processes (--users-per-process), so a
+process has the same work at every size. Throughput counts conversations per second over the
+whole run; efficiency divides it by N times the one-process throughput.
+
+The try-on is a FakeTryOnBackend that waits --model-latency, like the model Spaces it stands in
+for, and the photos are small. This keeps local CPU from being the limit. On a host with few
+cores, the CPU-bound stages flatten the curve well before the processes do. At the end one output
+URL is fetched from every node, to check it resolves wherever it is asked for.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from benchmarks.fakes import free_port, media_server
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(work_dir, port, workers, environment):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.fake_node:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=work_dir, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def wait_until_ready(server, port, timeout=60.0):
+    """Wait for GET /metrics to answer, the port alone is bound by the uvicorn supervisor early."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server on port {port} exited with code {server.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"The server on port {port} did not answer within {timeout}s")
+
+
+def server_environment(args, media_base, delivery_log, workers):
+    environment = dict(os.environ)
+    environment.update({
+        "PYTHONPATH": REPO_ROOT + os.pathsep + environment.get("PYTHONPATH", ""),
+        "BENCH_MEDIA_BASE": media_base,
+        "BENCH_MODEL_LATENCY": str(args.model_latency),
+        "BENCH_DELIVERY_LOG": delivery_log,
+        "TRY_ON_MODE": "virtual_try_on",
+        "PREVIEW_ENABLED": "false",
+        "RATE_LIMIT_ENABLED": "false",
+        # The same durable queue at every size, so one process is not flattered by the in-memory one
+        "JOB_QUEUE_BACKEND": "sqlite",
+        "JOB_QUEUE_WORKERS": str(args.job_workers),
+        "IMAGE_WORKERS": "1",
+        "WEB_WORKERS": str(workers)
+    })
+    return environment
+
+
+def delivered(delivery_log):
+    if not os.path.exists(delivery_log):
+        return []
+    with open(delivery_log) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+async def converse(client, base_urls, media_base, user_id, index):
+    for step, image_type in enumerate(("person", "garment")):
+        form = {
+            "From": user_id,
+            "Body": image_type,
+            "MessageSid": f"SM{user_id}{image_type}",
+            "NumMedia": "1",
+            "MediaUrl0": f"{media_base}/media/{user_id[-8:]}{image_type}"
+        }
+        base_url = base_urls[(index + step) % len(base_urls)]
+        response = await client.post(f"{base_url}/webhook", data=form)
+        if response.status_code != 200 or "Please try again" in response.text:
+            raise RuntimeError(f"Webhook failed: {response.status_code} {response.text}")
+
+
+async def send_load(base_urls, media_base, users, run_id):
+    import httpx
+
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        await asyncio.gather(*[
+            converse(client, base_urls, media_base, f"whatsapp:+1{run_id:05d}{index:06d}", index)
+            for index in range(users)
+        ])
+
+
+def check_output_everywhere(base_urls, media_url):
+    import httpx
+
+    image_path = "/get_image/" + media_url.rsplit("/get_image/", 1)[1]
+    statuses = [httpx.get(f"{base_url}{image_path}", timeout=30).status_code for base_url in base_urls]
+    if any(status != 200 for status in statuses):
+        raise RuntimeError(f"{image_path} answered {statuses} on the nodes")
+
+
+def run_size(args, mode, processes, media_base):
+    """Conversations per second with this many processes."""
+    work_root = tempfile.mkdtemp(prefix=f"scale_out_{mode}_")
+    delivery_log = os.path.join(work_root, "deliveries.jsonl")
+    servers = []
+    try:
+        if mode == "workers":
+            ports = [free_port()]
+            servers.append(start_server(
+                work_root, ports[0], processes, server_environment(args, media_base, delivery_log, processes)
+            ))
+        else:
+            ports = [free_port() for _ in range(processes)]
+            nodes = ",".join(f"n{index}=http://127.0.0.1:{port}" for index, port in enumerate(ports))
+            for index, port in enumerate(ports):
+                work_dir = os.path.join(work_root, f"n{index}")
+                os.makedirs(work_dir)
+                environment = server_environment(args, media_base, delivery_log, 1)
+                environment.update({"NODE_ID": f"n{index}", "CLUSTER_NODES": nodes})
+                servers.append(start_server(work_dir, port, 1, environment))
+        for server, port in zip(servers, ports):
+            wait_until_ready(server, port)
+        base_urls = [f"http://127.0.0.1:{port}" for port in ports]
+
+        users = args.users_per_process * processes
+        run_id = int(time.time() * 1000) % 100000
+        begun = time.perf_counter()
+        asyncio.run(send_load(base_urls, media_base, users, run_id))
+        deadline = time.monotonic() + args.timeout
+        while len(delivered(delivery_log)) < users:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Only {len(delivered(delivery_log))} of {users} results were delivered")
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - begun
+        replies = delivered(delivery_log)
+        failed = [reply for reply in replies if not reply["media_url"]]
+        if failed:
+            raise RuntimeError(f"{len(failed)} try-ons failed: {failed[0]['body']}")
+        check_output_everywhere(base_urls, replies[0]["media_url"][0])
+        return users / elapsed
+    finally:
+        for server in servers:
+            server.terminate()
+        for server in servers:
+            server.wait(timeout=30)
+        shutil.rmtree(work_root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("workers", "nodes", "both"), default="both")
+    parser.add_argument("--processes", default="1,2,4")
+    parser.add_argument("--users-per-process", type=int, default=16)
+    parser.add_argument("--job-workers", type=int, default=4, help="job queue workers in each process")
+    parser.add_argument("--model-latency", type=float, default=1.0)
+    parser.add_argument("--media-latency", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    modes = ("workers", "nodes") if args.mode == "both" else (args.mode,)
+    sizes = [int(size) for size in args.processes.split(",")]
+    with media_server(args.media_latency, photo_size=(480, 640)) as media_base:
+        print(f"{'mode':<8} {'processes':>9} {'users':>6} {'conv/s':>8} {'efficiency':>11}")
+        for mode in modes:
+            single = None
+            for processes in sizes:
+                throughput = run_size(args, mode, processes, media_base)
+                if single is None:
+                    single = throughput / processes
+                efficiency = throughput / (single * processes)
+                print(f"{mode:<8} {processes:>9} {args.users_per_process * processes:>6} {throughput:>8.2f} "
+                      f"{efficiency:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
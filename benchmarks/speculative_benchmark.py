@@ -0,0 +1,143 @@
+"""Latency from the second photo to the delivered result, with and without speculative preprocessing.
+
+Run from the repository root:  python -m benchmarks.speculative_benchmark [--users 10] [--gap 1.0]
+
+Each user sends a person photo, waits --gap seconds as someone choosing a garment would, and then
+sends the garment photo. The latency runs from the garment message to the result reaching the fake
+Twilio client, which is what the user waits for once they have sent both.
+
+merge           the side-by-side merge, where the cells of the first photo are ready by the time
+                the second arrives
+virtual_try_on  the fake gradio backend, which spends --upload-latency sending each input that was
+                not uploaded ahead, like gradio_client uploading a file before predict()
+
+Each mode and setting runs in a fresh spawned process with its own scratch directory.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.fakes import media_server
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run_users(options, results):
+    import httpx
+
+    from benchmarks.fakes import install_fakes
+
+    import app
+
+    twilio = install_fakes(options["media_base"], model_latency=options["model_latency"],
+                           upload_latency=options["upload_latency"])
+    app.get_job_queue().start()
+    users = options["users"]
+    run_id = int(time.time() * 1000) % 100000
+
+    async def send(client, user_id, image_type):
+        form = {
+            "From": user_id,
+            "Body": image_type,
+            "MessageSid": f"SM{user_id}{image_type}",
+            "NumMedia": "1",
+            "MediaUrl0": f"{options['media_base']}/media/{run_id}{user_id[-6:]}{image_type}"
+        }
+        response = await client.post("/webhook", data=form)
+        if response.status_code != 200 or "Please try again" in response.text:
+            raise RuntimeError(f"Webhook failed: {response.status_code} {response.text}")
+
+    async def converse(client, index, garment_sent):
+        user_id = f"whatsapp:+1{run_id:05d}{index:06d}"
+        await send(client, user_id, "person")
+        await asyncio.sleep(options["gap"])
+        garment_sent[user_id] = time.perf_counter()
+        await send(client, user_id, "garment")
+
+    async def run():
+        garment_sent = {}
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=120) as client:
+            await asyncio.gather(*[converse(client, index, garment_sent) for index in range(users)])
+        return garment_sent
+
+    try:
+        garment_sent = asyncio.run(run())
+        if not twilio.wait_for(users, timeout=options["timeout"]):
+            raise RuntimeError(f"Only {len(twilio.sent)} of {users} results were delivered")
+        failed = [message for message in twilio.sent if not message["media_url"]]
+        if failed:
+            raise RuntimeError(f"{len(failed)} try-ons failed: {failed[0]['body']}")
+        latencies = sorted(message["at"] - garment_sent[message["to"]] for message in twilio.sent)
+        results.put({"p50_ms": percentile(latencies, 0.5) * 1000, "p99_ms": percentile(latencies, 0.99) * 1000})
+    except Exception as e:
+        results.put({"error": repr(e)})
+    finally:
+        app.on_shutdown()
+
+
+def run_setting(options, environment, results):
+    work_dir = tempfile.mkdtemp(prefix="bench_speculative_")
+    os.chdir(work_dir)
+    # Settings are read when the modules are first imported, which happens after this
+    os.environ.update(environment)
+    try:
+        run_users(options, results)
+    finally:
+        os.chdir(tempfile.gettempdir())
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def measure(options, environment):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_setting, args=(options, environment, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="merge,virtual_try_on")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--gap", type=float, default=1.0, help="seconds between a user's two photos")
+    parser.add_argument("--media-latency", type=float, default=0.2)
+    parser.add_argument("--model-latency", type=float, default=0.5)
+    parser.add_argument("--upload-latency", type=float, default=0.3, help="seconds the fake backend takes per input")
+    args = parser.parse_args()
+
+    # Each setting runs in a scratch directory, the repository must stay importable from there
+    sys.path.insert(0, os.getcwd())
+    options = {
+        "users": args.users,
+        "gap": args.gap,
+        "model_latency": args.model_latency,
+        "upload_latency": args.upload_latency,
+        "timeout": 300
+    }
+    print(f"{'mode':<15} {'speculative':>11} {'p50 ms':>9} {'p99 ms':>9}")
+    with media_server(args.media_latency) as media_base:
+        options["media_base"] = media_base
+        for mode in args.modes.split(","):
+            for enabled in ("false", "true"):
+                # The preview is a message of its own, only the result is timed
+                environment = {"TRY_ON_MODE": mode, "SPECULATIVE_ENABLED": enabled, "PREVIEW_ENABLED": "false",
+                               "RATE_LIMIT_ENABLED": "false"}
+                result = measure(options, environment)
+                if "error" in result:
+                    print(f"{mode:<15} {enabled:>11} failed: {result['error']}")
+                    continue
+                print(f"{mode:<15} {enabled:>11} {result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Cold start of a new replica, checked against a time budget.
+
+Run from the repository root:
+    python -m benchmarks.startup_benchmark
+    python -m benchmarks.startup_benchmark --runs 5 --import-budget-ms 600 --ready-budget-ms 1000
+
+import  python -X importtime -c "import app" in a fresh interpreter: the cumulative import time
+        of app, and the modules app imports directly that took longest
+ready   a fresh `python -m uvicorn app:app`, from launch until GET /metrics first answers 200
+
+Every run is a new interpreter in its own scratch directory, so nothing is cached in the process
+and no database exists yet. The median of the runs is compared to each budget, and the script
+exits 1 when one is over, so a slow import creeping back in fails the check.
+"""
+import argparse
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child_environment():
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = REPO_ROOT + os.pathsep + environment.get("PYTHONPATH", "")
+    # The merge mode has no model backends to connect to at startup
+    environment.setdefault("TRY_ON_MODE", "merge")
+    return environment
+
+
+def parse_importtime(stderr):
+    """Return (cumulative microseconds of app, {module app imports directly: cumulative microseconds})."""
+    # A module's imports are listed before it, so the depth 1 lines since the last top-level one are app's
+    pending = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            pending[name.strip()] = int(cumulative)
+        elif depth == 0:
+            if name.strip() == "app":
+                return int(cumulative), pending
+            pending = {}
+    raise RuntimeError("importtime did not report the app module")
+
+
+def measure_import(work_dir):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"], cwd=work_dir, env=child_environment(),
+        capture_output=True, text=True, check=True
+    )
+    return parse_importtime(result.stderr)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_ready(work_dir, timeout=30.0):
+    """Seconds from launching the server until it answers a request."""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/metrics"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        cwd=work_dir, env=child_environment(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"The server exited with code {server.returncode} before answering")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError(f"The server did not answer within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--import-budget-ms", type=float, default=600)
+    parser.add_argument("--ready-budget-ms", type=float, default=1000)
+    parser.add_argument("--top", type=int, default=8, help="direct imports of app to list")
+    args = parser.parse_args()
+
+    import_times, ready_times, direct_imports = [], [], []
+    for _ in range(args.runs):
+        for measure, results in ((measure_import, import_times), (measure_ready, ready_times)):
+            work_dir = tempfile.mkdtemp(prefix="startup_benchmark_")
+            try:
+                result = measure(work_dir)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            if measure is measure_import:
+                result, direct = result
+                direct_imports.append(direct)
+                results.append(result / 1e6)
+            else:
+                results.append(result)
+
+    import_ms = statistics.median(import_times) * 1000
+    ready_ms = statistics.median(ready_times) * 1000
+    print(f"{'':<8} {'median ms':>10} {'max ms':>8} {'budget ms':>10}")
+    print(f"{'import':<8} {import_ms:>10.0f} {max(import_times) * 1000:>8.0f} {args.import_budget_ms:>10.0f}")
+    print(f"{'ready':<8} {ready_ms:>10.0f} {max(ready_times) * 1000:>8.0f} {args.ready_budget_ms:>10.0f}")
+
+    print("\nslowest direct imports of app (median ms)")
+    modules = {name for direct in direct_imports for name in direct}
+    medians = {
+        name: statistics.median(direct.get(name, 0) for direct in direct_imports) / 1000 for name in modules
+    }
+    for name, median in sorted(medians.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {name:<40} {median:>8.1f}")
+
+    over = []
+    if import_ms > args.import_budget_ms:
+        over.append(f"import took {import_ms:.0f}ms, the budget is {args.import_budget_ms:.0f}ms")
+    if ready_ms > args.ready_budget_ms:
+        over.append(f"ready took {ready_ms:.0f}ms, the budget is {args.ready_budget_ms:.0f}ms")
+    for problem in over:
+        print(f"OVER BUDGET: {problem}")
+    sys.exit(1 if over else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""Micro benchmarks and concurrent-user scenarios, compared against a saved baseline.
+
+Run from the repository root:
+    python -m benchmarks.suite                                   everything, as a table
+    python -m benchmarks.suite --only merge,metadata             a subset
+    python -m benchmarks.suite --save-baseline baseline.json     record the numbers to beat
+    python -m benchmarks.suite --baseline baseline.json          exit 1 when something regressed
+
+micro  merge         merge_side_by_side of a 12MP person and a garment photo
+       normalize     ingest normalization of a 12MP upload
+       metadata      the metadata store calls one webhook makes
+       chat_history  chat history appends
+macro  users_<N>     N users each send a person and a garment photo through the real app over
+                     ASGI. Media comes from a local media server, the try-on from a fake gradio
+                     backend and replies go to a fake Twilio client. Latency runs from the first
+                     message to the delivered result, the preview sent before it is not counted.
+
+Each benchmark runs in a fresh spawned process with its own scratch directory, so its peak
+memory is its own and no state carries over. A baseline is compared per benchmark: lower
+throughput, higher p99 or higher peak memory beyond --tolerance is flagged.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from contextlib import ExitStack
+
+from benchmarks.fakes import media_server
+
+MICRO_BENCHMARKS = ("merge", "normalize", "metadata", "chat_history")
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def reset_peak_rss():
+    """Start the peak memory over from the current RSS, so setup is not counted (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def timed_calls(function, count):
+    reset_peak_rss()
+    latencies = []
+    started = time.perf_counter()
+    for index in range(count):
+        call_started = time.perf_counter()
+        function(index)
+        latencies.append(time.perf_counter() - call_started)
+    return count, time.perf_counter() - started, latencies
+
+
+def bench_merge(options):
+    from benchmarks.merge_benchmark import make_photo
+    from image_pipeline import merge_side_by_side
+
+    make_photo("person.jpeg", (3024, 4032))
+    make_photo("garment.jpeg", (2000, 2000))
+    return timed_calls(lambda index: merge_side_by_side("person.jpeg", "garment.jpeg", "out.jpeg"),
+                       options["repeats"])
+
+
+def bench_normalize(options):
+    from benchmarks.merge_benchmark import make_photo
+    from image_pipeline import normalize_image
+
+    make_photo("upload.jpeg", (3024, 4032))
+    return timed_calls(lambda index: normalize_image("upload.jpeg", "normalized.jpeg", "thumb.jpeg"),
+                       options["repeats"])
+
+
+def bench_metadata(options):
+    from image_handler import UserMetadataManager
+    from metadata_store import get_metadata_store
+
+    store = get_metadata_store()
+
+    def webhook_calls(index):
+        user_id = f"whatsapp:+1555{index % 50:07d}"
+        message_sid = f"SM{index:08d}"
+        manager = UserMetadataManager(user_id)
+        store.get_message_response(message_sid)
+        manager.add_image_metadata(f"https://media.example/{index}", f"blob_{index}.jpeg", "garment",
+                                   content_hash=f"{index:064x}")
+        for image_type in ("person", "garment", None):
+            manager.session().has(image_type)
+        manager.claim_latest_unused_image("garment")
+        store.save_message_response(message_sid, user_id, "<Response/>", time.time())
+
+    return timed_calls(webhook_calls, options["repeats"] * 100)
+
+
+def bench_chat_history(options):
+    from chat_history_manager import get_chat_history_log
+
+    chat_history = get_chat_history_log()
+    count, elapsed, latencies = timed_calls(
+        lambda index: chat_history.append(f"whatsapp:+1555{index % 50:07d}", {"user_message": f"garment {index}"}),
+        options["repeats"] * 500
+    )
+    chat_history.flush()
+    return count, elapsed, latencies
+
+
+def bench_users(options):
+    import httpx
+
+    from benchmarks.fakes import install_fakes
+
+    import app
+    from try_on_jobs import PREVIEW_RESPONSE
+
+    twilio = install_fakes(options["media_base"], model_latency=options["model_latency"])
+    app.get_job_queue().start()
+    users = options["users"]
+    run_id = int(time.time() * 1000) % 100000
+
+    async def converse(client, index, started):
+        user_id = f"whatsapp:+1{run_id:05d}{index:06d}"
+        started[user_id] = time.perf_counter()
+        for image_type in ("person", "garment"):
+            form = {
+                "From": user_id,
+                "Body": image_type,
+                "MessageSid": f"SM{user_id}{image_type}",
+                "NumMedia": "1",
+                "MediaUrl0": f"{options['media_base']}/media/{run_id}{index}{image_type}"
+            }
+            response = await client.post("/webhook", data=form)
+            if response.status_code != 200 or "Please try again" in response.text:
+                raise RuntimeError(f"Webhook failed: {response.status_code} {response.text}")
+
+    async def run_users():
+        started = {}
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=120) as client:
+            await asyncio.gather(*[converse(client, index, started) for index in range(users)])
+        return started
+
+    try:
+        reset_peak_rss()
+        begun = time.perf_counter()
+        started = asyncio.run(run_users())
+        # Each user gets a preview and then the result
+        if not twilio.wait_for(users * 2, timeout=options["timeout"]):
+            raise RuntimeError(f"Only {len(twilio.sent)} of {users * 2} messages were delivered")
+        results = [message for message in twilio.sent if message["body"] != PREVIEW_RESPONSE]
+        failed = [message for message in results if not message["media_url"]]
+        if failed:
+            raise RuntimeError(f"{len(failed)} try-ons failed: {failed[0]['body']}")
+        latencies = [message["at"] - started[message["to"]] for message in results]
+        return users, max(message["at"] for message in results) - begun, latencies
+    finally:
+        app.on_shutdown()
+
+
+BENCHMARKS = {
+    "merge": bench_merge,
+    "normalize": bench_normalize,
+    "metadata": bench_metadata,
+    "chat_history": bench_chat_history,
+    "users": bench_users
+}
+
+
+def run_benchmark(kind, options, environment, results):
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{kind}_")
+    os.chdir(work_dir)
+    # Settings are read when the modules are first imported, which happens after this
+    os.environ.update(environment)
+    try:
+        from benchmarks.merge_benchmark import peak_rss_kib
+
+        count, elapsed, latencies = BENCHMARKS[kind](options)
+        latencies.sort()
+        results.put({
+            "throughput": count / elapsed,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "peak_mb": peak_rss_kib() / 1024
+        })
+    except Exception as e:
+        results.put({"error": repr(e)})
+    finally:
+        os.chdir(tempfile.gettempdir())
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_in_process(kind, options, environment):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_benchmark, args=(kind, options, environment, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Regressions against the baseline, as printable lines."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or "error" in result:
+            continue
+        checks = [
+            ("throughput", result["throughput"] < base["throughput"] * (1 - tolerance)),
+            ("p99_ms", result["p99_ms"] > base["p99_ms"] * (1 + tolerance)),
+            ("peak_mb", result["peak_mb"] > base["peak_mb"] * (1 + tolerance))
+        ]
+        for metric, regressed in checks:
+            if regressed:
+                change = (result[metric] - base[metric]) / base[metric] * 100
+                regressions.append(
+                    f"{name}: {metric} {result[metric]:.1f} against {base[metric]:.1f} in the baseline ({change:+.0f}%)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", help="comma separated benchmark names, users_<N> included")
+    parser.add_argument("--users", default="10,50", help="concurrent users of the macro scenarios")
+    parser.add_argument("--repeats", type=int, default=10, help="scales the number of micro iterations")
+    parser.add_argument("--media-latency", type=float, default=0.2)
+    parser.add_argument("--model-latency", type=float, default=0.5)
+    parser.add_argument("--baseline", help="JSON file from --save-baseline to compare with")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change before flagging")
+    args = parser.parse_args()
+
+    # Benchmarks run in scratch directories, the repository must stay importable from there
+    sys.path.insert(0, os.getcwd())
+    names = list(MICRO_BENCHMARKS) + [f"users_{users}" for users in args.users.split(",")]
+    if args.only:
+        names = [name for name in args.only.split(",") if name]
+
+    options = {"repeats": args.repeats, "model_latency": args.model_latency, "timeout": 300}
+    # Rate limits would cap the throughput being measured
+    environment = {"TRY_ON_MODE": "virtual_try_on", "PREVIEW_ENABLED": "true", "RATE_LIMIT_ENABLED": "false"}
+    results = {}
+    print(f"{'benchmark':<14} {'ops/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'peak MB':>9}")
+    with ExitStack() as stack:
+        if any(name.startswith("users_") for name in names):
+            options["media_base"] = stack.enter_context(media_server(args.media_latency))
+        for name in names:
+            kind = name
+            if name.startswith("users_"):
+                kind, options["users"] = "users", int(name[len("users_"):])
+            result = results[name] = run_in_process(kind, options, environment)
+            if "error" in result:
+                print(f"{name:<14} failed: {result['error']}")
+                continue
+            print(f"{name:<14} {result['throughput']:>9.1f} {result['p50_ms']:>9.1f} "
+                  f"{result['p99_ms']:>9.1f} {result['peak_mb']:>9.1f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump({name: result for name, result in results.items() if "error" not in result}, file, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+    failed = [name for name, result in results.items() if "error" in result]
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if not regressions:
+            print(f"No regressions beyond {args.tolerance:.0%} of {args.baseline}")
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Webhook throughput against the number of concurrent conversations.
+
+Run from the repository root:  python -m benchmarks.webhook_load [--media-latency 0.5]
+
+Each conversation is a new user sending a person image and then a garment image. Media is
+served by a local server in its own process that answers after --media-latency seconds, like
+Twilio's media host. The app is driven in-process over ASGI without starting its job workers,
+so this measures the request path alone. With blocking handlers, throughput stops growing once
+every threadpool slot is parked on a download; with async handlers it keeps scaling.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.fakes import media_server
+
+
+async def run_level(client, media_base, concurrency, conversations, run_id):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def conversation(index):
+        user_id = f"whatsapp:+1555{run_id}{concurrency:04d}{index:05d}"
+        async with semaphore:
+            for image_type in ("person", "garment"):
+                form = {
+                    "From": user_id,
+                    "Body": image_type,
+                    "MessageSid": f"SM{user_id}{image_type}",
+                    "NumMedia": "1",
+                    "MediaUrl0": f"{media_base}/media/{user_id}{image_type}"
+                }
+                started = time.perf_counter()
+                response = await client.post("/webhook", data=form)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200 or "error occurred" in response.text:
+                    raise RuntimeError(f"Webhook failed: {response.status_code} {response.text}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*[conversation(index) for index in range(conversations)])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return conversations / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+async def run(levels, rounds, media_base):
+    import httpx
+
+    import app
+
+    transport = httpx.ASGITransport(app=app.app)
+    run_id = int(time.time()) % 1000
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=120) as client:
+        print(f"{'concurrent':>10} {'conv/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+        for concurrency in levels:
+            throughput, p50, p99 = await run_level(
+                client, media_base, concurrency, concurrency * rounds, run_id
+            )
+            print(f"{concurrency:>10} {throughput:>8.1f} {p50 * 1000:>8.1f} {p99 * 1000:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", default="1,10,50,100,200")
+    parser.add_argument("--rounds", type=int, default=2, help="conversations per concurrent slot")
+    parser.add_argument("--media-latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.getcwd())
+    os.chdir(tempfile.mkdtemp(prefix="webhook_load_"))
+    # The per-host cap protects Twilio in production, here it would only measure itself
+    os.environ.setdefault("HTTP_PER_HOST_LIMIT", "1000")
+    os.environ.setdefault("HTTP_MAX_CONNECTIONS", "1000")
+
+    with media_server(args.media_latency) as media_base:
+        levels = [int(level) for level in args.levels.split(",")]
+        asyncio.run(run(levels, args.rounds, media_base))
+
+
+if __name__ == "__main__":
+    main()
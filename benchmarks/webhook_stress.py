@@ -0,0 +1,173 @@
+"""Fire concurrent webhook calls for a single user and check that no state is lost or reused.
+
+Run from the repository root:  python -m benchmarks.webhook_stress [--processes 2] [--concurrency 8]
+
+Every worker process gets its own copy of the app sharing one SQLite database, like uvicorn
+workers would. Each person/garment message is delivered several times with the same MessageSid,
+in a random order, to imitate Twilio retries racing with the original delivery. Media downloads
+are answered locally. Job workers are not started, so every enqueued job stays inspectable.
+Exits non-zero when an invariant is violated.
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+USER_ID = "whatsapp:+15550000001"
+
+
+class LocalMediaClient:
+    """Answers media downloads with a small distinct PNG per URL."""
+
+    def download_to_file_sync(self, media_url, dest_path, auth=None):
+        from PIL import Image
+
+        seed = int(hashlib.sha256(media_url.encode()).hexdigest()[:6], 16)
+        buffer = io.BytesIO()
+        Image.new("RGB", (32, 32), (seed >> 16, (seed >> 8) & 255, seed & 255)).save(buffer, "PNG")
+        content = buffer.getvalue()
+        with open(dest_path, "wb") as file:
+            file.write(content)
+        return len(content), hashlib.sha256(content).hexdigest()
+
+    async def download_to_file(self, media_url, dest_path, auth=None):
+        return self.download_to_file_sync(media_url, dest_path, auth)
+
+
+def messages_for(pairs, duplicates):
+    messages = []
+    for index in range(pairs):
+        for image_type in ("person", "garment"):
+            form = {
+                "From": USER_ID,
+                "Body": image_type,
+                "MessageSid": f"SM{image_type}{index:04d}",
+                "NumMedia": "1",
+                "MediaUrl0": f"https://media.example/{image_type}/{index}"
+            }
+            messages.extend([form] * duplicates)
+    return messages
+
+
+def run_worker(messages, concurrency, results):
+    import httpx
+
+    import image_handler
+    image_handler.get_media_download_client = LocalMediaClient
+
+    import app
+
+    async def post_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=60) as client:
+            async def post(form):
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await client.post("/webhook", data=form)
+                    return form["MessageSid"], response.status_code, response.text, time.perf_counter() - started
+
+            return await asyncio.gather(*[post(form) for form in messages])
+
+    try:
+        results.put(asyncio.run(post_all()))
+    finally:
+        # Uploads are normalized in image worker processes, which would keep this process alive
+        from image_workers import get_image_worker_pool
+        get_image_worker_pool().shutdown()
+
+
+def check_invariants(replies, pairs):
+    problems = []
+    by_sid = {}
+    for message_sid, status_code, text, _ in replies:
+        if status_code != 200:
+            problems.append(f"{message_sid} returned HTTP {status_code}")
+        if "error occurred" in text or "Failed to process" in text:
+            problems.append(f"{message_sid} failed: {text}")
+        by_sid.setdefault(message_sid, set()).add(text)
+    for message_sid, texts in by_sid.items():
+        if len(texts) > 1:
+            problems.append(f"{message_sid} got {len(texts)} different replies to duplicate deliveries")
+
+    metadata = sqlite3.connect(os.path.join("database", "metadata.db"))
+    downloaded = metadata.execute("SELECT COUNT(*) FROM input_images WHERE user_id = ?", (USER_ID,)).fetchone()[0]
+    used = metadata.execute(
+        "SELECT COUNT(*) FROM input_images WHERE user_id = ? AND already_used = 1", (USER_ID,)
+    ).fetchone()[0]
+    if downloaded != 2 * pairs:
+        problems.append(f"{downloaded} input images stored for {2 * pairs} distinct messages")
+
+    jobs = sqlite3.connect(os.path.join("database", "jobs.db"))
+    consumed = []
+    for (payload,) in jobs.execute("SELECT payload FROM jobs WHERE user_id = ?", (USER_ID,)):
+        payload = json.loads(payload)
+        consumed.append(payload["person_image_id"])
+        if "garments" in payload:
+            consumed.extend(garment["garment_image_id"] for garment in payload["garments"])
+        else:
+            consumed.append(payload["garment_image_id"])
+    if len(consumed) != len(set(consumed)):
+        problems.append(f"{len(consumed) - len(set(consumed))} input images were consumed by more than one job")
+    if len(consumed) != used:
+        problems.append(f"{used} images marked used but {len(consumed)} handed to jobs")
+    return problems, downloaded, len(consumed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight per process")
+    parser.add_argument("--pairs", type=int, default=25)
+    parser.add_argument("--duplicates", type=int, default=3)
+    args = parser.parse_args()
+
+    # Workers share state through files, so point every relative directory at a scratch area
+    work_dir = tempfile.mkdtemp(prefix="webhook_stress_")
+    sys.path.insert(0, os.getcwd())
+    os.chdir(work_dir)
+    os.environ["JOB_QUEUE_BACKEND"] = "sqlite"
+
+    messages = messages_for(args.pairs, args.duplicates)
+    random.shuffle(messages)
+    shares = [messages[index::args.processes] for index in range(args.processes)]
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    started = time.perf_counter()
+    processes = [
+        context.Process(target=run_worker, args=(share, args.concurrency, results)) for share in shares
+    ]
+    for process in processes:
+        process.start()
+    replies = []
+    for _ in processes:
+        replies.extend(results.get())
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(reply[3] for reply in replies)
+    problems, downloaded, consumed = check_invariants(replies, args.pairs)
+    print(f"{len(replies)} webhook calls ({args.pairs * 2} distinct messages x{args.duplicates}) "
+          f"from {args.processes} processes x {args.concurrency} in flight in {elapsed:.2f}s")
+    print(f"p50 {latencies[len(latencies) // 2] * 1000:.1f}ms  "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms")
+    print(f"{downloaded} images stored, {consumed} handed to jobs, scratch directory {work_dir}")
+    for problem in problems:
+        print(f"FAIL {problem}")
+    if problems:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+import threading
+import uuid
+
+from constants import DirectoryPath
+from image_pipeline import make_thumbnail, normalize_image
+from image_workers import get_image_worker_pool
+from metadata_store import get_metadata_store
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """Content-addressed, deduplicated storage for input images with refcounted garbage collection."""
+
+    def __init__(self, blob_dir, store):
+        self.blob_dir = blob_dir
+        self.store = store
+        self.incoming_dir = os.path.join(blob_dir, "incoming")
+        os.makedirs(self.incoming_dir, exist_ok=True)
+
+    def blob_path(self, content_hash):
+        # Ingest normalizes every upload to JPEG, blobs stored earlier keep the path recorded for them
+        return os.path.join(self.blob_dir, content_hash[:2], content_hash[2:4], f"{content_hash}.jpeg")
+
+    def thumbnail_path(self, content_hash):
+        return os.path.join(self.blob_dir, content_hash[:2], content_hash[2:4], f"{content_hash}_thumb.jpeg")
+
+    def new_incoming_path(self):
+        """A temporary path on the blob volume, so put() can move it into place with a rename."""
+        return os.path.join(self.incoming_dir, uuid.uuid4().hex)
+
+    def put(self, temp_path, content_hash, thumbnail_temp_path=None, perceptual_hash=None):
+        """Move temp_path into the store (or drop it if the content is already there) and take a reference."""
+        # Referenced before the existence check, so a concurrent garbage collection keeps the file
+        self.store.add_blob_reference(
+            content_hash, self.blob_path(content_hash), os.path.getsize(temp_path), perceptual_hash=perceptual_hash
+        )
+        path = self.store.get_blob(content_hash)["path"]
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        if thumbnail_temp_path:
+            os.replace(thumbnail_temp_path, self.thumbnail_path(content_hash))
+        return path
+
+    def _is_stored(self, content_hash):
+        blob = self.store.get_blob(content_hash)
+        return blob is not None and os.path.exists(blob["path"])
+
+    def _normalized_paths(self, temp_path):
+        return f"{temp_path}.normalized", f"{temp_path}.thumb"
+
+    def _put_normalized(self, temp_path, content_hash, normalized):
+        normalized_path, thumbnail_path = self._normalized_paths(temp_path)
+        logger.log(level=logging.INFO, msg=f"Normalized {normalized['format']} upload {content_hash[:12]} "
+                   f"from {normalized['source_size']} to {normalized['size']}")
+        os.remove(temp_path)
+        return self.put(
+            normalized_path, content_hash, thumbnail_temp_path=thumbnail_path,
+            perceptual_hash=normalized["perceptual_hash"]
+        )
+
+    def _discard(self, temp_path):
+        for path in (temp_path, *self._normalized_paths(temp_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def ingest(self, temp_path, content_hash):
+        """put() a freshly uploaded file, normalizing it in an image worker unless the content is already stored.
+
+        content_hash stays the hash of the bytes as uploaded, so the same upload is only ever normalized once.
+        """
+        if self._is_stored(content_hash):
+            return self.put(temp_path, content_hash)
+        try:
+            normalized = get_image_worker_pool().run(
+                normalize_image, temp_path, *self._normalized_paths(temp_path)
+            )
+            return self._put_normalized(temp_path, content_hash, normalized)
+        finally:
+            self._discard(temp_path)
+
+    async def ingest_async(self, temp_path, content_hash):
+        """ingest() for coroutines, the event loop is free while the image worker and the metadata store run."""
+        if await asyncio.to_thread(self._is_stored, content_hash):
+            return await asyncio.to_thread(self.put, temp_path, content_hash)
+        try:
+            normalized = await get_image_worker_pool().run_async(
+                normalize_image, temp_path, *self._normalized_paths(temp_path)
+            )
+            return await asyncio.to_thread(self._put_normalized, temp_path, content_hash, normalized)
+        finally:
+            self._discard(temp_path)
+
+    def thumbnail(self, content_hash):
+        """Path of the blob's thumbnail, made on the spot for blobs stored before ingest made them."""
+        path = self.thumbnail_path(content_hash)
+        if not os.path.exists(path):
+            blob = self.store.get_blob(content_hash)
+            if blob is None or not os.path.exists(blob["path"]):
+                return None
+            temp_path = f"{self.new_incoming_path()}.thumb"
+            make_thumbnail(blob["path"], temp_path)
+            os.replace(temp_path, path)
+        return path
+
+    def add_reference(self, content_hash):
+        blob = self.store.get_blob(content_hash)
+        self.store.add_blob_reference(content_hash, blob["path"], blob["size"])
+        return blob["path"]
+
+    def release(self, content_hash):
+        if content_hash:
+            self.store.release_blob_reference(content_hash)
+
+    def garbage_collect(self):
+        """Delete blobs nobody references any more, returning the number of bytes freed."""
+        freed = 0
+        for blob in self.store.unreferenced_blobs():
+            # Move the file aside first so a put() racing with us either sees it gone or keeps it
+            doomed_path = f"{blob['path']}.gc"
+            try:
+                os.replace(blob["path"], doomed_path)
+            except FileNotFoundError:
+                doomed_path = None
+            if self.store.delete_blob(blob["content_hash"]):
+                if doomed_path:
+                    os.remove(doomed_path)
+                    freed += blob["size"]
+                # Thumbnails are derived, thumbnail() remakes one if a racing put() lost it here
+                thumbnail_path = self.thumbnail_path(blob["content_hash"])
+                if os.path.exists(thumbnail_path):
+                    os.remove(thumbnail_path)
+            elif doomed_path:
+                os.replace(doomed_path, blob["path"])
+        if freed:
+            logger.log(level=logging.INFO, msg=f"Blob garbage collection freed {freed} bytes")
+        return freed
+
+    def sweep_incoming(self, older_than):
+        """Delete temporary upload files last written before older_than, returning how many."""
+        removed = 0
+        for entry in os.scandir(self.incoming_dir):
+            try:
+                if entry.stat().st_mtime < older_than:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                # Ingested or discarded in the meantime
+                continue
+        return removed
+
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+
+def get_blob_store():
+    """Return the process-wide BlobStore."""
+    global _blob_store
+    if _blob_store is None:
+        with _blob_store_lock:
+            if _blob_store is None:
+                _blob_store = BlobStore(DirectoryPath.BLOB_DIR.value, get_metadata_store())
+    return _blob_store
@@ -1,10 +1,229 @@
+import glob
+import logging
 import os
 import json
+import threading
+import time
 
-from constants import DirectoryPath
+from constants import ChatHistorySettings, DirectoryPath
+from user_locks import get_user_locks
 
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".jsonl"
+
+
+class ChatHistoryLog:
+    """Append-only, line-delimited chat history split into size-bounded segments per user."""
+
+    def __init__(self, history_dir, max_segment_bytes=ChatHistorySettings.MAX_SEGMENT_BYTES.value,
+                 max_segments=ChatHistorySettings.MAX_SEGMENTS.value,
+                 retain_entries=ChatHistorySettings.RETAIN_ENTRIES.value,
+                 fsync_every=ChatHistorySettings.FSYNC_EVERY.value,
+                 fsync_interval=ChatHistorySettings.FSYNC_INTERVAL_SECONDS.value):
+        self.history_dir = history_dir
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segments = max_segments
+        self.retain_entries = retain_entries
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._dirty_segments = set()
+        self._pending_appends = 0
+        self._last_fsync = time.monotonic()
+        self._fsync_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._flusher = None
+        os.makedirs(history_dir, exist_ok=True)
+
+    def _user_lock(self, user_id):
+        # Held across worker processes too, rotation and compaction rename and delete segments
+        return get_user_locks("chat_history").lock(user_id)
+
+    def _user_dir(self, user_id):
+        return os.path.join(self.history_dir, user_id)
+
+    def _segment_path(self, user_id, segment_index):
+        return os.path.join(self._user_dir(user_id), f"{segment_index:08d}{SEGMENT_SUFFIX}")
+
+    def _segment_indexes(self, user_id):
+        """Return the user's segment indexes, oldest first."""
+        paths = glob.glob(os.path.join(glob.escape(self._user_dir(user_id)), f"*{SEGMENT_SUFFIX}"))
+        return sorted(int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)]) for path in paths)
+
+    def _latest_segment_index(self, user_id):
+        # Listed on every call so rotations made by other worker processes are picked up
+        indexes = self._segment_indexes(user_id)
+        return indexes[-1] if indexes else 0
+
+    def append(self, user_id, entry):
+        """Append one entry with a single O_APPEND write."""
+        line = (json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._user_lock(user_id):
+            os.makedirs(self._user_dir(user_id), exist_ok=True)
+            segment_index = self._latest_segment_index(user_id)
+            path = self._segment_path(user_id, segment_index)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                size = os.fstat(fd).st_size
+                if size and size + len(line) > self.max_segment_bytes:
+                    os.close(fd)
+                    fd = None
+                    segment_index = self._rotate(user_id, segment_index)
+                    path = self._segment_path(user_id, segment_index)
+                    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                os.write(fd, line)
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        self._schedule_fsync(path)
+
+    def _rotate(self, user_id, segment_index):
+        """Start a new segment, compacting older ones when there are too many."""
+        if len(self._segment_indexes(user_id)) >= self.max_segments:
+            self._compact_locked(user_id)
+        return self._latest_segment_index(user_id) + 1
+
+    def _schedule_fsync(self, path):
+        with self._fsync_lock:
+            self._dirty_segments.add(path)
+            self._pending_appends += 1
+            due = (self._pending_appends >= self.fsync_every
+                   or time.monotonic() - self._last_fsync >= self.fsync_interval)
+        if due:
+            # Fsync runs on a background thread, an append never waits for the disk
+            self._ensure_flusher()
+            self._flush_requested.set()
+
+    def _ensure_flusher(self):
+        with self._fsync_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="chat-history-fsync", daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_requested.wait()
+            self._flush_requested.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.log(level=logging.ERROR, msg=f"Could not fsync the chat history. Error: [{e}]")
+
+    def flush(self):
+        """Fsync every segment written since the last flush."""
+        with self._fsync_lock:
+            dirty_segments = self._dirty_segments
+            self._dirty_segments = set()
+            self._pending_appends = 0
+            self._last_fsync = time.monotonic()
+        for path in dirty_segments:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                # Removed by compaction, its entries were fsynced there
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def tail(self, user_id, n):
+        """Return the last n entries, oldest first, reading segments backwards."""
+        if n <= 0:
+            return []
+        lines = []
+        for segment_index in reversed(self._segment_indexes(user_id)):
+            lines.extend(self._read_lines_backwards(self._segment_path(user_id, segment_index), n - len(lines)))
+            if len(lines) >= n:
+                break
+        entries = []
+        for line in reversed(lines):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A torn write from a crashed process, skip it
+                continue
+        return entries
+
+    @staticmethod
+    def _read_lines_backwards(path, limit, block_size=8192):
+        """Return up to limit complete lines from the end of path, newest first."""
+        lines = []
+        try:
+            with open(path, "rb") as file:
+                position = file.seek(0, os.SEEK_END)
+                remainder = b""
+                while position > 0 and len(lines) < limit:
+                    read_size = min(block_size, position)
+                    position -= read_size
+                    file.seek(position)
+                    chunk = file.read(read_size) + remainder
+                    parts = chunk.split(b"\n")
+                    # The first part may be the tail of a line that starts in an earlier block
+                    remainder = parts.pop(0)
+                    for part in reversed(parts):
+                        if part:
+                            lines.append(part)
+                if position == 0 and remainder and len(lines) < limit:
+                    lines.append(remainder)
+        except FileNotFoundError:
+            return []
+        return lines[:limit]
+
+    def compact(self, user_id):
+        with self._user_lock(user_id):
+            return self._compact_locked(user_id)
+
+    def _compact_locked(self, user_id):
+        """Rewrite the newest retain_entries entries into one segment and drop the rest."""
+        indexes = self._segment_indexes(user_id)
+        if not indexes:
+            return 0
+        entries = self.tail(user_id, self.retain_entries)
+        compacted_index = indexes[-1] + 1
+        compacted_path = self._segment_path(user_id, compacted_index)
+        temp_path = f"{compacted_path}.tmp"
+        with open(temp_path, "wb") as file:
+            for entry in entries:
+                file.write((json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8"))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, compacted_path)
+        for segment_index in indexes:
+            os.remove(self._segment_path(user_id, segment_index))
+        logger.log(level=logging.INFO, msg=f"Compacted chat history for user {user_id} "
+                   f"into {len(entries)} entries")
+        return compacted_index
+
+    def migrate_json_history(self):
+        """Convert legacy {user_id}.json history files, renaming each to *.migrated."""
+        migrated = 0
+        for path in glob.glob(os.path.join(self.history_dir, "*.json")):
+            user_id = os.path.basename(path)[:-len(".json")]
+            with open(path, "r") as file:
+                entries = json.load(file)
+            for entry in entries:
+                self.append(user_id, entry)
+            os.rename(path, f"{path}.migrated")
+            migrated += len(entries)
+        self.flush()
+        return migrated
+
+
+_chat_history_log = None
+_chat_history_log_lock = threading.Lock()
+
+
+def get_chat_history_log():
+    """Return the process-wide ChatHistoryLog."""
+    global _chat_history_log
+    if _chat_history_log is None:
+        with _chat_history_log_lock:
+            if _chat_history_log is None:
+                _chat_history_log = ChatHistoryLog(DirectoryPath.CHAT_HISTORY_DIR.value)
+    return _chat_history_log
 
-os.makedirs(DirectoryPath.CHAT_HISTORY_DIR.value, exist_ok=True)
 
 class ChatHistoryManager:
     def __init__(self):
@@ -12,17 +231,15 @@ class ChatHistoryManager:
 
     @staticmethod
     def update_chat_history(user_id, entry):
-        """Add an entry to the user's chat history JSON."""
-        history_file = os.path.join(DirectoryPath.CHAT_HISTORY_DIR.value, f"{user_id}.json")
-
-        if os.path.exists(history_file):
-            with open(history_file, "r") as file:
-                history = json.load(file)
-        else:
-            history = []
+        """Add an entry to the user's chat history."""
+        get_chat_history_log().append(user_id, entry)
 
-        history.append(entry)
-        with open(history_file, "w") as file:
-            json.dump(history, file, indent=4)
+    @staticmethod
+    def get_recent_history(user_id, n=20):
+        """Return the user's last n chat entries, oldest first."""
+        return get_chat_history_log().tail(user_id, n)
 
 
+if __name__ == "__main__":
+    # One-shot conversion of the legacy JSON chat history files
+    print(get_chat_history_log().migrate_json_history())
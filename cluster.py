@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+import re
+import threading
+
+from constants import ClusterSettings
+from telemetry import span
+from utils import MyCustomError
+
+# Set on forwarded requests, the receiving node answers them itself instead of forwarding again
+FORWARDED_HEADER = "X-Tryon-Forwarded-By"
+NODE_ID_PATTERN = re.compile(r"^[A-Za-z0-9]+$")
+
+
+def parse_nodes(spec):
+    """Parse "name=url,name=url" into {name: url}."""
+    nodes = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        node_id, separator, url = item.partition("=")
+        node_id = node_id.strip()
+        if not separator or not NODE_ID_PATTERN.match(node_id):
+            raise MyCustomError(f"Cluster nodes are given as name=http://host:port with an alphanumeric name, "
+                                f"got [{item}]")
+        nodes[node_id] = url.strip().rstrip("/")
+    return nodes
+
+
+class Cluster:
+    """The nodes of a scaled-out deployment, and which of them each user and output image lives on.
+
+    A node keeps the whole conversation of the users it owns, in stores its worker processes share.
+    Users are spread over the nodes by rendezvous hashing, so adding or removing a node only moves
+    the users of that node. Requests that reach another node are forwarded to the owner.
+    The garment catalog is shared instead: each catalog write is applied on every node.
+    """
+
+    def __init__(self, node_id, nodes, forward_timeout=ClusterSettings.FORWARD_TIMEOUT_SECONDS.value):
+        if len(nodes) > 1 and node_id not in nodes:
+            raise MyCustomError(f"NODE_ID [{node_id}] is not one of the cluster nodes {sorted(nodes)}")
+        self.node_id = node_id
+        self.nodes = nodes
+        self.forward_timeout = forward_timeout
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return len(self.nodes) > 1
+
+    def home_node(self, user_id):
+        """The node that keeps user_id's images, jobs and replies."""
+        if not self.enabled:
+            return self.node_id
+        return max(self.nodes, key=lambda node_id: hashlib.sha1(f"{node_id}:{user_id}".encode()).digest())
+
+    def other_nodes(self):
+        return [node_id for node_id in self.nodes if node_id != self.node_id] if self.enabled else []
+
+    def is_local(self, node_id):
+        return not self.enabled or node_id not in self.nodes or node_id == self.node_id
+
+    def output_suffix(self):
+        """Appended to new output names, so whichever node gets the request can tell where one lives."""
+        return f"-{self.node_id}" if self.enabled else ""
+
+    @staticmethod
+    def output_node(image_name):
+        """The node an output was written on, None for names without one."""
+        stem = image_name.rsplit(".", 1)[0]
+        _, separator, node_id = stem.rpartition("-")
+        return node_id if separator else None
+
+    def _http_client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    # Imported on the first forward, a single node never needs it
+                    import httpx
+
+                    self._client = httpx.AsyncClient(timeout=self.forward_timeout, follow_redirects=False)
+        return self._client
+
+    async def forward(self, node_id, method, path, headers=None, content=None, data=None, files=None):
+        """Send a request on to another node, returning its httpx response."""
+        headers = dict(headers or {})
+        headers[FORWARDED_HEADER] = self.node_id
+        with span("forward"):
+            return await self._http_client().request(
+                method, f"{self.nodes[node_id]}{path}", headers=headers, content=content, data=data, files=files
+            )
+
+    async def broadcast(self, method, path, headers=None, data=None, files=None):
+        """Send a request to every other node, returning the ids of those that failed or refused it."""
+        node_ids = self.other_nodes()
+        replies = await asyncio.gather(
+            *[self.forward(node_id, method, path, headers, data=data, files=files) for node_id in node_ids],
+            return_exceptions=True
+        )
+        return [
+            node_id for node_id, reply in zip(node_ids, replies)
+            if isinstance(reply, Exception) or reply.status_code >= 400
+        ]
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+_cluster = None
+_cluster_lock = threading.Lock()
+
+
+def get_cluster():
+    """Return the process-wide Cluster."""
+    global _cluster
+    if _cluster is None:
+        with _cluster_lock:
+            if _cluster is None:
+                _cluster = Cluster(ClusterSettings.NODE_ID.value, parse_nodes(ClusterSettings.NODES.value))
+    return _cluster
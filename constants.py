@@ -1,9 +1,12 @@
+import os
+
 from enum import Enum
 
 
 class TokensAndURLs(Enum):
     HUGGING_FACE_API_URL = "https://api-inference.huggingface.co/models/Kwai-Kolors/Kolors-Virtual-Try-On"
     MODEL_NAME = "AhmedAlmaghz/Kolors-Virtual-Try-On"
+    IDM_VTON_MODEL_NAME = "Nymbo/Virtual-Try-On"
     BASE_URL = "https://fc3e-2401-4900-1c0e-1d9d-b9ce-4a6c-ec16-58e2.ngrok-free.app"
 
 class DirectoryPath(Enum):
@@ -12,4 +15,203 @@ class DirectoryPath(Enum):
     OUTPUT_DIR = "./output_images"
     OUTPUT_METADATA_DIR = "./output_metadata"
     CHAT_HISTORY_DIR = "./chat_history"
+    DATABASE_DIR = "./database"
+    RESULT_CACHE_DIR = "./result_cache"
+    BLOB_DIR = "./blob_store"
+
+class ServerSettings(Enum):
+    HOST = os.getenv("HOST", "0.0.0.0")
+    PORT = int(os.getenv("PORT", "8000"))
+    # Web worker processes on this node, they share every store through SQLite and lock files
+    WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+
+class ClusterSettings(Enum):
+    # This node's name, and every node as name=URL the nodes reach each other on, comma separated.
+    # With more than one node each user belongs to one of them and the others forward to it.
+    # Catalog writes are copied to every node listed, a node added later starts with an empty catalog.
+    NODE_ID = os.getenv("NODE_ID", "")
+    NODES = os.getenv("CLUSTER_NODES", "")
+    FORWARD_TIMEOUT_SECONDS = float(os.getenv("CLUSTER_FORWARD_TIMEOUT_SECONDS", "30"))
+
+class JobQueueSettings(Enum):
+    # "memory" keeps jobs in-process, "sqlite" persists them in DATABASE_FILE and shares them between workers
+    BACKEND = os.getenv("JOB_QUEUE_BACKEND", "sqlite" if ServerSettings.WORKERS.value > 1 else "memory")
+    DATABASE_FILE = os.path.join(DirectoryPath.DATABASE_DIR.value, "jobs.db")
+    WORKER_COUNT = int(os.getenv("JOB_QUEUE_WORKERS", "4"))
+    # "merge" for the side-by-side preview, "virtual_try_on" for the model path
+    TRY_ON_MODE = os.getenv("TRY_ON_MODE", "merge")
+
+class MetadataStoreSettings(Enum):
+    DATABASE_FILE = os.path.join(DirectoryPath.DATABASE_DIR.value, "metadata.db")
+
+class ChatHistorySettings(Enum):
+    MAX_SEGMENT_BYTES = 256 * 1024
+    # Compaction runs once a user has more than MAX_SEGMENTS segments
+    MAX_SEGMENTS = 8
+    RETAIN_ENTRIES = 2000
+    FSYNC_EVERY = 32
+    FSYNC_INTERVAL_SECONDS = 1.0
+
+class HttpClientSettings(Enum):
+    MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "64"))
+    MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "32"))
+    # Every Twilio media URL is on one host, so this bounds concurrent uploads being received
+    PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", "16"))
+    # WhatsApp caps image media at 16MB
+    MAX_MEDIA_BYTES = 16 * 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+    MAX_ATTEMPTS = 3
+    BACKOFF_BASE_SECONDS = 0.5
+    BACKOFF_MAX_SECONDS = 8.0
+    TIMEOUT_SECONDS = 30.0
+
+class GradioPoolSettings(Enum):
+    # Clients created per backend at startup, the pool grows lazily up to MAX_CONCURRENCY
+    WARM_CLIENTS = int(os.getenv("GRADIO_WARM_CLIENTS", "1"))
+    MAX_CONCURRENCY = int(os.getenv("GRADIO_MAX_CONCURRENCY", "4"))
+    CHECKOUT_TIMEOUT_SECONDS = 120.0
+    HEALTH_CHECK_INTERVAL_SECONDS = 60.0
+
+class TryOnRouterSettings(Enum):
+    # Rolling window of calls used for the p50/p95 latency and error rate of a backend
+    WINDOW_SIZE = 50
+    FAILURE_THRESHOLD = 3
+    CIRCUIT_RESET_SECONDS = 60.0
+    # Hedge deadline before a backend has enough samples for a p95
+    DEFAULT_HEDGE_DELAY_SECONDS = 30.0
+    MIN_HEDGE_DELAY_SECONDS = 5.0
+    # Longest a try-on waits across all of its backend calls, hedges and failovers included
+    TOTAL_DEADLINE_SECONDS = float(os.getenv("TRY_ON_DEADLINE_SECONDS", "180"))
+
+class ResultCacheSettings(Enum):
+    MAX_DISK_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+    HOT_MAX_ENTRIES = 64
+    HOT_MAX_ITEM_BYTES = 512 * 1024
+
+class NearDuplicateSettings(Enum):
+    # A photo sent again after WhatsApp recompressed it reuses the results of the first one. Photos match
+    # when their HASH_SIZE x HASH_SIZE difference hashes differ in at most MAX_DISTANCE bits.
+    ENABLED = os.getenv("NEAR_DUPLICATE_ENABLED", "true").lower() == "true"
+    HASH_SIZE = 16
+    MAX_DISTANCE = int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", "16"))
+    # How long a user's photos can be matched after they were first sent
+    RETENTION_SECONDS = int(os.getenv("NEAR_DUPLICATE_RETENTION_SECONDS", str(30 * 24 * 60 * 60)))
+
+class StorageSettings(Enum):
+    # "local" keeps outputs on this disk only, "s3" also uploads them to S3_BUCKET
+    OUTPUT_BACKEND = os.getenv("OUTPUT_STORAGE_BACKEND", "local")
+    S3_BUCKET = os.getenv("OUTPUT_S3_BUCKET", "")
+    S3_PREFIX = os.getenv("OUTPUT_S3_PREFIX", "outputs/")
+    # For MinIO or another S3-compatible stand-in, unset for AWS
+    S3_ENDPOINT_URL = os.getenv("OUTPUT_S3_ENDPOINT_URL") or None
+    S3_URL_EXPIRY_SECONDS = int(os.getenv("OUTPUT_S3_URL_EXPIRY_SECONDS", "3600"))
+    # With the s3 backend, local copies older than this are dropped and served from S3
+    LOCAL_HOT_SECONDS = int(os.getenv("OUTPUT_LOCAL_HOT_SECONDS", str(24 * 60 * 60)))
+    OUTPUT_TTL_SECONDS = int(os.getenv("OUTPUT_TTL_SECONDS", str(30 * 24 * 60 * 60)))
+    OUTPUT_MAX_BYTES = int(os.getenv("OUTPUT_MAX_BYTES", str(10 * 1024 * 1024 * 1024)))
+    OUTPUT_USER_MAX_BYTES = int(os.getenv("OUTPUT_USER_MAX_BYTES", str(200 * 1024 * 1024)))
+    # Outputs never committed (the job failed half way) are removed after this
+    PENDING_OUTPUT_SECONDS = 6 * 60 * 60
+    # Files left in the blob store's incoming folder by a crashed or cancelled upload are removed after this
+    INCOMING_TTL_SECONDS = 6 * 60 * 60
+    UNUSED_INPUT_TTL_SECONDS = int(os.getenv("UNUSED_INPUT_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+    SWEEP_INTERVAL_SECONDS = float(os.getenv("STORAGE_SWEEP_INTERVAL_SECONDS", "3600"))
+    # Rows handled per query, a sweep loops until nothing is left
+    SWEEP_BATCH_SIZE = 500
+
+class ImageServingSettings(Enum):
+    # Output names are never reused, so clients may cache them forever
+    CACHE_CONTROL = "public, max-age=31536000, immutable"
+    ETAG_CACHE_ENTRIES = 4096
+    THUMBNAIL_MAX_BYTES = 64 * 1024
+    THUMBNAIL_CACHE_ENTRIES = 256
+
+class MergeSettings(Enum):
+    # Each input is letterboxed into a PANEL_WIDTH x PANEL_HEIGHT cell of the output
+    PANEL_WIDTH = int(os.getenv("MERGE_PANEL_WIDTH", "768"))
+    PANEL_HEIGHT = int(os.getenv("MERGE_PANEL_HEIGHT", "1024"))
+    JPEG_QUALITY = int(os.getenv("MERGE_JPEG_QUALITY", "85"))
+    PROGRESSIVE_JPEG = os.getenv("MERGE_PROGRESSIVE_JPEG", "true").lower() == "true"
+    BACKGROUND_COLOR = (255, 255, 255)
+
+class PreviewSettings(Enum):
+    # With the model path, a small side-by-side merge is sent first while the model runs
+    ENABLED = os.getenv("PREVIEW_ENABLED", "true").lower() == "true"
+    PANEL_WIDTH = int(os.getenv("PREVIEW_PANEL_WIDTH", "384"))
+    PANEL_HEIGHT = int(os.getenv("PREVIEW_PANEL_HEIGHT", "512"))
+    JPEG_QUALITY = int(os.getenv("PREVIEW_JPEG_QUALITY", "75"))
+
+class SpeculativeSettings(Enum):
+    # The work on an input that does not depend on what it is paired with starts as soon as it is stored:
+    # its letterboxed merge cells, and in the model mode an upload to the fastest backend
+    ENABLED = os.getenv("SPECULATIVE_ENABLED", "true").lower() == "true"
+    CELL_DIR = os.path.join(DirectoryPath.BLOB_DIR.value, "speculative")
+    WORKERS = int(os.getenv("SPECULATIVE_WORKERS", "2"))
+    MAX_PENDING = 64
+    # Work still queued this long after the upload is dropped, the try-on has most likely started without it
+    MAX_DELAY_SECONDS = 30.0
+    # A job waits this long for work already running on its inputs instead of doing it again
+    SETTLE_TIMEOUT_SECONDS = 5.0
+    # Cells and uploads are removed TTL_SECONDS after they were made, whether or not a try-on used them
+    TTL_SECONDS = int(os.getenv("SPECULATIVE_TTL_SECONDS", "900"))
+    CLEANUP_INTERVAL_SECONDS = 60.0
+
+class IngestSettings(Enum):
+    # Uploads are stored no larger than the backends use them, 768x1024 for the try-on models
+    MAX_WIDTH = int(os.getenv("INGEST_MAX_WIDTH", "768"))
+    MAX_HEIGHT = int(os.getenv("INGEST_MAX_HEIGHT", "1024"))
+    JPEG_QUALITY = int(os.getenv("INGEST_JPEG_QUALITY", "90"))
+    THUMBNAIL_WIDTH = 192
+    THUMBNAIL_HEIGHT = 256
+    # Formats Pillow reports for uploads we accept, HEIF needs the optional pillow-heif plugin
+    FORMATS = ("JPEG", "MPO", "PNG", "WEBP", "GIF", "BMP", "TIFF", "HEIF")
+
+class BatchSettings(Enum):
+    # A WhatsApp message carries at most 10 media, the contact sheet plus one image per garment
+    MAX_GARMENTS = int(os.getenv("BATCH_MAX_GARMENTS", "6"))
+    MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "4"))
+    CONTACT_SHEET_COLUMNS = 3
+    CONTACT_SHEET_CELL_WIDTH = 512
+    CONTACT_SHEET_CELL_HEIGHT = 384
+
+class ConcurrencySettings(Enum):
+    LOCK_DIR = os.path.join(DirectoryPath.DATABASE_DIR.value, "locks")
+    # Twilio retries a webhook for a few hours at most
+    MESSAGE_RETENTION_SECONDS = 24 * 60 * 60
+
+class SessionSettings(Enum):
+    CACHE_ENTRIES = int(os.getenv("SESSION_CACHE_ENTRIES", "10000"))
+    # Change counters shared by every worker process through a memory-mapped file
+    VERSION_FILE = os.path.join(ConcurrencySettings.LOCK_DIR.value, "session_versions")
+    VERSION_SLOTS = 1 << 16
+
+class RateLimitSettings(Enum):
+    # Token buckets live in their own SQLite file, shared by every worker process
+    DATABASE_FILE = os.path.join(DirectoryPath.DATABASE_DIR.value, "rate_limits.db")
+    ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+    USER_MESSAGES_PER_MINUTE = float(os.getenv("RATE_LIMIT_USER_MESSAGES_PER_MINUTE", "20"))
+    USER_MESSAGE_BURST = float(os.getenv("RATE_LIMIT_USER_MESSAGE_BURST", "10"))
+    USER_TRY_ONS_PER_MINUTE = float(os.getenv("RATE_LIMIT_USER_TRY_ONS_PER_MINUTE", "4"))
+    USER_TRY_ON_BURST = float(os.getenv("RATE_LIMIT_USER_TRY_ON_BURST", "3"))
+    # Jobs started per minute by all workers together, protects the model backends
+    GLOBAL_TRY_ONS_PER_MINUTE = float(os.getenv("RATE_LIMIT_GLOBAL_TRY_ONS_PER_MINUTE", "120"))
+    GLOBAL_TRY_ON_BURST = float(os.getenv("RATE_LIMIT_GLOBAL_TRY_ON_BURST", "20"))
+    # Beyond either of these a try-on is queued with a "busy" reply, beyond the MAX_ ones it is turned away
+    BUSY_QUEUE_DEPTH = int(os.getenv("ADMISSION_BUSY_QUEUE_DEPTH", "8"))
+    BUSY_WAIT_SECONDS = float(os.getenv("ADMISSION_BUSY_WAIT_SECONDS", "30"))
+    MAX_QUEUE_DEPTH = int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", "200"))
+    MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "600"))
+    # Buckets untouched this long are full again and can be dropped
+    IDLE_BUCKET_SECONDS = 60 * 60
+
+class ImageWorkerSettings(Enum):
+    # Processes for CPU-bound Pillow work in each web worker, 0 runs it in the calling thread
+    MAX_WORKERS = int(os.getenv("IMAGE_WORKERS", str(max(1, (os.cpu_count() or 1) // ServerSettings.WORKERS.value))))
+    # Tasks accepted beyond the busy workers, more wait SUBMIT_TIMEOUT_SECONDS and are then rejected
+    MAX_QUEUED = int(os.getenv("IMAGE_WORKERS_MAX_QUEUED", "16"))
+    SUBMIT_TIMEOUT_SECONDS = 30.0
 
+class TelemetrySettings(Enum):
+    ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    # Spans slower than this are logged with their trace id
+    SLOW_SPAN_SECONDS = float(os.getenv("SLOW_SPAN_SECONDS", "10"))
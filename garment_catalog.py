@@ -0,0 +1,153 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import uuid
+
+from urllib.parse import urlsplit
+
+from blob_store import get_blob_store
+from http_client import get_media_download_client
+from metadata_store import get_metadata_store
+from near_duplicates import get_near_duplicate_index
+from session_state import READY, get_session_store
+from speculative import get_speculative_preprocessor
+from utils import MyCustomError
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Catalog ids look like "g1a2b3c4d" so they can be typed into a WhatsApp message
+GARMENT_ID_PATTERN = re.compile(r"\b(g[0-9a-f]{8})\b")
+
+
+class CatalogIngestError(MyCustomError):
+    pass
+
+
+def catalog_ingest_hosts():
+    """Hosts garments may be fetched from by URL, none unless CATALOG_INGEST_HOSTS lists them."""
+    # Read on use, the .env file is loaded by the app's startup hook
+    return {host.strip().lower() for host in os.getenv("CATALOG_INGEST_HOSTS", "").split(",") if host.strip()}
+
+
+def check_ingest_url(media_url):
+    """Refuse URLs the server should not fetch on a caller's behalf, anything but https on a listed host."""
+    parts = urlsplit(media_url)
+    if parts.scheme != "https" or not parts.hostname:
+        raise CatalogIngestError(f"Garments are fetched over https only, got [{media_url}]")
+    if parts.hostname.lower() not in catalog_ingest_hosts():
+        raise CatalogIngestError(f"Host [{parts.hostname}] is not in CATALOG_INGEST_HOSTS")
+
+
+class GarmentCatalog:
+    """Pre-ingested garments that users can pick by ID instead of uploading a photo."""
+
+    def __init__(self, store, blob_store):
+        self.store = store
+        self.blob_store = blob_store
+
+    @staticmethod
+    def new_garment_id():
+        return f"g{uuid.uuid4().hex[:8]}"
+
+    def _add_from_incoming(self, name, temp_path, content_hash, garment_id=None):
+        self.blob_store.ingest(temp_path, content_hash)
+        garment = self.store.add_garment(garment_id or self.new_garment_id(), name, content_hash)
+        # A blob stored before perceptual hashing is hashed here, the webhook only reads stored hashes
+        get_near_duplicate_index().backfill_catalog()
+        logger.log(level=logging.INFO, msg=f"Added garment {garment['garment_id']} ({name}) to the catalog")
+        return garment
+
+    def ingest_from_url(self, name, media_url, auth=None, garment_id=None):
+        """Add the garment at media_url, under garment_id when another node already picked one."""
+        existing = self._replicated(garment_id)
+        if existing is not None:
+            return existing
+        check_ingest_url(media_url)
+        temp_path = self.blob_store.new_incoming_path()
+        # A redirect could lead anywhere, the listed host has to serve the image itself
+        _, content_hash = get_media_download_client().download_to_file_sync(
+            media_url, temp_path, auth=auth, follow_redirects=False
+        )
+        return self._add_from_incoming(name, temp_path, content_hash, garment_id)
+
+    def ingest_from_file(self, name, file_obj, garment_id=None):
+        existing = self._replicated(garment_id)
+        if existing is not None:
+            return existing
+        temp_path = self.blob_store.new_incoming_path()
+        digest = hashlib.sha256()
+        with open(temp_path, "wb") as temp_file:
+            for chunk in iter(lambda: file_obj.read(64 * 1024), b""):
+                digest.update(chunk)
+                temp_file.write(chunk)
+        return self._add_from_incoming(name, temp_path, digest.hexdigest(), garment_id)
+
+    def _replicated(self, garment_id):
+        """The garment a replicated write already added, so a retried one is a no-op."""
+        if garment_id is None:
+            return None
+        if not GARMENT_ID_PATTERN.fullmatch(garment_id):
+            raise CatalogIngestError(f"[{garment_id}] is not a garment id")
+        return self.store.get_garment(garment_id)
+
+    def get_garment(self, garment_id):
+        return self.store.get_garment(garment_id)
+
+    def thumbnail_path(self, garment_id):
+        garment = self.store.get_garment(garment_id)
+        return self.blob_store.thumbnail(garment["content_hash"]) if garment else None
+
+    def list_garments(self):
+        return self.store.list_garments()
+
+    def delete_garment(self, garment_id):
+        garment = self.store.get_garment(garment_id)
+        if garment is None:
+            raise MyCustomError(f"Garment {garment_id} is not in the catalog")
+        self.store.delete_garment(garment_id)
+        self.blob_store.release(garment["content_hash"])
+        self.blob_store.garbage_collect()
+
+    def find_garment_id(self, message_body):
+        """Return the catalog id mentioned in a message, if it exists."""
+        garment_ids = self.find_garment_ids(message_body)
+        return garment_ids[0] if garment_ids else None
+
+    def find_garment_ids(self, message_body):
+        """Return every catalog id mentioned in a message that exists, in order and without repeats."""
+        garment_ids = []
+        for garment_id in GARMENT_ID_PATTERN.findall(message_body):
+            if garment_id not in garment_ids and self.store.get_garment(garment_id):
+                garment_ids.append(garment_id)
+        return garment_ids
+
+    def select_for_user(self, user_id, garment_id):
+        """Queue a catalog garment as the user's next unused garment image."""
+        garment = self.store.get_garment(garment_id)
+        if garment is None:
+            raise MyCustomError(f"Garment {garment_id} is not in the catalog")
+        path = self.blob_store.add_reference(garment["content_hash"])
+        self.store.add_input_image(
+            user_id, f"catalog:{garment_id}", path, "garment", content_hash=garment["content_hash"]
+        )
+        sessions = get_session_store()
+        sessions.record(user_id, {"garment": 1})
+        get_speculative_preprocessor().schedule(path, pair_ready=sessions.get(user_id).state == READY)
+        return path
+
+
+_garment_catalog = None
+_garment_catalog_lock = threading.Lock()
+
+
+def get_garment_catalog():
+    """Return the process-wide GarmentCatalog."""
+    global _garment_catalog
+    if _garment_catalog is None:
+        with _garment_catalog_lock:
+            if _garment_catalog is None:
+                _garment_catalog = GarmentCatalog(get_metadata_store(), get_blob_store())
+    return _garment_catalog
@@ -0,0 +1,254 @@
+import logging
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+from constants import GradioPoolSettings, TokensAndURLs
+from utils import MyCustomError
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+KOLORS_BACKEND = "kolors"
+IDM_VTON_BACKEND = "idm_vton"
+
+
+class PoolTimeoutError(MyCustomError):
+    pass
+
+
+def create_gradio_client(src):
+    # Imported lazily so the merge-only deployment does not pay for gradio_client
+    from gradio_client import Client
+
+    return Client(src, hf_token=os.getenv("HF_API_TOKEN"))
+
+
+def check_gradio_client(client):
+    """Raise if the Space behind the client stopped answering."""
+    import httpx
+
+    response = httpx.get(f"{client.src.rstrip('/')}/config", headers=client.headers, timeout=10)
+    response.raise_for_status()
+
+
+def upload_gradio_file(client, media_path):
+    """Post a file to the Space's upload endpoint, returning a URL predict() passes on instead of uploading it again."""
+    import httpx
+
+    with open(media_path, "rb") as file:
+        response = httpx.post(
+            client.upload_url, headers=client.headers, cookies=client.cookies,
+            files=[("files", (os.path.basename(media_path), file))], timeout=60
+        )
+    response.raise_for_status()
+    return f"{client.src_prefixed}file={response.json()[0]}"
+
+
+class GradioClientPool:
+    """Pre-warmed gradio clients for one backend with a concurrency cap."""
+
+    def __init__(self, name, src, max_concurrency=GradioPoolSettings.MAX_CONCURRENCY.value,
+                 warm_clients=GradioPoolSettings.WARM_CLIENTS.value,
+                 checkout_timeout=GradioPoolSettings.CHECKOUT_TIMEOUT_SECONDS.value,
+                 client_factory=create_gradio_client, health_check=check_gradio_client):
+        self.name = name
+        self.src = src
+        self.max_concurrency = max_concurrency
+        self.warm_clients = min(warm_clients, max_concurrency)
+        self.checkout_timeout = checkout_timeout
+        self.client_factory = client_factory
+        self.health_check = health_check
+        self._idle = deque()
+        self._created = 0
+        self._in_use = 0
+        self._condition = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "checkout_timeouts": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "connects": 0,
+            "connect_failures": 0,
+            "discarded": 0
+        }
+
+    def _connect(self):
+        try:
+            client = self.client_factory(self.src)
+        except Exception as e:
+            with self._condition:
+                self._created -= 1
+                self._stats["connect_failures"] += 1
+                self._condition.notify()
+            logger.log(level=logging.ERROR, msg=f"Could not connect to gradio backend {self.name}. Error: [{e}]")
+            raise e
+        with self._condition:
+            self._stats["connects"] += 1
+        return client
+
+    def warm(self):
+        """Create clients until warm_clients are idle, logging failures instead of raising."""
+        while True:
+            with self._condition:
+                if self._created >= self.warm_clients:
+                    return
+                self._created += 1
+            try:
+                client = self._connect()
+            except Exception:
+                return
+            with self._condition:
+                self._idle.append(client)
+                self._condition.notify()
+
+    def _acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if self._idle:
+                    self._in_use += 1
+                    return self._idle.popleft()
+                if self._created < self.max_concurrency:
+                    # Reserve a slot and connect outside the lock
+                    self._created += 1
+                    self._in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["checkout_timeouts"] += 1
+                    raise PoolTimeoutError(f"No {self.name} client became free within {timeout}s")
+                self._condition.wait(remaining)
+        try:
+            return self._connect()
+        except Exception:
+            with self._condition:
+                self._in_use -= 1
+            raise
+
+    def _release(self, client, discard):
+        with self._condition:
+            self._in_use -= 1
+            if discard:
+                # Dropped clients are recreated lazily on the next checkout
+                self._created -= 1
+                self._stats["discarded"] += 1
+            else:
+                self._idle.append(client)
+            self._condition.notify()
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        """Borrow a client, discarding it if the caller's call fails."""
+        started = time.monotonic()
+        client = self._acquire(self.checkout_timeout if timeout is None else timeout)
+        waited = time.monotonic() - started
+        with self._condition:
+            self._stats["checkouts"] += 1
+            self._stats["wait_seconds_total"] += waited
+            self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], waited)
+        failed = False
+        try:
+            yield client
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._release(client, discard=failed)
+
+    def check_idle_clients(self):
+        """Health-check idle clients, dropping dead ones and topping the pool back up."""
+        with self._condition:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._in_use += len(idle)
+        for client in idle:
+            try:
+                self.health_check(client)
+                healthy = True
+            except Exception as e:
+                logger.log(level=logging.WARNING, msg=f"Dropping unhealthy {self.name} client. Error: [{e}]")
+                healthy = False
+            self._release(client, discard=not healthy)
+        self.warm()
+
+    def metrics(self):
+        with self._condition:
+            metrics = dict(self._stats)
+            metrics.update({
+                "backend": self.name,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "created": self._created,
+                "max_concurrency": self.max_concurrency
+            })
+        return metrics
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_health_check_stop = threading.Event()
+_health_check_thread = None
+
+
+def default_pool_sources():
+    return {
+        KOLORS_BACKEND: TokensAndURLs.MODEL_NAME.value,
+        IDM_VTON_BACKEND: TokensAndURLs.IDM_VTON_MODEL_NAME.value
+    }
+
+
+def register_gradio_pool(pool):
+    with _pools_lock:
+        _pools[pool.name] = pool
+    return pool
+
+
+def get_gradio_pool(name):
+    """Return the process-wide pool for a backend, creating it on first use."""
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = GradioClientPool(name, default_pool_sources()[name])
+        return _pools[name]
+
+
+def gradio_pool_metrics():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [pool.metrics() for pool in pools]
+
+
+def _health_check_loop(interval):
+    while not _health_check_stop.wait(interval):
+        with _pools_lock:
+            pools = list(_pools.values())
+        for pool in pools:
+            try:
+                pool.check_idle_clients()
+            except Exception as e:
+                logger.log(level=logging.ERROR, msg=f"Health check of {pool.name} failed. Error: [{e}]")
+
+
+def start_gradio_pools(interval=GradioPoolSettings.HEALTH_CHECK_INTERVAL_SECONDS.value):
+    """Warm every default backend pool and start the periodic health check."""
+    global _health_check_thread
+    for name in default_pool_sources():
+        get_gradio_pool(name).warm()
+    if _health_check_thread is None:
+        _health_check_stop.clear()
+        _health_check_thread = threading.Thread(
+            target=_health_check_loop, args=(interval,), name="gradio-health-check", daemon=True
+        )
+        _health_check_thread.start()
+
+
+def stop_gradio_pools():
+    global _health_check_thread
+    _health_check_stop.set()
+    if _health_check_thread is not None:
+        _health_check_thread.join(timeout=5)
+        _health_check_thread = None
@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import threading
+
+from urllib.parse import urlsplit
+
+from constants import HttpClientSettings
+from telemetry import DOWNLOAD_ATTEMPTS, span
+from utils import MyCustomError
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class MediaTooLargeError(MyCustomError):
+    pass
+
+
+class MediaDownloadClient:
+    """Shared, connection-pooled async client that streams media straight to disk.
+
+    The httpx client lives on a dedicated event loop thread so both sync callers
+    (via download_to_file_sync) and async callers can share one connection pool.
+    """
+
+    def __init__(self, max_connections=HttpClientSettings.MAX_CONNECTIONS.value,
+                 max_keepalive_connections=HttpClientSettings.MAX_KEEPALIVE_CONNECTIONS.value,
+                 per_host_limit=HttpClientSettings.PER_HOST_LIMIT.value,
+                 max_media_bytes=HttpClientSettings.MAX_MEDIA_BYTES.value,
+                 chunk_size=HttpClientSettings.CHUNK_SIZE.value,
+                 max_attempts=HttpClientSettings.MAX_ATTEMPTS.value,
+                 backoff_base=HttpClientSettings.BACKOFF_BASE_SECONDS.value,
+                 backoff_max=HttpClientSettings.BACKOFF_MAX_SECONDS.value,
+                 timeout=HttpClientSettings.TIMEOUT_SECONDS.value):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.per_host_limit = per_host_limit
+        self.max_media_bytes = max_media_bytes
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self._client = None
+        self._loop = None
+        self._thread = None
+        self._host_semaphores = {}
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                ready.set()
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=run_loop, name="media-download-loop", daemon=True)
+            self._thread.start()
+            ready.wait()
+            self._loop = loop
+
+    def _get_client(self):
+        # Only called on the client loop, so no locking is needed
+        if self._client is None:
+            # Imported on the first download, httpx is a noticeable part of startup
+            import httpx
+
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections
+                ),
+                timeout=httpx.Timeout(self.timeout),
+                follow_redirects=True
+            )
+        return self._client
+
+    def _host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+        return self._host_semaphores[host]
+
+    def _backoff_delay(self, attempt):
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def _stream_to_file(self, url, dest_path, auth, follow_redirects):
+        temp_path = f"{dest_path}.part"
+        written = 0
+        digest = hashlib.sha256()
+        try:
+            async with self._get_client().stream("GET", url, auth=auth, follow_redirects=follow_redirects) as response:
+                if response.status_code != 200:
+                    return response.status_code, 0, None
+                content_length = response.headers.get("Content-Length")
+                if content_length and int(content_length) > self.max_media_bytes:
+                    raise MediaTooLargeError(
+                        f"Media at {url} is {content_length} bytes, limit is {self.max_media_bytes}"
+                    )
+                with open(temp_path, "wb") as file:
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        written += len(chunk)
+                        if written > self.max_media_bytes:
+                            raise MediaTooLargeError(
+                                f"Media at {url} exceeds the limit of {self.max_media_bytes} bytes"
+                            )
+                        digest.update(chunk)
+                        file.write(chunk)
+            os.replace(temp_path, dest_path)
+            return 200, written, digest.hexdigest()
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    async def _download_on_loop(self, url, dest_path, auth, follow_redirects=True):
+        import httpx
+
+        last_error = None
+        async with self._host_semaphore(url):
+            for attempt in range(self.max_attempts):
+                try:
+                    with span("download"):
+                        status_code, written, content_hash = await self._stream_to_file(
+                            url, dest_path, auth, follow_redirects
+                        )
+                    DOWNLOAD_ATTEMPTS.inc(outcome=status_code)
+                    if status_code == 200:
+                        return written, content_hash
+                    last_error = MyCustomError(f"Got status {status_code} while downloading {url}")
+                    if status_code not in RETRYABLE_STATUS_CODES:
+                        break
+                except httpx.TransportError as e:
+                    DOWNLOAD_ATTEMPTS.inc(outcome="transport_error")
+                    last_error = e
+                if attempt < self.max_attempts - 1:
+                    await asyncio.sleep(self._backoff_delay(attempt))
+        raise last_error
+
+    async def download_to_file(self, url, dest_path, auth=None):
+        """Download url into dest_path, returning (bytes written, SHA-256 of the content)."""
+        self._ensure_started()
+        future = asyncio.run_coroutine_threadsafe(self._download_on_loop(url, dest_path, auth), self._loop)
+        return await asyncio.wrap_future(future)
+
+    def download_to_file_sync(self, url, dest_path, auth=None, follow_redirects=True):
+        self._ensure_started()
+        future = asyncio.run_coroutine_threadsafe(
+            self._download_on_loop(url, dest_path, auth, follow_redirects), self._loop
+        )
+        return future.result()
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._client is not None:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+            self._client = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop = None
+        self._thread = None
+        self._host_semaphores = {}
+
+
+_media_download_client = None
+_media_download_client_lock = threading.Lock()
+
+
+def get_media_download_client():
+    """Return the process-wide MediaDownloadClient."""
+    global _media_download_client
+    if _media_download_client is None:
+        with _media_download_client_lock:
+            if _media_download_client is None:
+                _media_download_client = MediaDownloadClient()
+    return _media_download_client
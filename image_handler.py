@@ -1,168 +1,270 @@
+import asyncio
 import logging
 import os
-import json
-import requests
 
-from datetime import datetime
-from dotenv import load_dotenv
-from constants import DirectoryPath, TokensAndURLs
-from utils import MyCustomError
-
-# Load environment variables from .env file
-load_dotenv()
-twilio_account_id = os.getenv("TWILIO_ACCOUNT_ID")
-twilio_auth_token = os.getenv("TWILIO_AUTH_TOKEN")
-
-os.makedirs(DirectoryPath.INPUT_DIR.value, exist_ok=True)
-os.makedirs(DirectoryPath.INPUT_METADATA_DIR.value, exist_ok=True)
+from blob_store import get_blob_store
+from http_client import get_media_download_client
+from metadata_store import get_metadata_store
+from near_duplicates import get_near_duplicate_index
+from session_state import READY, get_session_store
+from speculative import get_speculative_preprocessor
+from utils import MyCustomError, Utils
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def twilio_media_auth():
+    """Basic auth for Twilio media URLs, or None when no credentials are configured."""
+    # Read on use, the .env file is loaded by the app's startup hook
+    twilio_account_id = os.getenv("TWILIO_ACCOUNT_ID")
+    twilio_auth_token = os.getenv("TWILIO_AUTH_TOKEN")
+    if twilio_account_id and twilio_auth_token:
+        return twilio_account_id, twilio_auth_token
+    return None
+
+
 class UserMetadataManager:
+    """The user's input image entries, every change is also applied to their cached session."""
+
     def __init__(self, user_id):
         self.user_id = user_id
-        self.metadata_file = os.path.join(
-            DirectoryPath.INPUT_METADATA_DIR.value, f"{self.user_id}_metadata.json"
-        )
-        self.input_metadata = self.load_input_metadata()
+        self.store = get_metadata_store()
+        self.sessions = get_session_store()
+
+    def session(self):
+        return self.sessions.get(self.user_id)
 
     def load_input_metadata(self):
-        """Load or initialize metadata for the user."""
-        if os.path.exists(self.metadata_file):
-            with open(self.metadata_file, "r") as file:
-                return json.load(file)
-        return []
-
-    def save_metadata(self):
-        """Save metadata to a JSON file."""
-        with open(self.metadata_file, "w") as file:
-            json.dump(self.input_metadata, file, indent=4)
-
-    def add_image_metadata(self, media_url, image_location, image_type="None"):
-        metadata = self.load_input_metadata()
+        """Return every metadata entry for the user, oldest first."""
+        return self.store.list_input_images(self.user_id)
+
+    def add_image_metadata(self, media_url, image_location, image_type="None", content_hash=None, match_hash=None):
         """Add new image metadata entry."""
-        metadata.append({
-            "media_url": media_url,
-            "image_location": image_location,
-            "image_type": image_type,
-            "already_used": False
-        })
-        self.input_metadata = metadata
-        self.save_metadata()
+        image_id = self.store.add_input_image(
+            self.user_id, media_url, image_location, image_type, content_hash=content_hash, match_hash=match_hash
+        )
+        self.sessions.record(self.user_id, {image_type: 1})
+        return image_id
 
     def find_latest_unused_image(self, image_type):
-        metadata = self.load_input_metadata()
         """Find and return the latest unused image metadata of a specific type."""
-        for entry in reversed(metadata):
-            if entry["image_type"] == image_type and not entry["already_used"]:
-                return entry
-        return None
+        return self.store.find_latest_unused_image(self.user_id, image_type)
+
+    def claim_latest_unused_image(self, image_type):
+        """Find the latest unused image of a specific type and mark it as used."""
+        entry = self.store.claim_latest_unused_image(self.user_id, image_type)
+        if entry is not None:
+            self.sessions.record(self.user_id, {image_type: -1})
+        return entry
+
+    def claim_unused_images(self, image_type, limit):
+        """Claim up to limit unused images of a specific type, newest first."""
+        entries = self.store.claim_unused_images(self.user_id, image_type, limit)
+        if entries:
+            self.sessions.record(self.user_id, {image_type: -len(entries)})
+        return entries
 
-    def mark_image_as_used(self, index):
+    def claim_try_on_images(self, garment_limit):
+        """Claim the person image and up to garment_limit garments of a try-on together."""
+        person_entry, garment_entries = self.store.claim_try_on_images(self.user_id, garment_limit)
+        if person_entry is not None:
+            self.sessions.record(self.user_id, {"person": -1, "garment": -len(garment_entries)})
+        return person_entry, garment_entries
+
+    def unclaim_images(self, entries):
+        """Give back images claimed for a try-on that could not be started."""
+        self.store.unclaim_images([entry["id"] for entry in entries])
+        counts = {}
+        for entry in entries:
+            counts[entry["image_type"]] = counts.get(entry["image_type"], 0) + 1
+        self.sessions.record(self.user_id, counts)
+
+    def retype_latest_unused_image(self, old_image_type, new_image_type):
+        """Retype the latest unused image of old_image_type atomically, returning its entry."""
+        entry = self.store.retype_latest_unused_image(self.user_id, old_image_type, new_image_type)
+        if entry is not None:
+            self.sessions.record(self.user_id, {old_image_type: -1, new_image_type: 1})
+        return entry
+
+    def retype_unused_images(self, old_image_type, new_image_type):
+        renamed = self.store.retype_unused_images(self.user_id, old_image_type, new_image_type)
+        if renamed:
+            self.sessions.record(self.user_id, {old_image_type: -renamed, new_image_type: renamed})
+        return renamed
+
+    def mark_image_as_used(self, image_id):
         """Mark a specific image as used."""
-        metadata = self.load_input_metadata()
-        metadata[index]["already_used"] = True
-        self.input_metadata = metadata
-        self.save_metadata()
+        self.store.mark_image_as_used(image_id)
+        # The entry's type is not known here, the session is reloaded instead
+        self.sessions.record(self.user_id)
+
+    def update_image_metadata(self, image_id, image_location, image_type):
+        self.store.update_input_image(image_id, image_location, image_type)
+        self.sessions.record(self.user_id)
 
 
 class ImageManager:
     def __init__(self, user_id):
         self.user_id = user_id
         self.metadata_manager = UserMetadataManager(user_id)
+        self.blob_store = get_blob_store()
 
     def download_image(self, media_url, image_type=None):
+        temp_path = self.blob_store.new_incoming_path()
         try:
-            """Download image from a URL and save it locally, returning the file path."""
-            retry_count = 0
-            response = None
-
-            while retry_count < 3:
-                try:
-                    response = requests.get(
-                        media_url,
-                        auth=(twilio_account_id, twilio_auth_token),
-                        timeout=30
-                    )
-                    if response.status_code == 200:
-                        break
-                except requests.RequestException as e:
-                    pass
-                retry_count += 1
-
-            if response and response.status_code == 200:
-                filename = f"{self.user_id}_{image_type}_{datetime.now().isoformat()}.png"
-                filepath = os.path.join(DirectoryPath.INPUT_DIR.value, filename)
-                with open(filepath, "wb") as file:
-                    file.write(response.content)
-                self.metadata_manager.add_image_metadata(
-                    media_url, filepath, image_type
-                )
-                return filepath
-            else:
-                raise MyCustomError(f"Failed to download the image for the user: {self.user_id}")
+            """Download image from a URL into the shared blob store, returning the blob path."""
+            # The content hash is computed while streaming, so cache lookups never re-read the file
+            _, content_hash = get_media_download_client().download_to_file_sync(
+                media_url, temp_path, auth=twilio_media_auth()
+            )
+            filepath = self.blob_store.ingest(temp_path, content_hash)
+            return self._record_download(media_url, image_type, filepath, content_hash)
         except Exception as e:
+            # ingest() moves the file into the store, what is left is a partial or rejected download
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
             logger.log(level=logging.ERROR, msg=f"Got an error while downloading the image. Media URL: "
                   f"[{media_url}] Image Type: [{image_type}] Error: [{e}]")
             raise e
 
+    async def download_images_async(self, media_urls, image_type=None):
+        """Download and normalize several images concurrently, recording them in the order they were sent."""
+        temp_paths = [self.blob_store.new_incoming_path() for _ in media_urls]
+        try:
+            # Every download settles before any fails the message, so none writes its file after the cleanup below
+            downloads = await asyncio.gather(*[
+                get_media_download_client().download_to_file(media_url, temp_path, auth=twilio_media_auth())
+                for media_url, temp_path in zip(media_urls, temp_paths)
+            ], return_exceptions=True)
+            errors = [download for download in downloads if isinstance(download, Exception)]
+            if errors:
+                raise errors[0]
+            filepaths = await asyncio.gather(*[
+                self.blob_store.ingest_async(temp_path, content_hash)
+                for temp_path, (_, content_hash) in zip(temp_paths, downloads)
+            ], return_exceptions=True)
+            errors = [filepath for filepath in filepaths if isinstance(filepath, Exception)]
+            if errors:
+                # One bad upload fails the message, the references taken for the others are given back
+                await asyncio.to_thread(self._release_blobs, [
+                    content_hash for filepath, (_, content_hash) in zip(filepaths, downloads)
+                    if not isinstance(filepath, Exception)
+                ])
+                raise errors[0]
+            # Recording takes SQLite transactions and matches near-duplicates, kept off the event loop
+            return await asyncio.to_thread(self._record_downloads, media_urls, image_type, filepaths, downloads)
+        except Exception as e:
+            for temp_path in temp_paths:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            logger.log(level=logging.ERROR, msg=f"Got an error while downloading the images. Media URLs: "
+                  f"{media_urls} Image Type: [{image_type}] Error: [{e}]")
+            raise e
+
+    def _release_blobs(self, content_hashes):
+        for content_hash in content_hashes:
+            self.blob_store.release(content_hash)
+
+    def _record_downloads(self, media_urls, image_type, filepaths, downloads):
+        return [
+            self._record_download(media_url, image_type, filepath, content_hash)
+            for media_url, filepath, (_, content_hash) in zip(media_urls, filepaths, downloads)
+        ]
+
+    def _record_download(self, media_url, image_type, filepath, content_hash):
+        # A photo sent again after recompression is cached under the first copy's hash
+        match_hash = get_near_duplicate_index().match(self.user_id, content_hash, image_type)
+        self.metadata_manager.add_image_metadata(
+            media_url, filepath, image_type, content_hash=content_hash, match_hash=match_hash
+        )
+        # Whichever image comes first is made ready for the merge or model while the other is on its way
+        get_speculative_preprocessor().schedule(filepath, pair_ready=self.metadata_manager.session().state == READY)
+        return filepath
+
 
     def rename_image(self, old_image_type=None, new_image_type="garment"):
         try:
-            """Rename the latest unused image of old_image_type to new_image_type."""
-            metadata = self.metadata_manager.load_input_metadata()
-            latest_image = None
-
-            # Find the latest unused image with the specified type
-            for i in range(len(metadata) - 1, -1, -1):
-                if metadata[i]["image_type"] == old_image_type and not metadata[i]["already_used"]:
-                    latest_image = metadata[i]
-                    index = i
-                    break
+            """Retype the latest unused image of old_image_type as new_image_type."""
+            # Blobs are shared and named by content, so only the metadata changes
+            latest_image = self.metadata_manager.retype_latest_unused_image(old_image_type, new_image_type)
 
             if latest_image:
-                directory, original_filename = os.path.split(latest_image["image_location"])
-                new_filename = f"{self.user_id}_{new_image_type}_{datetime.now().isoformat()}.png"
-                new_filepath = os.path.join(directory, new_filename)
-
-                # Rename file and update metadata
-                os.rename(latest_image["image_location"], new_filepath)
-                latest_image["image_location"] = new_filepath
-                latest_image["image_type"] = new_image_type
-                metadata[index] = latest_image
-                self.metadata_manager.input_metadata = metadata
-                self.metadata_manager.save_metadata()
-                return new_filepath
+                return latest_image["image_location"]
             else:
                 raise MyCustomError("No unused image found with the specified type.")
         except Exception as e:
-            logger.log(level=logging.ERROR, msg=f"Got an error while renaming the image. Media URL: "
-                  f"[{media_url}] Error: [{e}]")
+            logger.log(level=logging.ERROR, msg=f"Got an error while renaming the image. User: "
+                  f"[{self.user_id}] Error: [{e}]")
+            raise e
+
+
+    def rename_all_images(self, old_image_type=None, new_image_type="garment"):
+        """Retype every unused image of old_image_type, for several photos sent before their type."""
+        try:
+            renamed = self.metadata_manager.retype_unused_images(old_image_type, new_image_type)
+            if not renamed:
+                raise MyCustomError("No unused image found with the specified type.")
+            return renamed
+        except Exception as e:
+            logger.log(level=logging.ERROR, msg=f"Got an error while renaming the images. User: "
+                  f"[{self.user_id}] Error: [{e}]")
             raise e
 
+    def fetch_latest_unused_entry(self, image_type="garment"):
+        """Claim the latest unused image of a specific type, returning its metadata entry."""
+        entry = self.metadata_manager.claim_latest_unused_image(image_type)
+        if entry is not None:
+            return entry
+        raise MyCustomError(f"No unused {image_type} image found for user {self.user_id}.")
+
+    def fetch_unused_entries(self, image_type="garment", limit=1):
+        """Claim up to limit unused images of a specific type, newest first."""
+        entries = self.metadata_manager.claim_unused_images(image_type, limit)
+        if entries:
+            return entries
+        raise MyCustomError(f"No unused {image_type} image found for user {self.user_id}.")
+
+    def fetch_try_on_entries(self, garment_limit):
+        """Claim the person image and up to garment_limit garments of a try-on, all or none of them."""
+        person_entry, garment_entries = self.metadata_manager.claim_try_on_images(garment_limit)
+        if person_entry is not None:
+            return person_entry, garment_entries
+        raise MyCustomError(f"No unused person and garment images found for user {self.user_id}.")
+
+    def return_entries(self, entries):
+        """Mark entries claimed by fetch_try_on_entries unused again."""
+        self.metadata_manager.unclaim_images(entries)
 
     def fetch_latest_unused_image(self, image_type="garment", get_url=True):
         """Fetch the latest unused image of a specific type, returning its location or URL."""
-        metadata = self.metadata_manager.load_input_metadata()
-        for i in range(len(metadata) - 1, -1, -1):
-            entry = metadata[i]
-            if entry["image_type"] == image_type and not entry["already_used"]:
-                self.metadata_manager.mark_image_as_used(i)
-                return entry["media_url"] if get_url else entry["image_location"]
-        raise MyCustomError(f"No unused {image_type} image found for user {self.user_id}.")
+        entry = self.fetch_latest_unused_entry(image_type)
+        return entry["media_url"] if get_url else entry["image_location"]
+
+    def resolve_input_image(self, image_type, media_path=None, content_hash=None):
+        """Return (location, match hash) for an input, claiming the latest unused one if no path is given."""
+        if media_path is None:
+            entry = self.fetch_latest_unused_entry(image_type)
+            media_path, content_hash = entry["image_location"], entry["match_hash"]
+        if content_hash is None:
+            content_hash = Utils.hash_file(media_path)
+        return media_path, content_hash
+
+    def session(self):
+        """Return the user's Session, from memory unless it changed since it was loaded."""
+        return self.metadata_manager.session()
 
     def has_unused_image(self, image_type="garment"):
         """Check if there is an unused image of a specific type."""
-        for entry in reversed(self.metadata_manager.input_metadata):
-            if entry["image_type"] == image_type and not entry["already_used"]:
-                return True
-        return False
+        return self.session().has(image_type)
 
 
 # Example usage
 if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    # Load environment variables from .env file
+    load_dotenv()
     user_id = "12345"
     media_url = "https://example.com/image.jpg"  # Replace with actual media URL
 
@@ -0,0 +1,266 @@
+import contextvars
+import os
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import BatchSettings, IngestSettings, MergeSettings, NearDuplicateSettings
+from image_workers import SharedPanel
+from telemetry import span
+from utils import MyCustomError
+
+_heif_opener_checked = False
+
+
+class UnsupportedImageError(MyCustomError):
+    pass
+
+
+def _pillow():
+    """Return Pillow's Image and ImageOps, imported on first use so importing this module stays cheap."""
+    global _heif_opener_checked
+    from PIL import Image, ImageOps
+
+    if not _heif_opener_checked:
+        _heif_opener_checked = True
+        try:
+            from pillow_heif import register_heif_opener
+            register_heif_opener()
+        except ImportError:
+            # Without the plugin HEIC uploads are rejected as unsupported
+            pass
+    return Image, ImageOps
+
+
+def load_panel(image_path, box):
+    """Decode an image scaled down to fit box=(width, height), never holding the full-size pixels if avoidable."""
+    import numpy as np
+
+    Image, _ = _pillow()
+    with span("decode"), Image.open(image_path) as image:
+        # JPEG draft mode lets libjpeg decode at 1/2, 1/4 or 1/8 scale straight away
+        image.draft("RGB", box)
+        image = image.convert("RGB")
+        image.thumbnail(box, Image.LANCZOS, reducing_gap=2.0)
+        return np.asarray(image)
+
+
+def load_panels(image_paths, box, max_workers=BatchSettings.MAX_WORKERS.value):
+    """load_panel over several images at once, Pillow releases the GIL while decoding and resampling."""
+    if len(image_paths) <= 1:
+        return [load_panel(image_path, box) for image_path in image_paths]
+    # Each thread runs in a copy of this context, so its spans are recorded like the caller's
+    contexts = [contextvars.copy_context() for _ in image_paths]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(image_paths))) as executor:
+        return list(executor.map(lambda context, image_path: context.run(load_panel, image_path, box),
+                                 contexts, image_paths))
+
+
+def compose_side_by_side(panels, box, background=MergeSettings.BACKGROUND_COLOR.value):
+    """Letterbox each panel into its own box-sized cell, left to right."""
+    import numpy as np
+
+    width, height = box
+    with span("composite"):
+        canvas = np.empty((height, width * len(panels), 3), dtype=np.uint8)
+        canvas[:] = background
+        for index, pixels in enumerate(panels):
+            top = (height - pixels.shape[0]) // 2
+            left = index * width + (width - pixels.shape[1]) // 2
+            canvas[top:top + pixels.shape[0], left:left + pixels.shape[1]] = pixels
+    return canvas
+
+
+def compose_grid(panels, box, columns, background=MergeSettings.BACKGROUND_COLOR.value):
+    """Letterbox each panel into a box-sized cell of a grid with the given number of columns."""
+    import numpy as np
+
+    width, height = box
+    columns = max(1, min(columns, len(panels)))
+    rows = -(-len(panels) // columns)
+    with span("composite"):
+        canvas = np.empty((height * rows, width * columns, 3), dtype=np.uint8)
+        canvas[:] = background
+        for index, pixels in enumerate(panels):
+            row, column = divmod(index, columns)
+            top = row * height + (height - pixels.shape[0]) // 2
+            left = column * width + (width - pixels.shape[1]) // 2
+            canvas[top:top + pixels.shape[0], left:left + pixels.shape[1]] = pixels
+    return canvas
+
+
+def encode_jpeg(pixels, output_path, quality=MergeSettings.JPEG_QUALITY.value,
+                progressive=MergeSettings.PROGRESSIVE_JPEG.value):
+    Image, _ = _pillow()
+    # Progressive scans already use optimized Huffman tables, so optimize=True would only add a pass
+    with span("encode"):
+        Image.fromarray(pixels).save(output_path, "JPEG", quality=quality, progressive=progressive)
+
+
+def letterbox(pixels, box, background=MergeSettings.BACKGROUND_COLOR.value):
+    """The panel centred in a box-sized cell, the cells of a side-by-side merge only need joining."""
+    import numpy as np
+
+    width, height = box
+    bottom = (height - pixels.shape[0]) // 2 + pixels.shape[0]
+    right = (width - pixels.shape[1]) // 2 + pixels.shape[1]
+    top, left = bottom - pixels.shape[0], right - pixels.shape[1]
+    cell = np.empty((height, width, 3), dtype=np.uint8)
+    # Only the margins are painted, a panel usually fills the cell in one direction
+    color = np.array(background, dtype=np.uint8)
+    cell[:top] = color
+    cell[bottom:] = color
+    cell[top:bottom, :left] = color
+    cell[top:bottom, right:] = color
+    cell[top:bottom, left:right] = pixels
+    return cell
+
+
+def prepare_cell(image_path, box, cell_path):
+    """Decode and letterbox an image ahead of its merge, saving the cell as a raw array at cell_path."""
+    import numpy as np
+
+    cell = letterbox(load_panel(image_path, box), box)
+    # Unique per writer, web workers and image workers of every process may prepare the same cell
+    temp_path = f"{cell_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "wb") as file:
+        np.save(file, cell)
+    # Renamed into place, so a merge never reads half a cell
+    os.replace(temp_path, cell_path)
+    return cell_path
+
+
+def load_cell(image_path, box, cell_path=None):
+    """The letterboxed cell of an image, read from cell_path when it was prepared ahead."""
+    import numpy as np
+
+    if cell_path:
+        try:
+            cell = np.load(cell_path, allow_pickle=False)
+            # Anything else is not a cell of this box, whatever wrote it
+            if cell.shape == (box[1], box[0], 3) and cell.dtype == np.uint8:
+                return cell
+        except (OSError, ValueError, EOFError):
+            # Not prepared, or removed by the cleanup in the meantime
+            pass
+    return letterbox(load_panel(image_path, box), box)
+
+
+def merge_side_by_side(person_image_path, garment_image_path, output_path,
+                       box=(MergeSettings.PANEL_WIDTH.value, MergeSettings.PANEL_HEIGHT.value),
+                       quality=MergeSettings.JPEG_QUALITY.value, cell_paths=(None, None)):
+    """Merge two images left to right, starting from their prepared cells where cell_paths has them."""
+    import numpy as np
+
+    cells = [load_cell(image_path, box, cell_path)
+             for image_path, cell_path in zip((person_image_path, garment_image_path), cell_paths)]
+    with span("composite"):
+        canvas = np.concatenate(cells, axis=1)
+    encode_jpeg(canvas, output_path, quality)
+    return output_path
+
+
+def decode_panel_to_shared(image_path, panel,
+                           box=(MergeSettings.PANEL_WIDTH.value, MergeSettings.PANEL_HEIGHT.value)):
+    """Decode an image once into an allocated SharedPanel so several workers can composite with it."""
+    return panel.fill(load_panel(image_path, box))
+
+
+def merge_with_shared_panel(person_panel, garment_image_path, output_path,
+                            box=(MergeSettings.PANEL_WIDTH.value, MergeSettings.PANEL_HEIGHT.value),
+                            quality=MergeSettings.JPEG_QUALITY.value):
+    """merge_side_by_side with the person already decoded into a SharedPanel."""
+    garment_pixels = load_panel(garment_image_path, box)
+    with person_panel.attach() as person_pixels:
+        canvas = compose_side_by_side([person_pixels, garment_pixels], box)
+        # The shared mapping can only be closed once nothing points into it
+        del person_pixels
+    encode_jpeg(canvas, output_path, quality)
+    return output_path
+
+
+def make_contact_sheet(image_paths, output_path,
+                       box=(BatchSettings.CONTACT_SHEET_CELL_WIDTH.value, BatchSettings.CONTACT_SHEET_CELL_HEIGHT.value),
+                       columns=BatchSettings.CONTACT_SHEET_COLUMNS.value,
+                       quality=MergeSettings.JPEG_QUALITY.value):
+    """Tile several results into one grid image so they can be compared at a glance."""
+    encode_jpeg(compose_grid(load_panels(image_paths, box), box, columns), output_path, quality)
+    return output_path
+
+
+def _flatten_to_rgb(image, background=MergeSettings.BACKGROUND_COLOR.value):
+    Image, _ = _pillow()
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        flattened = Image.new("RGB", image.size, background)
+        flattened.paste(image, mask=image.getchannel("A"))
+        return flattened
+    return image.convert("RGB")
+
+
+def normalize_image(source_path, output_path, thumbnail_path,
+                    box=(IngestSettings.MAX_WIDTH.value, IngestSettings.MAX_HEIGHT.value),
+                    thumbnail_box=(IngestSettings.THUMBNAIL_WIDTH.value, IngestSettings.THUMBNAIL_HEIGHT.value),
+                    quality=IngestSettings.JPEG_QUALITY.value):
+    """Turn an upload into an upright RGB JPEG no larger than box, without EXIF, plus a thumbnail.
+
+    The format is sniffed from the bytes, the name or content type Twilio sent is not trusted.
+    """
+    Image, ImageOps = _pillow()
+    with span("normalize"):
+        try:
+            image = Image.open(source_path)
+        except (Image.UnidentifiedImageError, OSError):
+            raise UnsupportedImageError("The upload is not an image we can read")
+        with image:
+            source_format = image.format
+            if source_format not in IngestSettings.FORMATS.value:
+                raise UnsupportedImageError(f"Unsupported image format {source_format}")
+            source_size = image.size
+            # The EXIF rotation may swap width and height, so draft for the longer side in both directions
+            longest_side = max(box)
+            image.draft("RGB", (longest_side, longest_side))
+            # ICC profiles describe the colors and are kept, EXIF (location, camera) is dropped with the rest
+            icc_profile = image.info.get("icc_profile")
+            image = _flatten_to_rgb(ImageOps.exif_transpose(image))
+        image.thumbnail(box, Image.LANCZOS, reducing_gap=2.0)
+        image.save(output_path, "JPEG", quality=quality, icc_profile=icc_profile)
+        size = image.size
+        image.thumbnail(thumbnail_box, Image.LANCZOS)
+        image.save(thumbnail_path, "JPEG", quality=80)
+        return {"format": source_format, "source_size": source_size, "size": size,
+                "perceptual_hash": difference_hash(image)}
+
+
+def difference_hash(image, hash_size=NearDuplicateSettings.HASH_SIZE.value):
+    """Hex dHash of a Pillow image: whether each pixel of a tiny grayscale copy is brighter than its left neighbour.
+
+    Recompression and resizing change few of the bits, a different photo changes about half of them.
+    """
+    import numpy as np
+
+    Image, _ = _pillow()
+    with span("perceptual_hash"):
+        pixels = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.int16)
+        bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return bits.tobytes().hex()
+
+
+def perceptual_hash_file(image_path, hash_size=NearDuplicateSettings.HASH_SIZE.value):
+    """difference_hash of a stored image, for blobs stored before ingest computed one."""
+    Image, ImageOps = _pillow()
+    with Image.open(image_path) as image:
+        image.draft("RGB", (hash_size * 16, hash_size * 16))
+        return difference_hash(_flatten_to_rgb(ImageOps.exif_transpose(image)), hash_size)
+
+
+def make_thumbnail(image_path, thumbnail_path,
+                   box=(IngestSettings.THUMBNAIL_WIDTH.value, IngestSettings.THUMBNAIL_HEIGHT.value)):
+    """A thumbnail for an image stored before ingest made one."""
+    Image, ImageOps = _pillow()
+    with Image.open(image_path) as image:
+        image.draft("RGB", box)
+        image = _flatten_to_rgb(ImageOps.exif_transpose(image))
+    image.thumbnail(box, Image.LANCZOS)
+    image.save(thumbnail_path, "JPEG", quality=80)
+    return thumbnail_path
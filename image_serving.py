@@ -0,0 +1,123 @@
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from collections import OrderedDict
+
+from constants import DirectoryPath, ImageServingSettings
+
+SAFE_IMAGE_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._entries.pop(key, None)
+
+
+class OutputImageServer:
+    """Resolves output image names safely and keeps ETags and small images in memory."""
+
+    def __init__(self, output_dir, etag_cache_entries=ImageServingSettings.ETAG_CACHE_ENTRIES.value,
+                 thumbnail_max_bytes=ImageServingSettings.THUMBNAIL_MAX_BYTES.value,
+                 thumbnail_cache_entries=ImageServingSettings.THUMBNAIL_CACHE_ENTRIES.value):
+        self.output_dir = os.path.realpath(output_dir)
+        self.thumbnail_max_bytes = thumbnail_max_bytes
+        self._etags = LRUCache(etag_cache_entries)
+        self._thumbnails = LRUCache(thumbnail_cache_entries)
+
+    def resolve(self, image_name):
+        """Return the real path of an output image, or None for missing or unsafe names."""
+        if not SAFE_IMAGE_NAME.match(image_name) or ".." in image_name:
+            return None
+        # Outputs are sharded by the first four characters of their name, older ones sit in output_dir itself
+        for directory in (os.path.join(self.output_dir, image_name[:2], image_name[2:4]), self.output_dir):
+            path = os.path.realpath(os.path.join(directory, image_name))
+            if os.path.dirname(path) == directory and os.path.isfile(path):
+                return path
+        return None
+
+    @staticmethod
+    def media_type(path):
+        return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    def cached_description(self, path):
+        """Return (stat, ETag) without reading the file, the ETag is None if it was never hashed."""
+        stat = os.stat(path)
+        return stat, self._etags.get((path, stat.st_mtime_ns, stat.st_size))
+
+    def describe(self, path):
+        """Return (stat, strong ETag); the content hash is computed once per file version."""
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        etag = self._etags.get(key)
+        if etag is None:
+            digest = hashlib.sha256()
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(64 * 1024), b""):
+                    digest.update(chunk)
+            etag = f'"{digest.hexdigest()}"'
+            self._etags.put(key, etag)
+        return stat, etag
+
+    def cached_small_image_bytes(self, path, stat):
+        """Bytes of a small image already held in memory, None if it is not."""
+        return self._thumbnails.get((path, stat.st_mtime_ns, stat.st_size))
+
+    def small_image_bytes(self, path, stat):
+        """Bytes of images small enough for the in-memory tier, None for larger ones."""
+        if stat.st_size > self.thumbnail_max_bytes:
+            return None
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        content = self._thumbnails.get(key)
+        if content is None:
+            with open(path, "rb") as file:
+                content = file.read()
+            self._thumbnails.put(key, content)
+        return content
+
+    @staticmethod
+    def etag_matches(if_none_match, etag):
+        if not if_none_match:
+            return False
+        candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+        # If-None-Match uses weak comparison
+        return "*" in candidates or any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+
+_output_image_server = None
+_output_image_server_lock = threading.Lock()
+
+
+def get_output_image_server():
+    """Return the process-wide OutputImageServer."""
+    global _output_image_server
+    if _output_image_server is None:
+        with _output_image_server_lock:
+            if _output_image_server is None:
+                os.makedirs(DirectoryPath.OUTPUT_DIR.value, exist_ok=True)
+                _output_image_server = OutputImageServer(DirectoryPath.OUTPUT_DIR.value)
+    return _output_image_server
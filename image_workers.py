@@ -0,0 +1,218 @@
+import asyncio
+import math
+import multiprocessing
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
+
+from constants import ImageWorkerSettings
+from telemetry import call_recording_observations, get_metrics_registry
+from utils import MyCustomError
+
+
+class ImageWorkersBusyError(MyCustomError):
+    pass
+
+
+class SharedPanel:
+    """Decoded RGB pixels in shared memory, handed to worker processes by name instead of pickled.
+
+    The server process allocates and unlinks the segment, workers only fill and attach it. Attaching
+    registers it with the resource tracker again, which pool workers share with the server process,
+    so the segment stays tracked once and is never unlinked behind the owner's back.
+    """
+
+    def __init__(self, name, shape):
+        self.name = name
+        self.shape = tuple(shape)
+
+    @classmethod
+    def allocate(cls, shape):
+        """Create a segment for up to shape pixels, owned by the calling process."""
+        shared_memory = SharedMemory(create=True, size=math.prod(shape))
+        shared_memory.close()
+        return cls(shared_memory.name, shape)
+
+    def fill(self, pixels):
+        """Copy pixels no larger than the allocated shape in, returning the panel that reads them."""
+        import numpy as np
+
+        shared_memory = SharedMemory(name=self.name)
+        try:
+            if pixels.nbytes > shared_memory.size:
+                raise MyCustomError(f"{pixels.shape} pixels do not fit a panel of {self.shape}")
+            np.ndarray(pixels.shape, dtype=np.uint8, buffer=shared_memory.buf)[:] = pixels
+        finally:
+            shared_memory.close()
+        return SharedPanel(self.name, pixels.shape)
+
+    @contextmanager
+    def attach(self):
+        """Map the pixels read-only; drop every reference to the array before the block ends."""
+        import numpy as np
+
+        shared_memory = SharedMemory(name=self.name)
+        pixels = np.ndarray(self.shape, dtype=np.uint8, buffer=shared_memory.buf)
+        pixels.flags.writeable = False
+        try:
+            yield pixels
+        finally:
+            del pixels
+            try:
+                shared_memory.close()
+            except BufferError:
+                # Still referenced, e.g. from a traceback, the mapping is freed along with it
+                pass
+
+    def unlink(self):
+        """Free the memory, only the process that owns the panel calls this."""
+        shared_memory = SharedMemory(name=self.name)
+        shared_memory.close()
+        shared_memory.unlink()
+
+
+class ImageWorkerPool:
+    """Runs CPU-bound Pillow work in a bounded pool of processes so it never holds the server's GIL.
+
+    At most max_workers + max_queued tasks are accepted at once. Beyond that a submit waits up to
+    submit_timeout seconds for a slot and then raises ImageWorkersBusyError.
+    """
+
+    def __init__(self, max_workers=ImageWorkerSettings.MAX_WORKERS.value,
+                 max_queued=ImageWorkerSettings.MAX_QUEUED.value,
+                 submit_timeout=ImageWorkerSettings.SUBMIT_TIMEOUT_SECONDS.value):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.submit_timeout = submit_timeout
+        self._slots = threading.BoundedSemaphore(max(1, max_workers) + max_queued)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.rejected = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Spawned rather than forked, the server process already runs threads and event loops
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _release_slot(self, future=None):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _acquire_slot(self, timeout):
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.rejected += 1
+            raise ImageWorkersBusyError(
+                f"All {self.max_workers} image workers are busy and {self.max_queued} tasks are waiting"
+            )
+
+    def _submit_with_slot(self, function, *args, **kwargs):
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = self._get_executor().submit(function, *args, **kwargs)
+        except BrokenProcessPool:
+            # A worker died (OOM on a huge image), start a fresh pool for the next task
+            self._release_slot()
+            self.reset()
+            raise
+        except Exception:
+            self._release_slot()
+            raise
+        future.add_done_callback(self._release_slot)
+        return future
+
+    def submit(self, function, *args, **kwargs):
+        """Queue a call of a module-level function in a worker process, returning its future."""
+        self._acquire_slot(self.submit_timeout)
+        return self._submit_with_slot(function, *args, **kwargs)
+
+    def _submit_recorded(self, function, args, kwargs):
+        # Spans recorded in the worker are replayed here, where /metrics can see them
+        return self.submit(call_recording_observations, function, args, kwargs)
+
+    @staticmethod
+    def _replay(outcome):
+        result, observations = outcome
+        get_metrics_registry().replay(observations)
+        return result
+
+    def run(self, function, *args, **kwargs):
+        """Call a module-level function in a worker process and wait for its result."""
+        if self.max_workers <= 0:
+            return function(*args, **kwargs)
+        try:
+            return self._replay(self._submit_recorded(function, args, kwargs).result())
+        except BrokenProcessPool:
+            self.reset()
+            raise
+
+    def map(self, function, *iterables):
+        """run() over several argument tuples in parallel, results in order."""
+        if self.max_workers <= 0:
+            return [function(*args) for args in zip(*iterables)]
+        try:
+            futures = [self._submit_recorded(function, args, {}) for args in zip(*iterables)]
+            return [self._replay(future.result()) for future in futures]
+        except BrokenProcessPool:
+            self.reset()
+            raise
+
+    async def run_async(self, function, *args, **kwargs):
+        """run() for coroutines, waiting for a slot and for the result without blocking the event loop."""
+        if self.max_workers <= 0:
+            return function(*args, **kwargs)
+        if not self._slots.acquire(blocking=False):
+            # Only a full pool parks a thread on the semaphore
+            await asyncio.to_thread(self._acquire_slot, self.submit_timeout)
+        try:
+            return self._replay(await asyncio.wrap_future(
+                self._submit_with_slot(call_recording_observations, function, args, kwargs)
+            ))
+        except BrokenProcessPool:
+            self.reset()
+            raise
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "in_flight": self._in_flight,
+                "capacity": max(1, self.max_workers) + self.max_queued,
+                "rejected": self.rejected
+            }
+
+    def reset(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+_image_worker_pool = None
+_image_worker_pool_lock = threading.Lock()
+
+
+def get_image_worker_pool():
+    """Return the process-wide ImageWorkerPool."""
+    global _image_worker_pool
+    if _image_worker_pool is None:
+        with _image_worker_pool_lock:
+            if _image_worker_pool is None:
+                _image_worker_pool = ImageWorkerPool()
+    return _image_worker_pool
@@ -0,0 +1,454 @@
+import logging
+import os
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from datetime import datetime
+from enum import Enum
+
+from constants import ConcurrencySettings, JobQueueSettings
+from rate_limiter import get_rate_limiter
+from telemetry import JOB_SECONDS, trace
+from utils import MyCustomError
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on this platform, every running job is taken for interrupted on start
+    fcntl = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+JOB_COLUMNS = "job_id, user_id, kind, payload, status, result, error, created_at, updated_at"
+
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class Job:
+    def __init__(self, job_id, user_id, kind, payload, status=JobStatus.QUEUED,
+                 result=None, error=None, created_at=None, updated_at=None):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.kind = kind
+        self.payload = payload
+        self.status = status
+        self.result = result
+        self.error = error
+        self.created_at = created_at or datetime.now().isoformat()
+        self.updated_at = updated_at or self.created_at
+        # Set by the queue while the job runs, saves results recorded before the job finishes
+        self.on_progress = None
+
+    @classmethod
+    def create(cls, user_id, kind, payload):
+        return cls(uuid.uuid4().hex, user_id, kind, payload)
+
+    def record_progress(self, **fields):
+        """Merge fields into the result of a running job and save it, so its status shows them already."""
+        self.result = {**(self.result or {}), **fields}
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "user_id": self.user_id,
+            "kind": self.kind,
+            "status": self.status.value,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+
+class InMemoryJobBackend:
+    """Process-local backend, jobs are lost on restart."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._pending = queue.Queue()
+        # Claimed jobs a worker holds back until the throttle lets them start
+        self._unstarted = set()
+        self._lock = threading.Lock()
+
+    def put(self, job):
+        with self._lock:
+            self._jobs[job.job_id] = job
+        self._pending.put(job.job_id)
+
+    def get_next(self, timeout=1.0):
+        """Claim the next queued job, or return None after timeout seconds."""
+        try:
+            job_id = self._pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self._lock:
+            job = self._jobs[job_id]
+            job.status = JobStatus.RUNNING
+            job.updated_at = datetime.now().isoformat()
+            self._unstarted.add(job_id)
+            return job
+
+    def mark_started(self, job):
+        with self._lock:
+            self._unstarted.discard(job.job_id)
+
+    def update(self, job):
+        with self._lock:
+            job.updated_at = datetime.now().isoformat()
+            self._jobs[job.job_id] = job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self):
+        """Jobs waiting to start, queued or claimed and held back by the throttle."""
+        with self._lock:
+            return self._pending.qsize() + len(self._unstarted)
+
+    def live_processes(self):
+        return 1
+
+    def recover_interrupted(self):
+        pass
+
+
+class SQLiteJobBackend:
+    """Durable backend, queued and interrupted jobs survive a restart.
+
+    Several processes can share one database. A running job records the process that claimed it, and
+    each process holds a lock file for as long as it lives, so a starting process only requeues the
+    jobs of processes that are gone.
+    """
+
+    def __init__(self, database_file, poll_interval=0.2,
+                 lock_dir=os.path.join(ConcurrencySettings.LOCK_DIR.value, "job_workers")):
+        self.database_file = database_file
+        self.poll_interval = poll_interval
+        self.lock_dir = lock_dir
+        self.worker_token = uuid.uuid4().hex
+        self._local = threading.local()
+        self._claim_lock = threading.Lock()
+        self._liveness_fd = None
+        self._liveness_lock = threading.Lock()
+        directory = os.path.dirname(database_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )"""
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)"
+        )
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(jobs)")]
+        if "claimed_by" not in columns:
+            connection.execute("ALTER TABLE jobs ADD COLUMN claimed_by TEXT")
+        if "started_at" not in columns:
+            # Set once the throttle lets a claimed job start
+            connection.execute("ALTER TABLE jobs ADD COLUMN started_at TEXT")
+        connection.commit()
+
+    def _liveness_path(self, worker_token):
+        return os.path.join(self.lock_dir, f"{worker_token}.lock")
+
+    def _hold_liveness_lock(self):
+        if self._liveness_fd is not None or fcntl is None:
+            return
+        # A second descriptor of this process would wait on the first one's flock forever
+        with self._liveness_lock:
+            if self._liveness_fd is not None:
+                return
+            os.makedirs(self.lock_dir, exist_ok=True)
+            path = self._liveness_path(self.worker_token)
+            while True:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                # Held until the process exits, the kernel releases it however the process ends
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # Another process may have taken the file for a dead one's and deleted it before the flock
+                try:
+                    if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                        break
+                except FileNotFoundError:
+                    pass
+                os.close(fd)
+            self._liveness_fd = fd
+
+    def _is_alive(self, worker_token):
+        """Whether the process still holds its liveness lock, the lock file of a process that is gone is deleted."""
+        if worker_token is None or fcntl is None:
+            return False
+        path = self._liveness_path(worker_token)
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return True
+        try:
+            # Deleted while locked, so no other check takes it for a live process in between
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        finally:
+            os.close(fd)
+        return False
+
+    def _live_worker_tokens(self):
+        """Tokens of the processes holding a liveness lock, deleting the lock files of the ones that are gone."""
+        try:
+            lock_files = os.listdir(self.lock_dir)
+        except FileNotFoundError:
+            return set()
+        worker_tokens = [name[:-len(".lock")] for name in lock_files if name.endswith(".lock")]
+        return {worker_token for worker_token in worker_tokens if self._is_alive(worker_token)}
+
+    def recover_interrupted(self):
+        """Put jobs back in the queue that were running in a process that has since died."""
+        # Called when workers start rather than on construction, a process that merely imports
+        # the app (an image worker, a migration script) must not requeue jobs still running elsewhere
+        self._hold_liveness_lock()
+        # Also clears the lock files of every process that is gone, jobs or not
+        live_worker_tokens = self._live_worker_tokens()
+        connection = self._connection()
+        owners = [row[0] for row in connection.execute(
+            "SELECT DISTINCT claimed_by FROM jobs WHERE status = ?", (JobStatus.RUNNING.value,)
+        )]
+        for owner in owners:
+            if owner == self.worker_token or owner in live_worker_tokens:
+                continue
+            cursor = connection.execute(
+                "UPDATE jobs SET status = ?, claimed_by = NULL, started_at = NULL WHERE status = ? AND claimed_by IS ?",
+                (JobStatus.QUEUED.value, JobStatus.RUNNING.value, owner)
+            )
+            connection.commit()
+            logger.log(level=logging.WARNING, msg=f"Requeued {cursor.rowcount} jobs of a worker that stopped")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_file, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _row_to_job(row):
+        job_id, user_id, kind, payload, status, result, error, created_at, updated_at = row
+        return Job(
+            job_id, user_id, kind, json.loads(payload), JobStatus(status),
+            json.loads(result) if result else None, error, created_at, updated_at
+        )
+
+    def put(self, job):
+        connection = self._connection()
+        connection.execute(
+            f"INSERT INTO jobs ({JOB_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job.job_id, job.user_id, job.kind, json.dumps(job.payload), job.status.value,
+             json.dumps(job.result) if job.result is not None else None, job.error,
+             job.created_at, job.updated_at)
+        )
+        connection.commit()
+
+    def _claim(self):
+        self._hold_liveness_lock()
+        connection = self._connection()
+        # Idle workers of every process poll, a plain read keeps them off the write lock
+        if connection.execute(
+            "SELECT 1 FROM jobs WHERE status = ? LIMIT 1", (JobStatus.QUEUED.value,)
+        ).fetchone() is None:
+            return None
+        with self._claim_lock:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    f"SELECT {JOB_COLUMNS} FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1",
+                    (JobStatus.QUEUED.value,)
+                ).fetchone()
+                if row is None:
+                    connection.commit()
+                    return None
+                job = self._row_to_job(row)
+                job.status = JobStatus.RUNNING
+                job.updated_at = datetime.now().isoformat()
+                connection.execute(
+                    "UPDATE jobs SET status = ?, updated_at = ?, claimed_by = ? WHERE job_id = ?",
+                    (job.status.value, job.updated_at, self.worker_token, job.job_id)
+                )
+                connection.commit()
+                return job
+            except Exception:
+                connection.rollback()
+                raise
+
+    def get_next(self, timeout=1.0):
+        """Claim the next queued job, or return None after timeout seconds."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._claim()
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            time.sleep(self.poll_interval)
+
+    def update(self, job):
+        job.updated_at = datetime.now().isoformat()
+        connection = self._connection()
+        connection.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE job_id = ?",
+            (job.status.value, json.dumps(job.result) if job.result is not None else None,
+             job.error, job.updated_at, job.job_id)
+        )
+        connection.commit()
+
+    def get(self, job_id):
+        row = self._connection().execute(
+            f"SELECT {JOB_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def mark_started(self, job):
+        connection = self._connection()
+        connection.execute(
+            "UPDATE jobs SET started_at = ? WHERE job_id = ?", (datetime.now().isoformat(), job.job_id)
+        )
+        connection.commit()
+
+    def depth(self):
+        """Jobs waiting to start, queued or claimed and held back by the throttle."""
+        row = self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = ? OR (status = ? AND started_at IS NULL)",
+            (JobStatus.QUEUED.value, JobStatus.RUNNING.value)
+        ).fetchone()
+        return row[0]
+
+    def live_processes(self):
+        """Processes whose workers take jobs from this database, counted by their liveness locks."""
+        return max(1, len(self._live_worker_tokens()))
+
+
+class JobQueue:
+    def __init__(self, backend, worker_count=4, throttle=None):
+        self.backend = backend
+        self.worker_count = worker_count
+        # throttle(job) returns 0 when the job may start, otherwise the seconds to wait before asking again
+        self.throttle = throttle
+        self.handlers = {}
+        self._workers = []
+        self._stop_event = threading.Event()
+
+    def register_handler(self, kind, handler):
+        """Register the callable that runs jobs of the given kind."""
+        self.handlers[kind] = handler
+
+    def enqueue(self, user_id, kind, payload):
+        if kind not in self.handlers:
+            raise MyCustomError(f"No handler registered for job kind: {kind}")
+        job = Job.create(user_id, kind, payload)
+        self.backend.put(job)
+        logger.log(level=logging.INFO, msg=f"Queued job {job.job_id} ({kind}) for user {user_id}")
+        return job
+
+    def get_job(self, job_id):
+        return self.backend.get(job_id)
+
+    def capacity(self):
+        """Workers of every process sharing the backend, each process runs worker_count of them."""
+        return self.backend.live_processes() * self.worker_count
+
+    def start(self):
+        self.backend.recover_interrupted()
+        self._stop_event.clear()
+        for index in range(self.worker_count):
+            worker = threading.Thread(
+                target=self._worker_loop, name=f"job-worker-{index}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout=5.0):
+        self._stop_event.set()
+        for worker in self._workers:
+            worker.join(timeout=timeout)
+        self._workers = []
+
+    def run_job(self, job):
+        """Run a claimed job and record its outcome."""
+        started = time.perf_counter()
+        job.on_progress = self.backend.update
+        with trace(job.job_id):
+            try:
+                job.result = self.handlers[job.kind](job)
+                job.status = JobStatus.DONE
+            except Exception as e:
+                logger.log(level=logging.ERROR, msg=f"Job {job.job_id} failed. Error: [{e}]")
+                job.status = JobStatus.FAILED
+                job.error = str(e)
+        JOB_SECONDS.observe(time.perf_counter() - started, kind=job.kind, status=job.status.value)
+        self.backend.update(job)
+        return job
+
+    def _worker_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                job = self.backend.get_next(timeout=1.0)
+            except Exception as e:
+                logger.log(level=logging.ERROR, msg=f"Could not claim the next job. Error: [{e}]")
+                time.sleep(1.0)
+                continue
+            if job is not None:
+                self._wait_for_throttle(job)
+                try:
+                    self.backend.mark_started(job)
+                except Exception as e:
+                    # Only admission reads the mark, the job runs either way
+                    logger.log(level=logging.ERROR, msg=f"Could not mark job {job.job_id} started. Error: [{e}]")
+                self.run_job(job)
+
+    def _wait_for_throttle(self, job):
+        while self.throttle is not None:
+            try:
+                retry_after = self.throttle(job)
+            except Exception as e:
+                # A broken limiter must not stall every job
+                logger.log(level=logging.ERROR, msg=f"Job throttle failed, running {job.job_id}. Error: [{e}]")
+                return
+            # A stopping queue runs the job it already claimed instead of dropping it
+            if not retry_after or self._stop_event.wait(min(retry_after, 1.0)):
+                return
+
+
+def create_job_queue():
+    """Build a JobQueue with the backend selected in JobQueueSettings."""
+    if JobQueueSettings.BACKEND.value == "sqlite":
+        backend = SQLiteJobBackend(JobQueueSettings.DATABASE_FILE.value)
+    else:
+        backend = InMemoryJobBackend()
+    return JobQueue(
+        backend, worker_count=JobQueueSettings.WORKER_COUNT.value,
+        throttle=get_rate_limiter().acquire_global_try_on
+    )
@@ -1,82 +1,107 @@
 import logging
-import os
-import json
 import shutil
 
-from datetime import datetime
-from PIL import Image
-
 from image_handler import ImageManager
-from constants import DirectoryPath
-from utils import Utils
+from image_pipeline import decode_panel_to_shared, make_contact_sheet, merge_side_by_side, merge_with_shared_panel
+from image_workers import SharedPanel, get_image_worker_pool
+from constants import MergeSettings, PreviewSettings
+from metadata_store import get_metadata_store
+from output_storage import get_output_storage
+from result_cache import ResultCache, get_result_cache
+from speculative import CELLS, get_speculative_preprocessor
+from telemetry import span
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+MERGE_BACKEND = "merge"
+# Settings that change the merged output, part of the result cache key
+MERGE_PARAMS = {
+    "panel_width": MergeSettings.PANEL_WIDTH.value,
+    "panel_height": MergeSettings.PANEL_HEIGHT.value,
+    "quality": MergeSettings.JPEG_QUALITY.value,
+    "progressive": MergeSettings.PROGRESSIVE_JPEG.value
+}
+PREVIEW_BACKEND = "merge_preview"
+PREVIEW_PARAMS = {
+    "panel_width": PreviewSettings.PANEL_WIDTH.value,
+    "panel_height": PreviewSettings.PANEL_HEIGHT.value,
+    "quality": PreviewSettings.JPEG_QUALITY.value,
+    "progressive": MergeSettings.PROGRESSIVE_JPEG.value
+}
+
 
 class MergeImages:
-    def __init__(self, user_id):
-        self.output_dir = DirectoryPath.OUTPUT_DIR.value
-        self.output_metadata_dir = DirectoryPath.OUTPUT_METADATA_DIR.value
+    def __init__(self, user_id, preview=False):
+        # A preview is the same merge at a smaller size, sent while the model path runs
+        self.preview = preview
+        self.backend_name = PREVIEW_BACKEND if preview else MERGE_BACKEND
+        self.params = PREVIEW_PARAMS if preview else MERGE_PARAMS
+        self.box = (self.params["panel_width"], self.params["panel_height"])
+        self.quality = self.params["quality"]
+        self.output_storage = get_output_storage()
         self.user_id = user_id
         self.image_manager_obj = ImageManager(user_id)
-        os.makedirs(self.output_dir, exist_ok=True)
+        self.metadata_store = get_metadata_store()
+        self.result_cache = get_result_cache()
+        self.image_workers = get_image_worker_pool()
+        self.speculative = get_speculative_preprocessor()
         pass
 
-    def get_output_path(self):
-        unique_id = Utils.generate_unique_id(
-            f"{self.user_id}_output_{datetime.now().isoformat()}"
-        )
-        return os.path.join(self.output_dir, f"{unique_id}.jpeg")
+    def run_image_task(self, function, *args):
+        # A preview is a few milliseconds of work, done here it cannot queue behind uploads being normalized
+        if self.preview:
+            return function(*args)
+        return self.image_workers.run(function, *args)
 
-    def save_metadata(self, metadata):
-        # Save metadata per user in a JSON file
-        metadata_path = os.path.join(
-            self.output_metadata_dir, f"{self.user_id}_metadata.json"
-        )
+    def map_image_task(self, function, *iterables):
+        if self.preview:
+            return [function(*args) for args in zip(*iterables)]
+        return self.image_workers.map(function, *iterables)
 
-        if os.path.exists(metadata_path):
-            with open(metadata_path, "r") as file:
-                user_metadata = json.load(file)
-        else:
-            user_metadata = []
+    def get_output_path(self):
+        return self.output_storage.new_output_path(self.user_id)
 
-        user_metadata.append(metadata)
-        with open(metadata_path, "w") as file:
-            json.dump(user_metadata, file, indent=4)
+    def save_metadata(self, metadata):
+        # Save metadata per user in the metadata store
+        self.metadata_store.add_output_metadata(self.user_id, metadata)
 
     def copy_image(self, src_path, dest_path):
         """Copy an image from src_path to dest_path."""
         shutil.copy2(src_path, dest_path)
 
-    def merge_images(self):
+    def merge_images(self, person_media_path=None, garment_media_path=None,
+                     person_hash=None, garment_hash=None):
         try:
-            # Fetch input images
-            person_media_path = self.image_manager_obj.fetch_latest_unused_image(
-                "person", get_url=False
+            # Fetch input images unless the caller already claimed them
+            person_media_path, person_hash = self.image_manager_obj.resolve_input_image(
+                "person", person_media_path, person_hash
             )
-            garment_media_path = self.image_manager_obj.fetch_latest_unused_image(
-                "garment", get_url=False
+            garment_media_path, garment_hash = self.image_manager_obj.resolve_input_image(
+                "garment", garment_media_path, garment_hash
             )
-
-            person_image = Image.open(person_media_path)
-            garment_image = Image.open(garment_media_path)
-
-            combined_width = person_image.width + garment_image.width
-            combined_height = max(person_image.height, garment_image.height)
-            combined_image = Image.new('RGB', (combined_width, combined_height))
-            # Paste the images
-            combined_image.paste(person_image, (0, 0))
-            combined_image.paste(garment_image, (person_image.width, 0))
-
             output_path = self.get_output_path()
-            combined_image.save(output_path)
+            cache_key = ResultCache.make_key(person_hash, garment_hash, self.backend_name, self.params)
+            cached = self.result_cache.get(cache_key, output_path)
+
+            if not cached:
+                # Cells prepared when the images arrived leave only the join and the encode
+                input_paths = [person_media_path, garment_media_path]
+                self.speculative.settle(input_paths, CELLS)
+                with span("merge", backend=self.backend_name):
+                    self.run_image_task(
+                        merge_side_by_side, person_media_path, garment_media_path, output_path, self.box, self.quality,
+                        self.speculative.cell_paths(input_paths, self.box)
+                    )
+                self.result_cache.put(cache_key, output_path)
 
             # Save metadata
             metadata = {
                 "person_image": person_media_path,
                 "garment_image": garment_media_path,
-                "output_image": output_path
+                "output_image": output_path,
+                "cached": cached,
+                "preview": self.preview
             }
             self.save_metadata(metadata)
             return output_path
@@ -86,4 +111,73 @@ class MergeImages:
                 msg=f"Got an error while generating the output image. "
                 f"User: {self.user_id} Error: [{e}]"
             )
-            raise e
\ No newline at end of file
+            raise e
+
+    def merge_batch(self, person_media_path, garment_media_paths, person_hash=None, garment_hashes=None):
+        """Merge one person image with each garment, returning the individual outputs and a contact sheet."""
+        try:
+            person_media_path, person_hash = self.image_manager_obj.resolve_input_image(
+                "person", person_media_path, person_hash
+            )
+            garment_hashes = garment_hashes or [None] * len(garment_media_paths)
+            garments = [
+                self.image_manager_obj.resolve_input_image("garment", garment_media_path, garment_hash)
+                for garment_media_path, garment_hash in zip(garment_media_paths, garment_hashes)
+            ]
+            output_paths = [self.get_output_path() for _ in garments]
+            cached = [
+                self.result_cache.get(
+                    ResultCache.make_key(person_hash, garment_hash, self.backend_name, self.params), output_path
+                )
+                for (_, garment_hash), output_path in zip(garments, output_paths)
+            ]
+
+            misses = [index for index, hit in enumerate(cached) if not hit]
+            with span("merge_batch", backend=self.backend_name):
+                if len(misses) == 1:
+                    # A single garment is merged like merge_images, from the cells prepared when the images arrived
+                    input_paths = [person_media_path, garments[misses[0]][0]]
+                    self.speculative.settle(input_paths, CELLS)
+                    self.run_image_task(
+                        merge_side_by_side, person_media_path, garments[misses[0]][0], output_paths[misses[0]],
+                        self.box, self.quality, self.speculative.cell_paths(input_paths, self.box)
+                    )
+                elif misses:
+                    # The person image is decoded once into shared memory, each garment is merged with it in parallel
+                    shared_panel = SharedPanel.allocate((self.box[1], self.box[0], 3))
+                    try:
+                        person_panel = self.run_image_task(
+                            decode_panel_to_shared, person_media_path, shared_panel, self.box
+                        )
+                        self.map_image_task(
+                            merge_with_shared_panel,
+                            [person_panel] * len(misses),
+                            [garments[index][0] for index in misses],
+                            [output_paths[index] for index in misses],
+                            [self.box] * len(misses),
+                            [self.quality] * len(misses)
+                        )
+                    finally:
+                        shared_panel.unlink()
+            for index in misses:
+                cache_key = ResultCache.make_key(person_hash, garments[index][1], self.backend_name, self.params)
+                self.result_cache.put(cache_key, output_paths[index])
+
+            contact_sheet_path = self.run_image_task(make_contact_sheet, output_paths, self.get_output_path())
+            metadata = {
+                "person_image": person_media_path,
+                "garment_images": [garment_media_path for garment_media_path, _ in garments],
+                "output_image": contact_sheet_path,
+                "batch_outputs": output_paths,
+                "cached": cached,
+                "preview": self.preview
+            }
+            self.save_metadata(metadata)
+            return {"contact_sheet": contact_sheet_path, "outputs": output_paths}
+        except Exception as e:
+            logger.log(
+                level=logging.ERROR,
+                msg=f"Got an error while generating the batch output images. "
+                f"User: {self.user_id} Error: [{e}]"
+            )
+            raise e
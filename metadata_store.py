@@ -0,0 +1,780 @@
+import glob
+import logging
+import os
+import json
+import sqlite3
+import threading
+
+from datetime import datetime
+
+from constants import DirectoryPath, MetadataStoreSettings
+from telemetry import timed_operation
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MetadataStore:
+    """SQLite-backed store for image metadata, blobs, the garment catalog and the result cache."""
+
+    def __init__(self, database_file):
+        self.database_file = database_file
+        self._local = threading.local()
+        directory = os.path.dirname(database_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.create_tables()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_file, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def create_tables(self):
+        connection = self._connection()
+        connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS input_images (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                media_url TEXT,
+                image_location TEXT NOT NULL,
+                image_type TEXT,
+                already_used INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL,
+                content_hash TEXT
+            );
+            CREATE INDEX IF NOT EXISTS input_images_lookup
+                ON input_images (user_id, image_type, already_used, created_at);
+
+            CREATE TABLE IF NOT EXISTS output_images (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                output_image TEXT,
+                metadata TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS output_images_user ON output_images (user_id, created_at);
+
+            CREATE TABLE IF NOT EXISTS result_cache (
+                cache_key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS result_cache_last_access ON result_cache (last_access);
+
+            CREATE TABLE IF NOT EXISTS blobs (
+                content_hash TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS blobs_refcount ON blobs (refcount);
+
+            CREATE TABLE IF NOT EXISTS garments (
+                garment_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS processed_messages (
+                message_sid TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                response TEXT NOT NULL,
+                processed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS processed_messages_age ON processed_messages (processed_at);
+
+            CREATE TABLE IF NOT EXISTS output_files (
+                name TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                served_at REAL,
+                input_ids TEXT NOT NULL DEFAULT '[]',
+                inputs_released INTEGER NOT NULL DEFAULT 0,
+                committed INTEGER NOT NULL DEFAULT 0,
+                stored_locally INTEGER NOT NULL DEFAULT 1
+            );
+            CREATE INDEX IF NOT EXISTS output_files_age ON output_files (created_at);
+            CREATE INDEX IF NOT EXISTS output_files_user ON output_files (user_id, created_at);
+            CREATE INDEX IF NOT EXISTS output_files_compaction ON output_files (inputs_released, served_at);
+
+            CREATE TABLE IF NOT EXISTS user_photo_hashes (
+                user_id TEXT NOT NULL,
+                image_type TEXT,
+                match_hash TEXT NOT NULL,
+                perceptual_hash TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (user_id, image_type, match_hash)
+            );
+            CREATE INDEX IF NOT EXISTS user_photo_hashes_age ON user_photo_hashes (created_at);
+
+            CREATE TABLE IF NOT EXISTS pre_uploads (
+                backend TEXT NOT NULL,
+                image_location TEXT NOT NULL,
+                reference TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (backend, image_location)
+            );
+            CREATE INDEX IF NOT EXISTS pre_uploads_expiry ON pre_uploads (expires_at);
+            """
+        )
+        # Columns added after the first release of the schema
+        self._ensure_column("input_images", "content_hash", "TEXT")
+        self._ensure_column("input_images", "match_hash", "TEXT")
+        self._ensure_column("blobs", "perceptual_hash", "TEXT")
+        # Rows written before photos were told apart by type have none and are never matched again
+        self._ensure_column("user_photo_hashes", "image_type", "TEXT")
+        connection.commit()
+
+    def _ensure_column(self, table, column, column_type):
+        connection = self._connection()
+        columns = [row["name"] for row in connection.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    @staticmethod
+    def _input_row_to_dict(row):
+        return {
+            "id": row["id"],
+            "media_url": row["media_url"],
+            "image_location": row["image_location"],
+            "image_type": row["image_type"],
+            "already_used": bool(row["already_used"]),
+            "created_at": row["created_at"],
+            "content_hash": row["content_hash"],
+            # The content hash try-on results are cached under, an earlier near-duplicate's or its own
+            "match_hash": row["match_hash"] or row["content_hash"]
+        }
+
+    @timed_operation
+    def add_input_image(self, user_id, media_url, image_location, image_type=None,
+                        already_used=False, created_at=None, content_hash=None, match_hash=None):
+        connection = self._connection()
+        cursor = connection.execute(
+            "INSERT INTO input_images "
+            "(user_id, media_url, image_location, image_type, already_used, created_at, content_hash, match_hash) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, media_url, image_location, image_type, int(already_used),
+             created_at or datetime.now().isoformat(), content_hash, match_hash)
+        )
+        connection.commit()
+        return cursor.lastrowid
+
+    @timed_operation
+    def list_input_images(self, user_id):
+        rows = self._connection().execute(
+            "SELECT * FROM input_images WHERE user_id = ? ORDER BY created_at, id", (user_id,)
+        ).fetchall()
+        return [self._input_row_to_dict(row) for row in rows]
+
+    @timed_operation
+    def find_latest_unused_image(self, user_id, image_type):
+        """Return the latest unused image of image_type (None matches untyped images)."""
+        row = self._connection().execute(
+            "SELECT * FROM input_images WHERE user_id = ? AND image_type IS ? AND already_used = 0 "
+            "ORDER BY created_at DESC, id DESC LIMIT 1",
+            (user_id, image_type)
+        ).fetchone()
+        return self._input_row_to_dict(row) if row else None
+
+    @timed_operation
+    def count_unused_images(self, user_id):
+        """Return how many unused images the user has of each type, untyped ones under None."""
+        rows = self._connection().execute(
+            "SELECT image_type, COUNT(*) AS unused FROM input_images WHERE user_id = ? AND already_used = 0 "
+            "GROUP BY image_type",
+            (user_id,)
+        ).fetchall()
+        return {row["image_type"]: row["unused"] for row in rows}
+
+    @timed_operation
+    def has_unused_image(self, user_id, image_type):
+        return self.find_latest_unused_image(user_id, image_type) is not None
+
+    @timed_operation
+    def mark_image_as_used(self, image_id):
+        connection = self._connection()
+        connection.execute("UPDATE input_images SET already_used = 1 WHERE id = ?", (image_id,))
+        connection.commit()
+
+    @timed_operation
+    def claim_latest_unused_image(self, user_id, image_type):
+        """Find the latest unused image and mark it as used in one transaction."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            entry = self.find_latest_unused_image(user_id, image_type)
+            if entry is not None:
+                connection.execute("UPDATE input_images SET already_used = 1 WHERE id = ?", (entry["id"],))
+                entry["already_used"] = True
+            connection.commit()
+            return entry
+        except Exception:
+            connection.rollback()
+            raise
+
+    @timed_operation
+    def claim_unused_images(self, user_id, image_type, limit):
+        """Claim up to limit unused images of image_type, newest first, in one transaction."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute(
+                "SELECT * FROM input_images WHERE user_id = ? AND image_type IS ? AND already_used = 0 "
+                "ORDER BY created_at DESC, id DESC LIMIT ?",
+                (user_id, image_type, limit)
+            ).fetchall()
+            entries = [self._input_row_to_dict(row) for row in rows]
+            for entry in entries:
+                connection.execute("UPDATE input_images SET already_used = 1 WHERE id = ?", (entry["id"],))
+                entry["already_used"] = True
+            connection.commit()
+            return entries
+        except Exception:
+            connection.rollback()
+            raise
+
+    @timed_operation
+    def claim_try_on_images(self, user_id, garment_limit):
+        """Claim the latest unused person image and up to garment_limit unused garments, newest first.
+
+        Claims all of them in one transaction, or nothing when either kind is missing.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            entries = {}
+            for image_type, limit in (("person", 1), ("garment", garment_limit)):
+                rows = connection.execute(
+                    "SELECT * FROM input_images WHERE user_id = ? AND image_type = ? AND already_used = 0 "
+                    "ORDER BY created_at DESC, id DESC LIMIT ?",
+                    (user_id, image_type, limit)
+                ).fetchall()
+                entries[image_type] = [self._input_row_to_dict(row) for row in rows]
+            if not entries["person"] or not entries["garment"]:
+                connection.commit()
+                return None, []
+            for entry in entries["person"] + entries["garment"]:
+                connection.execute("UPDATE input_images SET already_used = 1 WHERE id = ?", (entry["id"],))
+                entry["already_used"] = True
+            connection.commit()
+            return entries["person"][0], entries["garment"]
+        except Exception:
+            connection.rollback()
+            raise
+
+    @timed_operation
+    def unclaim_images(self, image_ids):
+        """Mark claimed images unused again, for a try-on that could not be started."""
+        connection = self._connection()
+        connection.executemany(
+            "UPDATE input_images SET already_used = 0 WHERE id = ?", [(image_id,) for image_id in image_ids]
+        )
+        connection.commit()
+
+    @timed_operation
+    def retype_latest_unused_image(self, user_id, old_image_type, new_image_type):
+        """Change the type of the latest unused image of old_image_type in one transaction."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            entry = self.find_latest_unused_image(user_id, old_image_type)
+            if entry is not None:
+                connection.execute(
+                    "UPDATE input_images SET image_type = ? WHERE id = ?", (new_image_type, entry["id"])
+                )
+                entry["image_type"] = new_image_type
+            connection.commit()
+            return entry
+        except Exception:
+            connection.rollback()
+            raise
+
+    @timed_operation
+    def retype_unused_images(self, user_id, old_image_type, new_image_type):
+        """Change the type of every unused image of old_image_type, returning how many changed."""
+        connection = self._connection()
+        cursor = connection.execute(
+            "UPDATE input_images SET image_type = ? WHERE user_id = ? AND image_type IS ? AND already_used = 0",
+            (new_image_type, user_id, old_image_type)
+        )
+        connection.commit()
+        return cursor.rowcount
+
+    @timed_operation
+    def update_input_image(self, image_id, image_location, image_type):
+        connection = self._connection()
+        connection.execute(
+            "UPDATE input_images SET image_location = ?, image_type = ? WHERE id = ?",
+            (image_location, image_type, image_id)
+        )
+        connection.commit()
+
+    @timed_operation
+    def add_output_metadata(self, user_id, metadata, created_at=None):
+        connection = self._connection()
+        connection.execute(
+            "INSERT INTO output_images (user_id, output_image, metadata, created_at) VALUES (?, ?, ?, ?)",
+            (user_id, metadata.get("output_image"), json.dumps(metadata),
+             created_at or datetime.now().isoformat())
+        )
+        connection.commit()
+
+    @timed_operation
+    def list_output_metadata(self, user_id):
+        rows = self._connection().execute(
+            "SELECT metadata FROM output_images WHERE user_id = ? ORDER BY created_at, id", (user_id,)
+        ).fetchall()
+        return [json.loads(row["metadata"]) for row in rows]
+
+    @timed_operation
+    def get_cache_entry(self, cache_key):
+        row = self._connection().execute(
+            "SELECT * FROM result_cache WHERE cache_key = ?", (cache_key,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    @timed_operation
+    def put_cache_entry(self, cache_key, path, size, last_access):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO result_cache (cache_key, path, size, last_access) VALUES (?, ?, ?, ?)",
+            (cache_key, path, size, last_access)
+        )
+        connection.commit()
+
+    @timed_operation
+    def touch_cache_entry(self, cache_key, last_access):
+        connection = self._connection()
+        connection.execute(
+            "UPDATE result_cache SET last_access = ? WHERE cache_key = ?", (last_access, cache_key)
+        )
+        connection.commit()
+
+    @timed_operation
+    def delete_cache_entry(self, cache_key):
+        connection = self._connection()
+        connection.execute("DELETE FROM result_cache WHERE cache_key = ?", (cache_key,))
+        connection.commit()
+
+    @timed_operation
+    def cache_total_bytes(self):
+        row = self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM result_cache").fetchone()
+        return row[0]
+
+    @timed_operation
+    def least_recently_used_cache_entries(self, limit):
+        rows = self._connection().execute(
+            "SELECT * FROM result_cache ORDER BY last_access LIMIT ?", (limit,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    @timed_operation
+    def delete_input_image(self, image_id):
+        """Delete an input entry, returning its content hash so the blob reference can be released."""
+        connection = self._connection()
+        row = connection.execute("SELECT content_hash FROM input_images WHERE id = ?", (image_id,)).fetchone()
+        connection.execute("DELETE FROM input_images WHERE id = ?", (image_id,))
+        connection.commit()
+        return row["content_hash"] if row else None
+
+    @timed_operation
+    def add_blob_reference(self, content_hash, path, size, perceptual_hash=None):
+        """Register the blob if needed and take one reference on it."""
+        connection = self._connection()
+        connection.execute(
+            "INSERT INTO blobs (content_hash, path, size, refcount, created_at, perceptual_hash) "
+            "VALUES (?, ?, ?, 1, ?, ?) "
+            "ON CONFLICT(content_hash) DO UPDATE SET refcount = refcount + 1, "
+            "perceptual_hash = COALESCE(perceptual_hash, excluded.perceptual_hash)",
+            (content_hash, path, size, datetime.now().isoformat(), perceptual_hash)
+        )
+        connection.commit()
+
+    @timed_operation
+    def set_blob_perceptual_hash(self, content_hash, perceptual_hash):
+        connection = self._connection()
+        connection.execute(
+            "UPDATE blobs SET perceptual_hash = ? WHERE content_hash = ?", (perceptual_hash, content_hash)
+        )
+        connection.commit()
+
+    @timed_operation
+    def release_blob_reference(self, content_hash):
+        connection = self._connection()
+        connection.execute(
+            "UPDATE blobs SET refcount = MAX(refcount - 1, 0) WHERE content_hash = ?", (content_hash,)
+        )
+        connection.commit()
+
+    @timed_operation
+    def get_blob(self, content_hash):
+        row = self._connection().execute(
+            "SELECT * FROM blobs WHERE content_hash = ?", (content_hash,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    @timed_operation
+    def unreferenced_blobs(self):
+        rows = self._connection().execute("SELECT * FROM blobs WHERE refcount = 0").fetchall()
+        return [dict(row) for row in rows]
+
+    @timed_operation
+    def delete_blob(self, content_hash):
+        """Delete the blob row unless it was referenced again in the meantime."""
+        connection = self._connection()
+        cursor = connection.execute(
+            "DELETE FROM blobs WHERE content_hash = ? AND refcount = 0", (content_hash,)
+        )
+        connection.commit()
+        return cursor.rowcount > 0
+
+    @timed_operation
+    def add_garment(self, garment_id, name, content_hash):
+        connection = self._connection()
+        created_at = datetime.now().isoformat()
+        connection.execute(
+            "INSERT INTO garments (garment_id, name, content_hash, created_at) VALUES (?, ?, ?, ?)",
+            (garment_id, name, content_hash, created_at)
+        )
+        connection.commit()
+        return {"garment_id": garment_id, "name": name, "content_hash": content_hash, "created_at": created_at}
+
+    @timed_operation
+    def get_garment(self, garment_id):
+        row = self._connection().execute(
+            "SELECT * FROM garments WHERE garment_id = ?", (garment_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    @timed_operation
+    def list_garments(self):
+        rows = self._connection().execute("SELECT * FROM garments ORDER BY created_at").fetchall()
+        return [dict(row) for row in rows]
+
+    @timed_operation
+    def delete_garment(self, garment_id):
+        connection = self._connection()
+        connection.execute("DELETE FROM garments WHERE garment_id = ?", (garment_id,))
+        connection.commit()
+
+    @timed_operation
+    def catalog_signature(self):
+        """Changes whenever a garment is added to or deleted from the catalog, or gets its perceptual hash."""
+        row = self._connection().execute(
+            "SELECT COUNT(*), MAX(garments.created_at), COUNT(blobs.perceptual_hash) FROM garments "
+            "LEFT JOIN blobs ON blobs.content_hash = garments.content_hash"
+        ).fetchone()
+        return row[0], row[1], row[2]
+
+    @timed_operation
+    def catalog_perceptual_hashes(self):
+        """Every catalog garment's content hash, blob path and perceptual hash (None if not computed yet)."""
+        rows = self._connection().execute(
+            "SELECT DISTINCT garments.content_hash, blobs.path, blobs.perceptual_hash FROM garments "
+            "JOIN blobs ON blobs.content_hash = garments.content_hash"
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    @timed_operation
+    def list_user_photo_hashes(self, user_id, image_type):
+        rows = self._connection().execute(
+            "SELECT match_hash, perceptual_hash FROM user_photo_hashes WHERE user_id = ? AND image_type = ?",
+            (user_id, image_type)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    @timed_operation
+    def add_user_photo_hash(self, user_id, image_type, match_hash, perceptual_hash, created_at):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR IGNORE INTO user_photo_hashes (user_id, image_type, match_hash, perceptual_hash, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id, image_type, match_hash, perceptual_hash, created_at)
+        )
+        connection.commit()
+
+    @timed_operation
+    def prune_user_photo_hashes(self, older_than):
+        connection = self._connection()
+        cursor = connection.execute("DELETE FROM user_photo_hashes WHERE created_at < ?", (older_than,))
+        connection.commit()
+        return cursor.rowcount
+
+    @timed_operation
+    def put_pre_upload(self, backend, image_location, reference, expires_at):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO pre_uploads (backend, image_location, reference, expires_at) VALUES (?, ?, ?, ?)",
+            (backend, image_location, reference, expires_at)
+        )
+        connection.commit()
+
+    @timed_operation
+    def get_pre_upload(self, backend, image_location, now):
+        """The reference an input was uploaded to backend under ahead of its try-on, None if none is current."""
+        row = self._connection().execute(
+            "SELECT reference FROM pre_uploads WHERE backend = ? AND image_location = ? AND expires_at > ?",
+            (backend, image_location, now)
+        ).fetchone()
+        return row["reference"] if row else None
+
+    @timed_operation
+    def delete_pre_uploads(self, backend, image_locations):
+        connection = self._connection()
+        connection.executemany(
+            "DELETE FROM pre_uploads WHERE backend = ? AND image_location = ?",
+            [(backend, image_location) for image_location in image_locations]
+        )
+        connection.commit()
+
+    @timed_operation
+    def prune_pre_uploads(self, now):
+        connection = self._connection()
+        cursor = connection.execute("DELETE FROM pre_uploads WHERE expires_at <= ?", (now,))
+        connection.commit()
+        return cursor.rowcount
+
+    @timed_operation
+    def get_message_response(self, message_sid):
+        """Return the reply already sent for a Twilio message, or None if it was never processed."""
+        row = self._connection().execute(
+            "SELECT response FROM processed_messages WHERE message_sid = ?", (message_sid,)
+        ).fetchone()
+        return row["response"] if row else None
+
+    @timed_operation
+    def save_message_response(self, message_sid, user_id, response, processed_at):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO processed_messages (message_sid, user_id, response, processed_at) "
+            "VALUES (?, ?, ?, ?)",
+            (message_sid, user_id, response, processed_at)
+        )
+        connection.commit()
+
+    @timed_operation
+    def prune_message_responses(self, older_than):
+        connection = self._connection()
+        cursor = connection.execute("DELETE FROM processed_messages WHERE processed_at < ?", (older_than,))
+        connection.commit()
+        return cursor.rowcount
+
+    @staticmethod
+    def _output_row_to_dict(row):
+        return dict(row, input_ids=json.loads(row["input_ids"]))
+
+    @timed_operation
+    def add_pending_output(self, name, user_id, created_at):
+        """Record an output name as soon as it is handed out, so a job that dies before committing leaks nothing."""
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR IGNORE INTO output_files (name, user_id, size, created_at) VALUES (?, ?, 0, ?)",
+            (name, user_id, created_at)
+        )
+        connection.commit()
+
+    @timed_operation
+    def commit_output_file(self, name, user_id, size, created_at, input_ids=()):
+        connection = self._connection()
+        connection.execute(
+            "INSERT INTO output_files (name, user_id, size, created_at, input_ids, committed) "
+            "VALUES (?, ?, ?, ?, ?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET size = excluded.size, input_ids = excluded.input_ids, committed = 1",
+            (name, user_id, size, created_at, json.dumps(list(input_ids)))
+        )
+        connection.commit()
+
+    @timed_operation
+    def get_output_file(self, name):
+        row = self._connection().execute("SELECT * FROM output_files WHERE name = ?", (name,)).fetchone()
+        return self._output_row_to_dict(row) if row else None
+
+    @timed_operation
+    def mark_output_served(self, name, served_at):
+        """Record the first fetch of an output, later fetches leave it alone."""
+        connection = self._connection()
+        connection.execute(
+            "UPDATE output_files SET served_at = ? WHERE name = ? AND served_at IS NULL", (served_at, name)
+        )
+        connection.commit()
+
+    @timed_operation
+    def mark_output_remote_only(self, name):
+        connection = self._connection()
+        connection.execute("UPDATE output_files SET stored_locally = 0 WHERE name = ?", (name,))
+        connection.commit()
+
+    @timed_operation
+    def served_outputs_holding_inputs(self, limit):
+        """Served outputs whose input images have not been released yet."""
+        rows = self._connection().execute(
+            "SELECT * FROM output_files WHERE inputs_released = 0 AND served_at IS NOT NULL AND committed = 1 "
+            "LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [self._output_row_to_dict(row) for row in rows]
+
+    @timed_operation
+    def release_output_inputs(self, name, input_ids):
+        """Delete the used input entries an output was made from in one transaction, returning their content hashes."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            content_hashes = []
+            for image_id in input_ids:
+                row = connection.execute(
+                    "SELECT content_hash FROM input_images WHERE id = ? AND already_used = 1", (image_id,)
+                ).fetchone()
+                if row is None:
+                    continue
+                connection.execute("DELETE FROM input_images WHERE id = ?", (image_id,))
+                if row["content_hash"]:
+                    content_hashes.append(row["content_hash"])
+            connection.execute("UPDATE output_files SET inputs_released = 1 WHERE name = ?", (name,))
+            connection.commit()
+            return content_hashes
+        except Exception:
+            connection.rollback()
+            raise
+
+    @timed_operation
+    def delete_unused_inputs_before(self, created_before, limit):
+        """Delete up to limit never-used input entries created before created_before, returning their content hashes.
+
+        Entries recorded before content hashing have None in their place.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute(
+                "SELECT id, content_hash FROM input_images WHERE already_used = 0 AND created_at < ? LIMIT ?",
+                (created_before, limit)
+            ).fetchall()
+            connection.executemany("DELETE FROM input_images WHERE id = ?", [(row["id"],) for row in rows])
+            connection.commit()
+            return [row["content_hash"] for row in rows]
+        except Exception:
+            connection.rollback()
+            raise
+
+    @timed_operation
+    def outputs_created_before(self, created_before, limit, committed=True):
+        rows = self._connection().execute(
+            "SELECT * FROM output_files WHERE committed = ? AND created_at < ? ORDER BY created_at LIMIT ?",
+            (int(committed), created_before, limit)
+        ).fetchall()
+        return [self._output_row_to_dict(row) for row in rows]
+
+    @timed_operation
+    def local_outputs_created_before(self, created_before, limit):
+        """Committed outputs that still have a local copy, oldest first."""
+        rows = self._connection().execute(
+            "SELECT * FROM output_files WHERE stored_locally = 1 AND committed = 1 AND created_at < ? "
+            "ORDER BY created_at LIMIT ?",
+            (created_before, limit)
+        ).fetchall()
+        return [self._output_row_to_dict(row) for row in rows]
+
+    @timed_operation
+    def output_bytes_by_user(self, more_than):
+        """{user_id: bytes} for the users storing more than more_than bytes of outputs."""
+        rows = self._connection().execute(
+            "SELECT user_id, SUM(size) AS total FROM output_files GROUP BY user_id HAVING total > ?", (more_than,)
+        ).fetchall()
+        return {row["user_id"]: row["total"] for row in rows}
+
+    @timed_operation
+    def output_total_bytes(self):
+        row = self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM output_files").fetchone()
+        return row[0]
+
+    @timed_operation
+    def oldest_outputs(self, limit, user_id=None):
+        if user_id is None:
+            rows = self._connection().execute(
+                "SELECT * FROM output_files WHERE committed = 1 ORDER BY created_at LIMIT ?", (limit,)
+            ).fetchall()
+        else:
+            rows = self._connection().execute(
+                "SELECT * FROM output_files WHERE committed = 1 AND user_id = ? ORDER BY created_at LIMIT ?",
+                (user_id, limit)
+            ).fetchall()
+        return [self._output_row_to_dict(row) for row in rows]
+
+    @timed_operation
+    def delete_output_file(self, name):
+        connection = self._connection()
+        connection.execute("DELETE FROM output_files WHERE name = ?", (name,))
+        connection.commit()
+
+    def migrate_json_metadata(self):
+        """Import the legacy per-user JSON files once, renaming each to *.migrated."""
+        counts = {"input_images": 0, "output_images": 0}
+        connection = self._connection()
+
+        def load(path):
+            with open(path, "r") as file:
+                return json.load(file)
+
+        def mark_migrated(path):
+            os.rename(path, f"{path}.migrated")
+
+        suffix = "_metadata.json"
+        for path in glob.glob(os.path.join(DirectoryPath.INPUT_METADATA_DIR.value, f"*{suffix}")):
+            user_id = os.path.basename(path)[:-len(suffix)]
+            for entry in load(path):
+                connection.execute(
+                    "INSERT INTO input_images (user_id, media_url, image_location, image_type, already_used, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, entry.get("media_url"), entry["image_location"], entry.get("image_type"),
+                     int(entry.get("already_used", False)),
+                     datetime.fromtimestamp(os.path.getmtime(path)).isoformat())
+                )
+                counts["input_images"] += 1
+            connection.commit()
+            mark_migrated(path)
+
+        for path in glob.glob(os.path.join(DirectoryPath.OUTPUT_METADATA_DIR.value, f"*{suffix}")):
+            user_id = os.path.basename(path)[:-len(suffix)]
+            for entry in load(path):
+                connection.execute(
+                    "INSERT INTO output_images (user_id, output_image, metadata, created_at) VALUES (?, ?, ?, ?)",
+                    (user_id, entry.get("output_image"), json.dumps(entry),
+                     datetime.fromtimestamp(os.path.getmtime(path)).isoformat())
+                )
+                counts["output_images"] += 1
+            connection.commit()
+            mark_migrated(path)
+
+        logger.log(level=logging.INFO, msg=f"Migrated JSON metadata into {self.database_file}: {counts}")
+        return counts
+
+
+_metadata_store = None
+_metadata_store_lock = threading.Lock()
+
+
+def get_metadata_store():
+    """Return the process-wide MetadataStore."""
+    global _metadata_store
+    if _metadata_store is None:
+        with _metadata_store_lock:
+            if _metadata_store is None:
+                _metadata_store = MetadataStore(MetadataStoreSettings.DATABASE_FILE.value)
+    return _metadata_store
+
+
+if __name__ == "__main__":
+    # One-shot migration of the legacy JSON metadata files
+    print(get_metadata_store().migrate_json_metadata())
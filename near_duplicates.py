@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+
+from constants import NearDuplicateSettings
+from image_pipeline import perceptual_hash_file
+from metadata_store import get_metadata_store
+from telemetry import NEAR_DUPLICATES
+from utils import MyCustomError
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def hamming_distance(first, second):
+    return (first ^ second).bit_count()
+
+
+class HammingIndex:
+    """Integer hashes of a fixed number of bits, finding every one within max_distance bits of a query.
+
+    Each hash is cut into max_distance + 1 bands. Two hashes that differ in at most max_distance bits
+    are equal in at least one band, so a search only compares the query with the hashes that share a
+    band with it. A BK-tree prunes nothing at this size: random 256-bit hashes are all about 128 bits
+    apart, and the search ends up visiting most of the tree.
+    """
+
+    def __init__(self, bits, max_distance):
+        self.max_distance = max_distance
+        band_count = max_distance + 1
+        if band_count > bits:
+            raise MyCustomError(f"A {bits} bit hash cannot be searched within {max_distance} bits")
+        # The first bits % band_count bands get one bit more
+        self._bands = []
+        shift = 0
+        for index in range(band_count):
+            width = bits // band_count + (1 if index < bits % band_count else 0)
+            self._bands.append((shift, (1 << width) - 1))
+            shift += width
+        self._buckets = [{} for _ in self._bands]
+        self._items = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, value, item):
+        """Add a hash, an equal one already in the index keeps its item."""
+        if value in self._items:
+            return
+        self._items[value] = item
+        for buckets, (shift, mask) in zip(self._buckets, self._bands):
+            buckets.setdefault((value >> shift) & mask, []).append(value)
+
+    def search(self, value):
+        """Return (distance, item) for every hash within max_distance of value, nearest first."""
+        candidates = set()
+        for buckets, (shift, mask) in zip(self._buckets, self._bands):
+            candidates.update(buckets.get((value >> shift) & mask, ()))
+        matches = []
+        for candidate in candidates:
+            distance = hamming_distance(value, candidate)
+            if distance <= self.max_distance:
+                matches.append((distance, self._items[candidate]))
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+class NearDuplicateIndex:
+    """Finds the earlier photo an upload is a recompressed or resized copy of, so its results can be reused.
+
+    A user's photos are kept in the metadata store, one row per distinct photo, and read on each lookup
+    so every worker process sees the others' uploads. The garment catalog is shared by everyone and
+    grows large, it is held in a HammingIndex per process and rebuilt when the catalog changes.
+    """
+
+    def __init__(self, store, max_distance=NearDuplicateSettings.MAX_DISTANCE.value,
+                 hash_bits=NearDuplicateSettings.HASH_SIZE.value ** 2, enabled=NearDuplicateSettings.ENABLED.value):
+        self.store = store
+        self.max_distance = max_distance
+        self.hash_bits = hash_bits
+        self.enabled = enabled
+        self._catalog_index = HammingIndex(self.hash_bits, self.max_distance)
+        self._catalog_signature = None
+        self._catalog_lock = threading.Lock()
+
+    def catalog_index(self):
+        signature = self.store.catalog_signature()
+        if signature != self._catalog_signature:
+            with self._catalog_lock:
+                if signature != self._catalog_signature:
+                    index = HammingIndex(self.hash_bits, self.max_distance)
+                    for garment in self.store.catalog_perceptual_hashes():
+                        # Garments ingested before perceptual hashing join once backfill_catalog() reaches them
+                        if garment["perceptual_hash"] is not None:
+                            index.add(int(garment["perceptual_hash"], 16), garment["content_hash"])
+                    self._catalog_index, self._catalog_signature = index, signature
+        return self._catalog_index
+
+    def backfill_catalog(self):
+        """Hash the catalog garments stored without a perceptual hash, returning how many.
+
+        Decodes every such garment, so it runs in the storage sweep and at catalog ingest, never on a webhook.
+        """
+        hashed = 0
+        for garment in self.store.catalog_perceptual_hashes():
+            if garment["perceptual_hash"] is not None:
+                continue
+            try:
+                perceptual_hash = perceptual_hash_file(garment["path"])
+            except Exception as e:
+                logger.log(level=logging.ERROR, msg=f"Could not hash catalog garment {garment['content_hash'][:12]}. "
+                           f"Error: [{e}]")
+                continue
+            self.store.set_blob_perceptual_hash(garment["content_hash"], perceptual_hash)
+            hashed += 1
+        return hashed
+
+    def nearest(self, user_id, image_type, perceptual_hash):
+        """Return (source, match hash) of the nearest earlier photo of image_type within max_distance, or None."""
+        value = int(perceptual_hash, 16)
+        best = None
+        for photo in self.store.list_user_photo_hashes(user_id, image_type):
+            distance = hamming_distance(value, int(photo["perceptual_hash"], 16))
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, "user", photo["match_hash"])
+        if image_type == "garment":
+            catalog_matches = self.catalog_index().search(value)
+            if catalog_matches and (best is None or catalog_matches[0][0] < best[0]):
+                best = (catalog_matches[0][0], "catalog", catalog_matches[0][1])
+        return best[1:] if best else None
+
+    def match(self, user_id, content_hash, image_type):
+        """Return the content hash the results of this upload are cached under.
+
+        That is the content hash of the nearest near-duplicate of the same type the user sent or, for
+        a garment, the catalog holds. Otherwise it is the upload's own, which then becomes the one later
+        copies of the photo match. An upload without a type is matched by its exact content only, its
+        type may still change.
+        """
+        if not self.enabled or image_type not in ("person", "garment"):
+            return content_hash
+        blob = self.store.get_blob(content_hash)
+        perceptual_hash = blob["perceptual_hash"] if blob else None
+        # A flat image has few brighter-than-left pixels, its hash says too little to match on
+        if perceptual_hash is None or int(perceptual_hash, 16).bit_count() < self.hash_bits // 8:
+            return content_hash
+        nearest = self.nearest(user_id, image_type, perceptual_hash)
+        if nearest is not None:
+            source, match_hash = nearest
+            if match_hash != content_hash:
+                NEAR_DUPLICATES.inc(source=source)
+                logger.log(level=logging.INFO, msg=f"Upload {content_hash[:12]} of {user_id} is a near-duplicate "
+                           f"of {source} photo {match_hash[:12]}")
+            return match_hash
+        self.store.add_user_photo_hash(user_id, image_type, content_hash, perceptual_hash, time.time())
+        return content_hash
+
+    def prune(self, older_than):
+        """Forget users' photos first sent before older_than, returning how many."""
+        return self.store.prune_user_photo_hashes(older_than)
+
+
+_near_duplicate_index = None
+_near_duplicate_index_lock = threading.Lock()
+
+
+def get_near_duplicate_index():
+    """Return the process-wide NearDuplicateIndex."""
+    global _near_duplicate_index
+    if _near_duplicate_index is None:
+        with _near_duplicate_index_lock:
+            if _near_duplicate_index is None:
+                _near_duplicate_index = NearDuplicateIndex(get_metadata_store())
+    return _near_duplicate_index
@@ -0,0 +1,189 @@
+import logging
+import os
+import threading
+import time
+import uuid
+
+from datetime import datetime
+
+from cluster import get_cluster
+from constants import DirectoryPath, StorageSettings, TokensAndURLs
+from image_serving import LRUCache
+from metadata_store import get_metadata_store
+from utils import MyCustomError, Utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class LocalOutputBackend:
+    """Outputs live only in the local output directory."""
+    name = "local"
+    remote = False
+
+    def upload(self, path, image_name):
+        pass
+
+    def delete(self, image_name):
+        pass
+
+    def url(self, image_name):
+        return None
+
+
+class S3OutputBackend:
+    """Copies outputs to an S3-compatible bucket and hands out presigned URLs for them."""
+    name = "s3"
+    remote = True
+
+    def __init__(self, bucket, prefix="", client=None, endpoint_url=None,
+                 url_expiry_seconds=StorageSettings.S3_URL_EXPIRY_SECONDS.value):
+        if not bucket:
+            raise MyCustomError("The s3 output backend needs OUTPUT_S3_BUCKET")
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise MyCustomError("The s3 output backend needs boto3, install it with pip install boto3")
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client
+        self.url_expiry_seconds = url_expiry_seconds
+
+    def _key(self, image_name):
+        return f"{self.prefix}{image_name}"
+
+    def upload(self, path, image_name):
+        self.client.upload_file(
+            path, self.bucket, self._key(image_name), ExtraArgs={"ContentType": "image/jpeg"}
+        )
+
+    def delete(self, image_name):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(image_name))
+
+    def url(self, image_name):
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": self._key(image_name)},
+            ExpiresIn=self.url_expiry_seconds
+        )
+
+
+class OutputStorage:
+    """Output images in a sharded local directory, tracked in the metadata store for the lifecycle sweep.
+
+    Names are handed out (and recorded as pending) before the image is written, commit() records the
+    finished file and copies it to the backend. Media URLs always point at /get_image, which serves the
+    local copy or redirects to the backend, so a URL keeps working after the local copy is dropped.
+    """
+
+    def __init__(self, output_dir, store, backend=None, served_cache_entries=4096):
+        self.output_dir = output_dir
+        self.store = store
+        self.backend = backend or LocalOutputBackend()
+        # Names already marked served by this process, so repeat fetches skip the write
+        self._served = LRUCache(served_cache_entries)
+        os.makedirs(output_dir, exist_ok=True)
+
+    def path(self, image_name):
+        return os.path.join(self.output_dir, image_name[:2], image_name[2:4], image_name)
+
+    def legacy_path(self, image_name):
+        """Where outputs were written before the directory was sharded."""
+        return os.path.join(self.output_dir, image_name)
+
+    def new_output_path(self, user_id):
+        unique_id = Utils.generate_unique_id(
+            # The random suffix keeps names distinct when a batch asks for several within one clock tick
+            f"{user_id}_output_{datetime.now().isoformat()}_{uuid.uuid4().hex}"
+        )
+        image_name = f"{unique_id}{get_cluster().output_suffix()}.jpeg"
+        self.store.add_pending_output(image_name, user_id, time.time())
+        path = self.path(image_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def commit(self, path, user_id, input_ids=()):
+        """Record a finished output, input_ids are released by the sweep once it has been fetched."""
+        image_name = os.path.basename(path)
+        self.backend.upload(path, image_name)
+        self.store.commit_output_file(image_name, user_id, os.path.getsize(path), time.time(), input_ids)
+        return image_name
+
+    def media_url(self, image_name):
+        return f"{TokensAndURLs.BASE_URL.value}/get_image/{image_name}"
+
+    def remote_url(self, image_name):
+        """A backend URL for an output without a local copy, None if there is none."""
+        if not self.backend.remote:
+            return None
+        entry = self.store.get_output_file(image_name)
+        if entry is None or not entry["committed"]:
+            return None
+        return self.backend.url(image_name)
+
+    def mark_served(self, image_name):
+        if self._served.get(image_name):
+            return
+        self.store.mark_output_served(image_name, time.time())
+        self._served.put(image_name, True)
+
+    def _remove_local(self, image_name):
+        for path in (self.path(image_name), self.legacy_path(image_name)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def drop_local_copy(self, image_name):
+        """Keep only the backend copy of an output."""
+        self.store.mark_output_remote_only(image_name)
+        self._remove_local(image_name)
+
+    def delete(self, entry):
+        """Delete an output everywhere, returning the bytes it held."""
+        image_name = entry["name"]
+        if entry["committed"]:
+            self.backend.delete(image_name)
+        self._remove_local(image_name)
+        self.store.delete_output_file(image_name)
+        return entry["size"]
+
+    def adopt_legacy_outputs(self, limit):
+        """Track up to limit outputs left in the unsharded directory by earlier releases, returning how many."""
+        adopted = 0
+        with os.scandir(self.output_dir) as entries:
+            for entry in entries:
+                if adopted >= limit:
+                    break
+                if not entry.is_file() or self.store.get_output_file(entry.name) is not None:
+                    continue
+                stat = entry.stat()
+                self.backend.upload(entry.path, entry.name)
+                # The owner is not known, quotas only apply to them globally
+                self.store.commit_output_file(entry.name, "", stat.st_size, stat.st_mtime)
+                adopted += 1
+        return adopted
+
+
+def create_output_backend():
+    if StorageSettings.OUTPUT_BACKEND.value == "s3":
+        return S3OutputBackend(
+            StorageSettings.S3_BUCKET.value, StorageSettings.S3_PREFIX.value,
+            endpoint_url=StorageSettings.S3_ENDPOINT_URL.value
+        )
+    return LocalOutputBackend()
+
+
+_output_storage = None
+_output_storage_lock = threading.Lock()
+
+
+def get_output_storage():
+    """Return the process-wide OutputStorage."""
+    global _output_storage
+    if _output_storage is None:
+        with _output_storage_lock:
+            if _output_storage is None:
+                _output_storage = OutputStorage(
+                    DirectoryPath.OUTPUT_DIR.value, get_metadata_store(), create_output_backend()
+                )
+    return _output_storage
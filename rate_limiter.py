@@ -0,0 +1,149 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from cluster import get_cluster
+from constants import RateLimitSettings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ADMIT = "admit"
+BUSY = "busy"
+SHED = "shed"
+
+
+class TokenBucketLimiter:
+    """Token buckets kept in SQLite, so every worker process draws from the same buckets.
+
+    A bucket holds up to burst tokens and refills at rate tokens per second. Each bucket is
+    one row, read, refilled and charged in a single write transaction.
+    """
+
+    def __init__(self, database_file):
+        self.database_file = database_file
+        self._local = threading.local()
+        directory = os.path.dirname(database_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS token_buckets (
+                bucket_key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_file, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def try_acquire(self, bucket_key, rate, burst, cost=1.0, now=None):
+        """Take cost tokens if the bucket has them, returning 0.0, or the seconds until it will."""
+        now = time.time() if now is None else now
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated_at FROM token_buckets WHERE bucket_key = ?", (bucket_key,)
+            ).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+            if tokens >= cost:
+                tokens -= cost
+                retry_after = 0.0
+            else:
+                retry_after = (cost - tokens) / rate
+            connection.execute(
+                "INSERT INTO token_buckets (bucket_key, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(bucket_key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (bucket_key, tokens, now)
+            )
+            connection.commit()
+            return retry_after
+        except Exception:
+            connection.rollback()
+            raise
+
+    def prune(self, older_than):
+        """Drop buckets untouched since older_than, they would be full again anyway."""
+        connection = self._connection()
+        cursor = connection.execute("DELETE FROM token_buckets WHERE updated_at < ?", (older_than,))
+        connection.commit()
+        return cursor.rowcount
+
+    def acquire_user_message(self, user_id):
+        if not RateLimitSettings.ENABLED.value:
+            return 0.0
+        return self.try_acquire(
+            f"messages:{user_id}", RateLimitSettings.USER_MESSAGES_PER_MINUTE.value / 60,
+            RateLimitSettings.USER_MESSAGE_BURST.value
+        )
+
+    def acquire_user_try_on(self, user_id):
+        if not RateLimitSettings.ENABLED.value:
+            return 0.0
+        return self.try_acquire(
+            f"try_ons:{user_id}", RateLimitSettings.USER_TRY_ONS_PER_MINUTE.value / 60,
+            RateLimitSettings.USER_TRY_ON_BURST.value
+        )
+
+    @staticmethod
+    def global_try_on_share():
+        """(rate per second, burst) of the global try-on limit that this node's jobs start under."""
+        # Every node keeps its own buckets, so each gets an equal share of the global limit
+        nodes = max(1, len(get_cluster().nodes))
+        return (RateLimitSettings.GLOBAL_TRY_ONS_PER_MINUTE.value / 60 / nodes,
+                max(1.0, RateLimitSettings.GLOBAL_TRY_ON_BURST.value / nodes))
+
+    def acquire_global_try_on(self, job=None):
+        if not RateLimitSettings.ENABLED.value:
+            return 0.0
+        rate, burst = self.global_try_on_share()
+        return self.try_acquire("try_ons:global", rate, burst)
+
+
+def admit_try_on(queue_depth, worker_count, job_seconds=None, start_rate=None, start_burst=0.0):
+    """Decide what happens to a new try-on given the jobs already waiting to start.
+
+    Returns (ADMIT, BUSY or SHED, its queue position, the expected wait in seconds). worker_count counts
+    the workers of every process sharing the queue. job_seconds is the recent time a job takes, None
+    while it is not known. start_rate and start_burst are the throttle jobs start under, None when
+    there is none; the longer of the two waits is expected.
+    """
+    position = queue_depth + 1
+    expected_wait = 0.0
+    if job_seconds:
+        expected_wait = math.ceil(position / max(1, worker_count)) * job_seconds
+    if start_rate:
+        expected_wait = max(expected_wait, max(0.0, position - start_burst) / start_rate)
+    if position > RateLimitSettings.MAX_QUEUE_DEPTH.value or expected_wait > RateLimitSettings.MAX_WAIT_SECONDS.value:
+        return SHED, position, expected_wait
+    if position > RateLimitSettings.BUSY_QUEUE_DEPTH.value or expected_wait > RateLimitSettings.BUSY_WAIT_SECONDS.value:
+        return BUSY, position, expected_wait
+    return ADMIT, position, expected_wait
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the process-wide TokenBucketLimiter."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                _rate_limiter = TokenBucketLimiter(RateLimitSettings.DATABASE_FILE.value)
+    return _rate_limiter
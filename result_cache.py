@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import os
+import json
+import shutil
+import threading
+import time
+
+from collections import OrderedDict
+
+from constants import DirectoryPath, ResultCacheSettings
+from metadata_store import get_metadata_store
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """Try-on results keyed by input content, with an in-memory hot tier over a size-bounded disk tier."""
+
+    def __init__(self, cache_dir, store, max_disk_bytes=ResultCacheSettings.MAX_DISK_BYTES.value,
+                 hot_max_entries=ResultCacheSettings.HOT_MAX_ENTRIES.value,
+                 hot_max_item_bytes=ResultCacheSettings.HOT_MAX_ITEM_BYTES.value):
+        self.cache_dir = cache_dir
+        self.store = store
+        self.max_disk_bytes = max_disk_bytes
+        self.hot_max_entries = hot_max_entries
+        self.hot_max_item_bytes = hot_max_item_bytes
+        self._hot = OrderedDict()
+        self._hot_lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self.hits = {"hot": 0, "disk": 0}
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(person_hash, garment_hash, backend, params=None):
+        key_material = json.dumps([person_hash, garment_hash, backend, params or {}], sort_keys=True)
+        return hashlib.sha256(key_material.encode()).hexdigest()
+
+    def _entry_path(self, cache_key):
+        return os.path.join(self.cache_dir, cache_key[:2], f"{cache_key}.jpeg")
+
+    def _remember_hot(self, cache_key, content):
+        if len(content) > self.hot_max_item_bytes:
+            return
+        with self._hot_lock:
+            self._hot[cache_key] = content
+            self._hot.move_to_end(cache_key)
+            while len(self._hot) > self.hot_max_entries:
+                self._hot.popitem(last=False)
+
+    def get(self, cache_key, dest_path):
+        """Materialize a cached result at dest_path, returning False on a miss."""
+        with self._hot_lock:
+            content = self._hot.get(cache_key)
+            if content is not None:
+                self._hot.move_to_end(cache_key)
+        if content is not None:
+            # Written aside and renamed, so a reader never sees a partial image
+            temp_path = f"{dest_path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as file:
+                file.write(content)
+            os.replace(temp_path, dest_path)
+            self.hits["hot"] += 1
+            self.store.touch_cache_entry(cache_key, time.time())
+            return True
+
+        entry = self.store.get_cache_entry(cache_key)
+        if entry is None or not os.path.exists(entry["path"]):
+            if entry is not None:
+                self.store.delete_cache_entry(cache_key)
+            self.misses += 1
+            return False
+        try:
+            # A hard link shares the bytes with the cache, eviction only drops the cache's name
+            os.link(entry["path"], dest_path)
+        except OSError:
+            shutil.copyfile(entry["path"], dest_path)
+        self.store.touch_cache_entry(cache_key, time.time())
+        if entry["size"] <= self.hot_max_item_bytes:
+            with open(entry["path"], "rb") as file:
+                self._remember_hot(cache_key, file.read())
+        self.hits["disk"] += 1
+        return True
+
+    def put(self, cache_key, src_path):
+        """Copy a finished result into the cache."""
+        try:
+            entry_path = self._entry_path(cache_key)
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            temp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+            shutil.copyfile(src_path, temp_path)
+            os.replace(temp_path, entry_path)
+            size = os.path.getsize(entry_path)
+            self.store.put_cache_entry(cache_key, entry_path, size, time.time())
+            if size <= self.hot_max_item_bytes:
+                with open(entry_path, "rb") as file:
+                    self._remember_hot(cache_key, file.read())
+            self.evict()
+        except Exception as e:
+            # The result was produced already, a failed cache write must not fail the request
+            logger.log(level=logging.ERROR, msg=f"Could not cache result {cache_key}. Error: [{e}]")
+
+    def evict(self):
+        """Drop least recently used entries until the disk tier fits in max_disk_bytes."""
+        with self._evict_lock:
+            total = self.store.cache_total_bytes()
+            while total > self.max_disk_bytes:
+                entries = self.store.least_recently_used_cache_entries(32)
+                if not entries:
+                    break
+                for entry in entries:
+                    if total <= self.max_disk_bytes:
+                        break
+                    if os.path.exists(entry["path"]):
+                        os.remove(entry["path"])
+                    self.store.delete_cache_entry(entry["cache_key"])
+                    with self._hot_lock:
+                        self._hot.pop(entry["cache_key"], None)
+                    total -= entry["size"]
+
+    def stats(self):
+        with self._hot_lock:
+            hot_entries = len(self._hot)
+        return {
+            "hot_hits": self.hits["hot"],
+            "disk_hits": self.hits["disk"],
+            "misses": self.misses,
+            "hot_entries": hot_entries,
+            "disk_bytes": self.store.cache_total_bytes()
+        }
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """Return the process-wide ResultCache."""
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = ResultCache(DirectoryPath.RESULT_CACHE_DIR.value, get_metadata_store())
+    return _result_cache
@@ -0,0 +1,152 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+from constants import SessionSettings
+from image_serving import LRUCache
+from metadata_store import get_metadata_store
+
+AWAITING_IMAGES = "awaiting_images"
+AWAITING_PERSON = "awaiting_person"
+AWAITING_GARMENT = "awaiting_garment"
+UNTYPED_PENDING = "untyped_pending"
+READY = "ready"
+
+VERSION = struct.Struct("<Q")
+
+
+class Session:
+    """The unused images of one user, counted by type, and the conversation state they put the user in.
+
+    Sessions are never changed in place, a change makes a new one, so readers need no lock.
+    """
+
+    def __init__(self, counts, epoch, version):
+        self.counts = counts
+        self.epoch = epoch
+        self.version = version
+
+    def has(self, image_type):
+        return self.counts.get(image_type, 0) > 0
+
+    @property
+    def state(self):
+        if self.has("person") and self.has("garment"):
+            return READY
+        # An untyped upload waits for its type before anything else is asked for
+        if self.has(None):
+            return UNTYPED_PENDING
+        if self.has("garment"):
+            return AWAITING_PERSON
+        if self.has("person"):
+            return AWAITING_GARMENT
+        return AWAITING_IMAGES
+
+    def changed(self, deltas, version):
+        counts = dict(self.counts)
+        for image_type, delta in deltas.items():
+            counts[image_type] = max(0, counts.get(image_type, 0) + delta)
+        return Session(counts, self.epoch, version)
+
+
+class SessionVersions:
+    """Change counters in a memory-mapped file, one slot per user hash plus a global epoch in slot 0.
+
+    Every worker process maps the same file, so reading a counter is a memory access. Writers change
+    the metadata store first and bump the counter after, readers read the counter before loading, so
+    a session loaded while a change is in flight is always older than the counter it is checked against.
+    """
+
+    def __init__(self, path, slots):
+        self.slots = slots
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        size = slots * VERSION.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._lock = threading.Lock()
+
+    def slot(self, user_id):
+        digest = hashlib.sha1(user_id.encode()).digest()
+        return 1 + int.from_bytes(digest[:8], "big") % (self.slots - 1)
+
+    def read(self, slot):
+        return VERSION.unpack_from(self._map, slot * VERSION.size)[0]
+
+    def bump(self, slot):
+        with self._lock:
+            version = self.read(slot) + 1
+            VERSION.pack_into(self._map, slot * VERSION.size, version)
+            return version
+
+
+class SessionStore:
+    """Per-user sessions in a bounded LRU, written through to the metadata store.
+
+    The input_images rows stay the only record, every change is written there first and then applied
+    to the cached session. A cached session is used while its user's counter and the epoch still
+    match, so changes made by another worker process only cost the next reader one query.
+    """
+
+    def __init__(self, store, versions, max_entries=SessionSettings.CACHE_ENTRIES.value):
+        self.store = store
+        self.versions = versions
+        self._sessions = LRUCache(max_entries)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Return the user's current Session."""
+        slot = self.versions.slot(user_id)
+        epoch, version = self.versions.read(0), self.versions.read(slot)
+        session = self._sessions.get(user_id)
+        if session is not None and session.epoch == epoch and session.version == version:
+            return session
+        session = Session(self.store.count_unused_images(user_id), epoch, version)
+        self._sessions.put(user_id, session)
+        return session
+
+    def record(self, user_id, deltas=None):
+        """Note a change already written to the store, deltas maps image types to count changes.
+
+        Without deltas the cached session is dropped and reloaded by the next reader.
+        """
+        slot = self.versions.slot(user_id)
+        with self._lock:
+            version = self.versions.bump(slot)
+            session = self._sessions.get(user_id)
+            if session is None:
+                return
+            # A counter that moved twice was also changed elsewhere, the cached counts are behind
+            if deltas is None or session.version != version - 1 or session.epoch != self.versions.read(0):
+                self._sessions.pop(user_id)
+            else:
+                self._sessions.put(user_id, session.changed(deltas, version))
+
+    def invalidate_all(self):
+        """Drop every cached session in every process, for changes that touch many users at once."""
+        self.versions.bump(0)
+
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """Return the process-wide SessionStore."""
+    global _session_store
+    if _session_store is None:
+        with _session_store_lock:
+            if _session_store is None:
+                _session_store = SessionStore(
+                    get_metadata_store(),
+                    SessionVersions(SessionSettings.VERSION_FILE.value, SessionSettings.VERSION_SLOTS.value)
+                )
+    return _session_store
@@ -0,0 +1,190 @@
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from constants import JobQueueSettings, MergeSettings, PreviewSettings, SpeculativeSettings
+from image_pipeline import prepare_cell
+from image_workers import get_image_worker_pool
+from metadata_store import get_metadata_store
+from telemetry import SPECULATIVE_TASKS, span
+from try_on_router import get_try_on_router
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CELLS = "cells"
+UPLOAD = "upload"
+
+
+class SpeculativePreprocessor:
+    """Prepares each input for its try-on while the user is still sending the other image.
+
+    A merge joins two letterboxed cells, so each input's cell is decoded and laid out on arrival, and
+    in the model mode the input is uploaded to the backend most likely to run it. The job then only
+    does what needs both images. Everything here is best effort: a job that finds nothing prepared
+    does the work itself. Cells are shared by every merge of the same blob and, like the uploads,
+    expire after ttl seconds.
+    """
+
+    def __init__(self, store, cell_dir, try_on_mode, max_workers=SpeculativeSettings.WORKERS.value,
+                 max_pending=SpeculativeSettings.MAX_PENDING.value,
+                 max_delay=SpeculativeSettings.MAX_DELAY_SECONDS.value,
+                 settle_timeout=SpeculativeSettings.SETTLE_TIMEOUT_SECONDS.value,
+                 ttl=SpeculativeSettings.TTL_SECONDS.value,
+                 cleanup_interval=SpeculativeSettings.CLEANUP_INTERVAL_SECONDS.value,
+                 enabled=SpeculativeSettings.ENABLED.value):
+        self.store = store
+        self.cell_dir = cell_dir
+        self.try_on_mode = try_on_mode
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.settle_timeout = settle_timeout
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self.enabled = enabled
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculative")
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+        os.makedirs(cell_dir, exist_ok=True)
+
+    def boxes(self):
+        """Cell sizes the merges of this mode use."""
+        if self.try_on_mode == "merge":
+            return [(MergeSettings.PANEL_WIDTH.value, MergeSettings.PANEL_HEIGHT.value)]
+        if PreviewSettings.ENABLED.value:
+            return [(PreviewSettings.PANEL_WIDTH.value, PreviewSettings.PANEL_HEIGHT.value)]
+        return []
+
+    def cell_path(self, image_path, box):
+        # Blobs are named by their content, so the name says which image a cell was made from
+        name = os.path.splitext(os.path.basename(image_path))[0]
+        return os.path.join(self.cell_dir, f"{name}-{box[0]}x{box[1]}.npy")
+
+    def schedule(self, image_path, pair_ready=False):
+        """Start preparing a newly stored input in the background.
+
+        pair_ready says the input completed a pair, its job is about to start and would only wait here.
+        """
+        if not self.enabled or pair_ready:
+            return
+        self._maybe_cleanup()
+        kinds = [CELLS] if self.boxes() else []
+        if self.try_on_mode != "merge":
+            kinds.append(UPLOAD)
+        for kind in kinds:
+            with self._lock:
+                if (kind, image_path) in self._pending or len(self._pending) >= self.max_pending:
+                    continue
+                future = self._executor.submit(self._run, kind, image_path, time.monotonic())
+                self._pending[(kind, image_path)] = future
+            future.add_done_callback(lambda _, key=(kind, image_path): self._forget(key))
+
+    def _forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def _run(self, kind, image_path, scheduled_at):
+        if time.monotonic() - scheduled_at > self.max_delay:
+            SPECULATIVE_TASKS.inc(kind=kind, outcome="stale")
+            return
+        try:
+            with span("speculative", backend=kind):
+                if kind == CELLS:
+                    self._prepare_cells(image_path)
+                else:
+                    self._pre_upload(image_path)
+            SPECULATIVE_TASKS.inc(kind=kind, outcome="done")
+        except Exception as e:
+            # The job does this work itself when it finds it undone
+            SPECULATIVE_TASKS.inc(kind=kind, outcome="failed")
+            logger.log(level=logging.WARNING, msg=f"Speculative {kind} of {image_path} failed. Error: [{e}]")
+
+    def _prepare_cells(self, image_path):
+        for box in self.boxes():
+            cell_path = self.cell_path(image_path, box)
+            if not os.path.exists(cell_path):
+                get_image_worker_pool().run(prepare_cell, image_path, box, cell_path)
+
+    def _pre_upload(self, image_path):
+        router = get_try_on_router()
+        ranked = router.ranked_backends()
+        if not ranked:
+            # Every circuit is open, there is no backend to send it to
+            return
+        backend_name = ranked[0]
+        if self.store.get_pre_upload(backend_name, image_path, time.time()):
+            return
+        reference = router.backends[backend_name].upload(image_path)
+        if reference is not None:
+            self.store.put_pre_upload(backend_name, image_path, reference, time.time() + self.ttl)
+
+    def settle(self, image_paths, kind):
+        """Called by a job about to use its inputs: drop their queued work and wait for any already running.
+
+        Only this process's work is seen. A job on another worker may find a cell missing and make its own.
+        """
+        with self._lock:
+            futures = [self._pending.get((kind, image_path)) for image_path in image_paths]
+        running = []
+        for future in futures:
+            if future is None:
+                continue
+            if future.cancel():
+                SPECULATIVE_TASKS.inc(kind=kind, outcome="cancelled")
+            else:
+                running.append(future)
+        if running:
+            wait(running, timeout=self.settle_timeout)
+
+    def cell_paths(self, image_paths, box):
+        # Cells are named by blob and shared by every merge of it, only cleanup() removes them
+        return [self.cell_path(image_path, box) for image_path in image_paths]
+
+    def _maybe_cleanup(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_cleanup < self.cleanup_interval:
+                return
+            self._last_cleanup = now
+        self._executor.submit(self.cleanup)
+
+    def cleanup(self, now=None):
+        """Remove cells and forget uploads older than ttl, left by inputs that were never paired."""
+        now = now or time.time()
+        removed = 0
+        try:
+            for entry in os.scandir(self.cell_dir):
+                try:
+                    if entry.stat().st_mtime < now - self.ttl:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    # Removed by another worker's cleanup in the meantime
+                    continue
+            removed += self.store.prune_pre_uploads(now)
+        except Exception as e:
+            logger.log(level=logging.ERROR, msg=f"Speculative cleanup failed. Error: [{e}]")
+        return removed
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_speculative_preprocessor = None
+_speculative_preprocessor_lock = threading.Lock()
+
+
+def get_speculative_preprocessor():
+    """Return the process-wide SpeculativePreprocessor."""
+    global _speculative_preprocessor
+    if _speculative_preprocessor is None:
+        with _speculative_preprocessor_lock:
+            if _speculative_preprocessor is None:
+                _speculative_preprocessor = SpeculativePreprocessor(
+                    get_metadata_store(), SpeculativeSettings.CELL_DIR.value, JobQueueSettings.TRY_ON_MODE.value
+                )
+    return _speculative_preprocessor
@@ -0,0 +1,207 @@
+import logging
+import os
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+from blob_store import get_blob_store
+from constants import NearDuplicateSettings, StorageSettings
+from metadata_store import get_metadata_store
+from near_duplicates import get_near_duplicate_index
+from output_storage import get_output_storage
+from session_state import get_session_store
+from speculative import get_speculative_preprocessor
+from telemetry import STORAGE_EVICTIONS
+from user_locks import get_user_locks
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_sweep_stop = threading.Event()
+_sweep_thread = None
+
+
+def _release_blobs(blob_store, content_hashes):
+    for content_hash in content_hashes:
+        if content_hash:
+            blob_store.release(content_hash)
+
+
+def release_consumed_inputs(store, blob_store, batch_size):
+    """Drop the inputs of outputs the user has fetched, they are not needed again."""
+    released = 0
+    while True:
+        outputs = store.served_outputs_holding_inputs(batch_size)
+        if not outputs:
+            return released
+        for output in outputs:
+            content_hashes = store.release_output_inputs(output["name"], output["input_ids"])
+            _release_blobs(blob_store, content_hashes)
+            released += len(content_hashes)
+
+
+def expire_unused_inputs(store, blob_store, ttl_seconds, batch_size):
+    """Drop inputs that never became part of a try-on within ttl_seconds."""
+    created_before = (datetime.now() - timedelta(seconds=ttl_seconds)).isoformat()
+    expired = 0
+    while True:
+        content_hashes = store.delete_unused_inputs_before(created_before, batch_size)
+        _release_blobs(blob_store, content_hashes)
+        expired += len(content_hashes)
+        if len(content_hashes) < batch_size:
+            if expired:
+                # Deleted across many users at once, every cached session is reloaded
+                get_session_store().invalidate_all()
+            return expired
+
+
+def _delete_outputs(output_storage, outputs, reason):
+    store = get_metadata_store()
+    blob_store = get_blob_store()
+    freed = 0
+    for output in outputs:
+        # An output evicted before it was fetched would otherwise pin its inputs forever
+        if not output["inputs_released"]:
+            _release_blobs(blob_store, store.release_output_inputs(output["name"], output["input_ids"]))
+        freed += output_storage.delete(output)
+        STORAGE_EVICTIONS.inc(reason=reason)
+    return freed
+
+
+def discard_outputs(file_paths, reason):
+    """Delete committed outputs that never reached the user, returning the bytes freed."""
+    store = get_metadata_store()
+    outputs = [store.get_output_file(os.path.basename(file_path)) for file_path in file_paths]
+    return _delete_outputs(get_output_storage(), [output for output in outputs if output is not None], reason)
+
+
+def expire_outputs(store, output_storage, created_before, reason, batch_size, committed=True):
+    freed = 0
+    while True:
+        outputs = store.outputs_created_before(created_before, batch_size, committed=committed)
+        if not outputs:
+            return freed
+        freed += _delete_outputs(output_storage, outputs, reason)
+
+
+def enforce_user_quota(store, output_storage, max_bytes, batch_size):
+    """Delete the oldest outputs of every user storing more than max_bytes."""
+    freed = 0
+    for user_id, total in store.output_bytes_by_user(max_bytes).items():
+        # Outputs adopted from before the store tracked owners have no user to charge
+        if not user_id:
+            continue
+        while total > max_bytes:
+            outputs = store.oldest_outputs(batch_size, user_id=user_id)
+            if not outputs:
+                break
+            for output in outputs:
+                if total <= max_bytes:
+                    break
+                size = _delete_outputs(output_storage, [output], "user_quota")
+                total -= size
+                freed += size
+    return freed
+
+
+def enforce_global_quota(store, output_storage, max_bytes, batch_size):
+    freed = 0
+    total = store.output_total_bytes()
+    while total > max_bytes:
+        outputs = store.oldest_outputs(batch_size)
+        if not outputs:
+            break
+        for output in outputs:
+            if total <= max_bytes:
+                break
+            size = _delete_outputs(output_storage, [output], "global_quota")
+            total -= size
+            freed += size
+    return freed
+
+
+def demote_local_outputs(store, output_storage, created_before, batch_size):
+    """Keep only the remote copy of outputs older than created_before."""
+    demoted = 0
+    while True:
+        outputs = store.local_outputs_created_before(created_before, batch_size)
+        if not outputs:
+            return demoted
+        for output in outputs:
+            output_storage.drop_local_copy(output["name"])
+            demoted += 1
+
+
+def sweep(now=None):
+    """Apply every lifecycle policy once, returning what was done."""
+    now = now or time.time()
+    store = get_metadata_store()
+    blob_store = get_blob_store()
+    output_storage = get_output_storage()
+    batch_size = StorageSettings.SWEEP_BATCH_SIZE.value
+    # One process sweeps at a time, the others find nothing left to do
+    with get_user_locks("lifecycle").lock("sweep"):
+        report = {
+            "adopted_outputs": output_storage.adopt_legacy_outputs(batch_size),
+            "released_inputs": release_consumed_inputs(store, blob_store, batch_size),
+            "expired_inputs": expire_unused_inputs(
+                store, blob_store, StorageSettings.UNUSED_INPUT_TTL_SECONDS.value, batch_size
+            ),
+            "hashed_catalog_garments": get_near_duplicate_index().backfill_catalog(),
+            "forgotten_photo_hashes": get_near_duplicate_index().prune(
+                now - NearDuplicateSettings.RETENTION_SECONDS.value
+            ),
+            "expired_speculative": get_speculative_preprocessor().cleanup(now),
+            "abandoned_output_bytes": expire_outputs(
+                store, output_storage, now - StorageSettings.PENDING_OUTPUT_SECONDS.value, "abandoned", batch_size,
+                committed=False
+            ),
+            "expired_output_bytes": expire_outputs(
+                store, output_storage, now - StorageSettings.OUTPUT_TTL_SECONDS.value, "ttl", batch_size
+            ),
+            "user_quota_bytes": enforce_user_quota(
+                store, output_storage, StorageSettings.OUTPUT_USER_MAX_BYTES.value, batch_size
+            ),
+            "global_quota_bytes": enforce_global_quota(
+                store, output_storage, StorageSettings.OUTPUT_MAX_BYTES.value, batch_size
+            ),
+            "demoted_outputs": 0
+        }
+        if output_storage.backend.remote:
+            report["demoted_outputs"] = demote_local_outputs(
+                store, output_storage, now - StorageSettings.LOCAL_HOT_SECONDS.value, batch_size
+            )
+        # Released inputs only drop their blob references, the files go here
+        report["blob_bytes_freed"] = blob_store.garbage_collect()
+        report["stale_incoming_files"] = blob_store.sweep_incoming(now - StorageSettings.INCOMING_TTL_SECONDS.value)
+    logger.log(level=logging.INFO, msg=f"Storage sweep: {report}")
+    return report
+
+
+def _sweep_loop(interval):
+    # The first sweep runs right away, it also collects blobs orphaned by a crash
+    while True:
+        try:
+            sweep()
+        except Exception as e:
+            logger.log(level=logging.ERROR, msg=f"Storage sweep failed. Error: [{e}]")
+        if _sweep_stop.wait(interval):
+            return
+
+
+def start_storage_lifecycle(interval=StorageSettings.SWEEP_INTERVAL_SECONDS.value):
+    """Start the periodic storage sweep."""
+    global _sweep_thread
+    if _sweep_thread is None:
+        _sweep_stop.clear()
+        _sweep_thread = threading.Thread(target=_sweep_loop, args=(interval,), name="storage-lifecycle", daemon=True)
+        _sweep_thread.start()
+
+
+def stop_storage_lifecycle():
+    global _sweep_thread
+    _sweep_stop.set()
+    if _sweep_thread is not None:
+        _sweep_thread.join(timeout=30)
+        _sweep_thread = None
@@ -0,0 +1,309 @@
+import contextvars
+import logging
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from constants import TelemetrySettings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds, from a fast SQLite read up to a slow model call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+# Set inside image worker processes, observations are shipped back to the server instead of recorded
+_recording = contextvars.ContextVar("recording", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f"{name}=\"{_escape(value)}\"" for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def _record(self, key, value):
+        recording = _recording.get()
+        if recording is not None:
+            recording.append((self.name, key, value))
+        else:
+            self._apply(key, value)
+
+    def _apply(self, key, value):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            values = {key: (list(value) if isinstance(value, list) else value) for key, value in self._values.items()}
+        for key, value in sorted(values.items()):
+            lines.extend(self._render_series(list(zip(self.label_names, key)), value))
+        return lines
+
+    def _render_series(self, labels, value):
+        return [f"{self.name}{_format_labels(labels)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        if TelemetrySettings.ENABLED.value:
+            self._record(self._key(labels), amount)
+
+    def _apply(self, key, value):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, label_names)
+
+    def observe(self, value, **labels):
+        if TelemetrySettings.ENABLED.value:
+            self._record(self._key(labels), value)
+
+    def _apply(self, key, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            # One count per bucket plus +Inf, then the sum; made cumulative only when rendered
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_series(self, labels, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+            cumulative += count
+            bucket_labels = labels + [("le", _format_value(float(bound)))]
+            lines.append(f"{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(series[-1])}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """The process's metrics, plus collectors that read gauges from other components at scrape time."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+
+    def add_collector(self, collector):
+        """collector() returns [(name, type, help, [(labels dict, value)])]."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def replay(self, observations):
+        """Record observations made in another process."""
+        for name, key, value in observations:
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric._apply(key, value)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                # One broken component must not take the whole scrape down
+                logger.log(level=logging.ERROR, msg=f"Metrics collector {collector.__name__} failed. Error: [{e}]")
+                continue
+            for name, metric_type, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+_registry = MetricsRegistry()
+
+
+def get_metrics_registry():
+    """Return the process-wide MetricsRegistry."""
+    return _registry
+
+
+STAGE_SECONDS = Histogram(
+    "tryon_stage_duration_seconds", "Time spent in each stage of handling a try-on", ("stage", "backend")
+)
+STAGE_ERRORS = Counter(
+    "tryon_stage_errors_total", "Stages that ended with an exception", ("stage", "backend")
+)
+METADATA_SECONDS = Histogram(
+    "tryon_metadata_operation_duration_seconds", "Time spent in each metadata store operation", ("operation",)
+)
+HTTP_SECONDS = Histogram(
+    "tryon_http_request_duration_seconds", "HTTP requests served, by route", ("method", "route", "status")
+)
+DOWNLOAD_ATTEMPTS = Counter(
+    "tryon_download_attempts_total", "Media download attempts by outcome", ("outcome",)
+)
+JOB_SECONDS = Histogram(
+    "tryon_job_duration_seconds", "Background jobs by kind and final status", ("kind", "status")
+)
+RATE_LIMITED = Counter(
+    "tryon_rate_limited_total", "Requests turned away by a token bucket, by limit", ("limit",)
+)
+ADMISSION_DECISIONS = Counter(
+    "tryon_admission_decisions_total", "Try-ons admitted, queued as busy or shed", ("decision",)
+)
+STORAGE_EVICTIONS = Counter(
+    "tryon_storage_evictions_total", "Stored images removed by the lifecycle sweep, by reason", ("reason",)
+)
+SPECULATIVE_TASKS = Counter(
+    "tryon_speculative_tasks_total", "Speculative preprocessing of inputs by kind and outcome", ("kind", "outcome")
+)
+NEAR_DUPLICATES = Counter(
+    "tryon_near_duplicate_photos_total", "Photos matched to an earlier one by perceptual hash, by where it was found",
+    ("source",)
+)
+
+
+def current_trace_id():
+    return _trace_id.get()
+
+
+@contextmanager
+def trace(trace_id):
+    """Tag every span in this context (a message, a job) with trace_id in slow-span logs."""
+    token = _trace_id.set(trace_id)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+@contextmanager
+def span(stage, backend=""):
+    """Time a stage into tryon_stage_duration_seconds, counting it as an error if it raises."""
+    if not TelemetrySettings.ENABLED.value:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage, backend=backend)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage, backend=backend)
+        if elapsed >= TelemetrySettings.SLOW_SPAN_SECONDS.value:
+            logger.log(level=logging.WARNING, msg=f"Slow {stage} span{f' on {backend}' if backend else ''}: "
+                       f"{elapsed:.2f}s (trace {_trace_id.get()})")
+
+
+def timed_operation(function):
+    """Decorator timing a metadata store method into tryon_metadata_operation_duration_seconds."""
+    operation = function.__name__
+
+    def wrapper(*args, **kwargs):
+        if not TelemetrySettings.ENABLED.value:
+            return function(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            METADATA_SECONDS.observe(time.perf_counter() - started, operation=operation)
+
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+def call_recording_observations(function, args, kwargs):
+    """Run function in an image worker, returning its result and the observations it made."""
+    observations = []
+    token = _recording.set(observations)
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        _recording.reset(token)
+    return result, observations
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware timing every HTTP request by its route template, not its raw path."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TelemetrySettings.ENABLED.value:
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            HTTP_SECONDS.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                # Unmatched paths share one label so scanners cannot blow up the series count
+                route=getattr(route, "path", "unmatched"),
+                status=status["code"]
+            )
@@ -0,0 +1,60 @@
+"""Shared setup for the test suite.
+
+The tests run in a scratch directory, where the app's relative data directories land, and build
+their own stores under tmp_path where a module would otherwise use its process-wide one.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Settings are read when the modules are first imported, which happens after this
+os.environ.setdefault("IMAGE_WORKERS", "0")
+
+ORIGINAL_CWD = os.getcwd()
+SCRATCH_DIR = tempfile.mkdtemp(prefix="tryon_tests_")
+os.chdir(SCRATCH_DIR)
+
+
+def pytest_unconfigure(config):
+    os.chdir(ORIGINAL_CWD)
+    shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def metadata_store(tmp_path, monkeypatch):
+    """A fresh MetadataStore, also returned by get_metadata_store() during the test."""
+    import metadata_store as metadata_store_module
+
+    store = metadata_store_module.MetadataStore(str(tmp_path / "metadata.db"))
+    monkeypatch.setattr(metadata_store_module, "_metadata_store", store)
+    return store
+
+
+@pytest.fixture
+def twilio(monkeypatch):
+    """The fake Twilio client of the benchmarks, recording every message the app sends."""
+    from benchmarks.fakes import FakeTwilioClient
+    from twilio_messenger import TwilioMessenger
+
+    client = FakeTwilioClient()
+    monkeypatch.setattr(TwilioMessenger, "_client", client)
+    return client
+
+
+@pytest.fixture
+def photo(tmp_path):
+    """Write a small phone-like JPEG and return its path."""
+    from benchmarks.merge_benchmark import make_photo
+
+    def make(name, size=(300, 400)):
+        path = str(tmp_path / name)
+        make_photo(path, size)
+        return path
+
+    return make
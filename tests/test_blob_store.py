@@ -0,0 +1,91 @@
+import hashlib
+import os
+import shutil
+import time
+
+import pytest
+
+from blob_store import BlobStore
+
+CONTENT = b"\x89PNG stand-in for an uploaded image" * 64
+
+
+@pytest.fixture
+def blob_store(tmp_path, metadata_store):
+    return BlobStore(str(tmp_path / "blobs"), metadata_store)
+
+
+def incoming_copy(blob_store, content=CONTENT):
+    """Write content to the incoming directory like a download, returning its path and content hash."""
+    temp_path = blob_store.new_incoming_path()
+    with open(temp_path, "wb") as file:
+        file.write(content)
+    return temp_path, hashlib.sha256(content).hexdigest()
+
+
+def incoming_file_copy(blob_store, path):
+    """Copy a file into the incoming directory like a download, returning its path and content hash."""
+    temp_path = blob_store.new_incoming_path()
+    shutil.copyfile(path, temp_path)
+    with open(path, "rb") as file:
+        return temp_path, hashlib.sha256(file.read()).hexdigest()
+
+
+def test_the_same_content_is_stored_once_and_referenced_twice(blob_store, metadata_store):
+    first_path = blob_store.put(*incoming_copy(blob_store))
+    temp_path, content_hash = incoming_copy(blob_store)
+    assert blob_store.put(temp_path, content_hash) == first_path
+    assert not os.path.exists(temp_path)
+    assert metadata_store.get_blob(content_hash)["refcount"] == 2
+
+
+def test_a_blob_is_collected_once_every_reference_is_released(blob_store, metadata_store):
+    stored_path = blob_store.put(*incoming_copy(blob_store))
+    content_hash = incoming_copy(blob_store)[1]
+    blob_store.add_reference(content_hash)
+
+    blob_store.release(content_hash)
+    assert blob_store.garbage_collect() == 0
+    assert os.path.exists(stored_path)
+
+    blob_store.release(content_hash)
+    assert blob_store.garbage_collect() == len(CONTENT)
+    assert not os.path.exists(stored_path)
+    assert metadata_store.get_blob(content_hash) is None
+
+
+def test_a_blob_referenced_again_before_collection_is_kept(blob_store, metadata_store):
+    temp_path, content_hash = incoming_copy(blob_store)
+    stored_path = blob_store.put(temp_path, content_hash)
+    blob_store.release(content_hash)
+    blob_store.add_reference(content_hash)
+    assert blob_store.garbage_collect() == 0
+    assert os.path.exists(stored_path)
+    assert metadata_store.get_blob(content_hash)["refcount"] == 1
+
+
+def test_ingest_normalizes_once_and_collects_the_thumbnail(blob_store, metadata_store, photo):
+    path = photo("person.jpeg", size=(1200, 1600))
+    stored_path = blob_store.ingest(*incoming_file_copy(blob_store, path))
+    temp_path, content_hash = incoming_file_copy(blob_store, path)
+    assert blob_store.ingest(temp_path, content_hash) == stored_path
+    assert metadata_store.get_blob(content_hash)["refcount"] == 2
+    thumbnail_path = blob_store.thumbnail(content_hash)
+    assert os.path.exists(thumbnail_path)
+    assert os.listdir(blob_store.incoming_dir) == []
+
+    blob_store.release(content_hash)
+    blob_store.release(content_hash)
+    assert blob_store.garbage_collect() > 0
+    assert not os.path.exists(stored_path)
+    assert not os.path.exists(thumbnail_path)
+
+
+def test_only_stale_incoming_files_are_swept(blob_store):
+    stale_path, fresh_path = blob_store.new_incoming_path(), blob_store.new_incoming_path()
+    for path in (stale_path, fresh_path):
+        with open(path, "wb") as file:
+            file.write(b"partial download")
+    os.utime(stale_path, (time.time() - 3600, time.time() - 3600))
+    assert blob_store.sweep_incoming(older_than=time.time() - 60) == 1
+    assert os.listdir(blob_store.incoming_dir) == [os.path.basename(fresh_path)]
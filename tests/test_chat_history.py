@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+from chat_history_manager import ChatHistoryLog
+
+
+@pytest.fixture
+def make_log(tmp_path):
+    def make(**kwargs):
+        return ChatHistoryLog(str(tmp_path / "chat_history"), **kwargs)
+
+    return make
+
+
+def entries(start, stop):
+    return [{"user_message": f"message {index}"} for index in range(start, stop)]
+
+
+def test_a_full_segment_rotates_to_a_new_one(make_log):
+    log = make_log(max_segment_bytes=256)
+    for entry in entries(0, 40):
+        log.append("user", entry)
+    segment_names = sorted(os.listdir(os.path.join(log.history_dir, "user")))
+    assert len(segment_names) > 1
+    for name in segment_names:
+        assert os.path.getsize(os.path.join(log.history_dir, "user", name)) <= 256
+    assert log.tail("user", 100) == entries(0, 40)
+
+
+def test_the_tail_is_read_backwards_across_segments(make_log):
+    log = make_log(max_segment_bytes=256)
+    for entry in entries(0, 40):
+        log.append("user", entry)
+    # The last segment holds fewer than 15 entries, so the tail starts in an earlier one
+    assert len(log.tail("user", 15)) == 15
+    assert log.tail("user", 15) == entries(25, 40)
+    assert log.tail("user", 1) == entries(39, 40)
+    assert log.tail("someone else", 5) == []
+
+
+def test_compaction_keeps_the_newest_entries(make_log):
+    log = make_log(max_segment_bytes=8 * 1024, max_segments=4)
+    for entry in entries(0, 3000):
+        log.append("user", entry)
+    # Rotation compacted the older segments on the way
+    assert len(os.listdir(os.path.join(log.history_dir, "user"))) <= 4
+    assert log.tail("user", 10) == entries(2990, 3000)
+
+    log.compact("user")
+    assert len(os.listdir(os.path.join(log.history_dir, "user"))) == 1
+    assert log.tail("user", 5000) == entries(1000, 3000)
@@ -0,0 +1,41 @@
+import asyncio
+import os
+
+import pytest
+
+from blob_store import BlobStore
+
+
+class FailingDownloadClient:
+    """Writes part of every media file and then loses the connection."""
+
+    def download_to_file_sync(self, media_url, temp_path, auth=None):
+        with open(temp_path, "wb") as file:
+            file.write(b"partial download")
+        raise ConnectionError("connection reset")
+
+    async def download_to_file(self, media_url, temp_path, auth=None):
+        self.download_to_file_sync(media_url, temp_path, auth)
+
+
+@pytest.fixture
+def image_manager(tmp_path, metadata_store, monkeypatch):
+    import image_handler
+
+    monkeypatch.setattr(image_handler, "get_media_download_client", lambda: FailingDownloadClient())
+    image_manager = image_handler.ImageManager("whatsapp:+15550010")
+    image_manager.blob_store = BlobStore(str(tmp_path / "blobs"), metadata_store)
+    return image_manager
+
+
+def test_a_failed_download_leaves_no_temp_file(image_manager):
+    with pytest.raises(ConnectionError):
+        image_manager.download_image("https://api.twilio.com/media/1", "person")
+    assert os.listdir(image_manager.blob_store.incoming_dir) == []
+
+
+def test_failed_concurrent_downloads_leave_no_temp_files(image_manager):
+    media_urls = ["https://api.twilio.com/media/1", "https://api.twilio.com/media/2"]
+    with pytest.raises(ConnectionError):
+        asyncio.run(image_manager.download_images_async(media_urls, "garment"))
+    assert os.listdir(image_manager.blob_store.incoming_dir) == []
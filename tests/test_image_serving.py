@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from image_serving import OutputImageServer
+
+IMAGE_BYTES = b"\xff\xd8\xff\xe0 output image" * 100
+
+
+@pytest.fixture
+def make_image_server(tmp_path, monkeypatch):
+    """Install an OutputImageServer over a fresh output directory as the process-wide one."""
+    import image_serving
+
+    def make(**kwargs):
+        output_dir = tmp_path / "outputs"
+        output_dir.mkdir(exist_ok=True)
+        (output_dir / "result.jpeg").write_bytes(IMAGE_BYTES)
+        (tmp_path / "secret.jpeg").write_bytes(b"not an output")
+        image_server = OutputImageServer(str(output_dir), **kwargs)
+        monkeypatch.setattr(image_serving, "_output_image_server", image_server)
+        return image_server
+
+    return make
+
+
+@pytest.fixture
+def request_image():
+    """Send requests to the app's image route in-process, returning the responses in order."""
+    import httpx
+
+    import app
+
+    def send(*requests):
+        async def run():
+            transport = httpx.ASGITransport(app=app.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                return [
+                    await client.request(method, f"/get_image/{image_name}", headers=headers)
+                    for method, image_name, headers in requests
+                ]
+
+        return asyncio.run(run())
+
+    return send
+
+
+def test_names_outside_the_output_directory_are_not_resolved(make_image_server, request_image):
+    image_server = make_image_server()
+    assert image_server.resolve("result.jpeg") == f"{image_server.output_dir}/result.jpeg"
+    for image_name in ("../secret.jpeg", "..%2Fsecret.jpeg", "%2e%2e%2fsecret.jpeg", "..", ".hidden", ""):
+        assert image_server.resolve(image_name) is None
+    responses = request_image(
+        ("GET", "..%2Fsecret.jpeg", {}), ("GET", "%2e%2e%2fsecret.jpeg", {}), ("GET", "%2E%2E", {})
+    )
+    assert [response.status_code for response in responses] == [404, 404, 404]
+    assert all(b"not an output" not in response.content for response in responses)
+
+
+@pytest.mark.parametrize("thumbnail_max_bytes", [1024 * 1024, 0], ids=["in_memory", "streamed"])
+def test_a_matching_etag_gets_not_modified(make_image_server, request_image, thumbnail_max_bytes):
+    make_image_server(thumbnail_max_bytes=thumbnail_max_bytes)
+    (first,) = request_image(("GET", "result.jpeg", {}))
+    assert first.status_code == 200
+    assert first.content == IMAGE_BYTES
+    etag = first.headers["etag"]
+    matching, weak, other = request_image(
+        ("GET", "result.jpeg", {"If-None-Match": etag}),
+        ("GET", "result.jpeg", {"If-None-Match": f'"other", W/{etag}'}),
+        ("GET", "result.jpeg", {"If-None-Match": '"other"'})
+    )
+    assert matching.status_code == weak.status_code == 304
+    assert matching.content == b""
+    assert matching.headers["etag"] == etag
+    assert other.status_code == 200
+    assert other.content == IMAGE_BYTES
+
+
+@pytest.mark.parametrize("thumbnail_max_bytes", [1024 * 1024, 0], ids=["in_memory", "streamed"])
+def test_head_returns_the_headers_without_a_body(make_image_server, request_image, thumbnail_max_bytes):
+    make_image_server(thumbnail_max_bytes=thumbnail_max_bytes)
+    head, get = request_image(("HEAD", "result.jpeg", {}), ("GET", "result.jpeg", {}))
+    assert head.status_code == 200
+    assert head.content == b""
+    assert head.headers["content-length"] == str(len(IMAGE_BYTES))
+    assert head.headers["etag"] == get.headers["etag"]
+    assert head.headers["content-type"] == "image/jpeg"
+
+
+def test_small_images_are_read_off_the_event_loop(make_image_server, request_image, monkeypatch):
+    image_server = make_image_server()
+    small_image_bytes = image_server.small_image_bytes
+    reads = []
+
+    def read_small_image(path, stat):
+        try:
+            asyncio.get_running_loop()
+            reads.append("event loop")
+        except RuntimeError:
+            reads.append("thread")
+        return small_image_bytes(path, stat)
+
+    monkeypatch.setattr(image_server, "small_image_bytes", read_small_image)
+    first, second = request_image(("GET", "result.jpeg", {}), ("GET", "result.jpeg", {}))
+    assert first.content == second.content == IMAGE_BYTES
+    # Read once, the second request is answered from memory
+    assert reads == ["thread"]
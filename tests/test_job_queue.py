@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+from job_queue import InMemoryJobBackend, JobQueue, JobStatus, SQLiteJobBackend
+
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+@pytest.fixture
+def sqlite_backend(tmp_path):
+    return SQLiteJobBackend(str(tmp_path / "jobs.db"), poll_interval=0.01, lock_dir=str(tmp_path / "locks"))
+
+
+def stop_process(backend):
+    """Release the liveness lock of a backend, as if its process had exited."""
+    os.close(backend._liveness_fd)
+    backend._liveness_fd = None
+
+
+@pytest.mark.parametrize("make_backend", ["memory", "sqlite"])
+def test_jobs_run_and_record_their_outcome(make_backend, sqlite_backend):
+    backend = InMemoryJobBackend() if make_backend == "memory" else sqlite_backend
+    job_queue = JobQueue(backend, worker_count=2)
+
+    def handler(job):
+        if job.payload.get("fail"):
+            raise ValueError("broken input")
+        return {"echo": job.payload["value"]}
+
+    job_queue.register_handler("echo", handler)
+    job_queue.start()
+    try:
+        done = job_queue.enqueue("user", "echo", {"value": 7})
+        failed = job_queue.enqueue("user", "echo", {"fail": True})
+        assert wait_until(lambda: all(
+            job_queue.get_job(job.job_id).status in (JobStatus.DONE, JobStatus.FAILED) for job in (done, failed)
+        ))
+    finally:
+        job_queue.stop()
+    assert job_queue.get_job(done.job_id).status == JobStatus.DONE
+    assert job_queue.get_job(done.job_id).result == {"echo": 7}
+    assert job_queue.get_job(failed.job_id).status == JobStatus.FAILED
+    assert "broken input" in job_queue.get_job(failed.job_id).error
+
+
+def test_a_job_is_claimed_once(sqlite_backend):
+    job_queue = JobQueue(sqlite_backend)
+    job_queue.register_handler("noop", lambda job: None)
+    job = job_queue.enqueue("user", "noop", {})
+    claims = []
+
+    def claim():
+        claimed = sqlite_backend.get_next(timeout=0.2)
+        if claimed is not None:
+            claims.append(claimed.job_id)
+
+    threads = [threading.Thread(target=claim) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert claims == [job.job_id]
+    assert sqlite_backend.get(job.job_id).status == JobStatus.RUNNING
+
+
+def test_jobs_of_a_stopped_process_are_requeued(tmp_path, sqlite_backend):
+    job_queue = JobQueue(sqlite_backend)
+    job_queue.register_handler("noop", lambda job: None)
+    job = job_queue.enqueue("user", "noop", {})
+    assert sqlite_backend.get_next(timeout=0.2).job_id == job.job_id
+    stop_process(sqlite_backend)
+
+    restarted = SQLiteJobBackend(str(tmp_path / "jobs.db"), poll_interval=0.01, lock_dir=str(tmp_path / "locks"))
+    restarted.recover_interrupted()
+    assert restarted.get(job.job_id).status == JobStatus.QUEUED
+    assert restarted.get_next(timeout=0.2).job_id == job.job_id
+
+
+def test_jobs_of_a_live_process_are_left_running(tmp_path, sqlite_backend):
+    job_queue = JobQueue(sqlite_backend)
+    job_queue.register_handler("noop", lambda job: None)
+    job = job_queue.enqueue("user", "noop", {})
+    sqlite_backend.get_next(timeout=0.2)
+
+    other = SQLiteJobBackend(str(tmp_path / "jobs.db"), poll_interval=0.01, lock_dir=str(tmp_path / "locks"))
+    other.recover_interrupted()
+    assert other.get(job.job_id).status == JobStatus.RUNNING
+    assert other.live_processes() == 2
+
+
+def test_lock_files_of_stopped_processes_are_removed(tmp_path, sqlite_backend):
+    lock_dir = tmp_path / "locks"
+    sqlite_backend.recover_interrupted()
+    stopped = SQLiteJobBackend(str(tmp_path / "jobs.db"), poll_interval=0.01, lock_dir=str(lock_dir))
+    stopped.recover_interrupted()
+    stop_process(stopped)
+    assert len(os.listdir(lock_dir)) == 2
+
+    # Both at startup and whenever live processes are counted
+    restarted = SQLiteJobBackend(str(tmp_path / "jobs.db"), poll_interval=0.01, lock_dir=str(lock_dir))
+    restarted.recover_interrupted()
+    assert sorted(os.listdir(lock_dir)) == sorted(
+        f"{backend.worker_token}.lock" for backend in (sqlite_backend, restarted)
+    )
+    stop_process(restarted)
+    assert sqlite_backend.live_processes() == 1
+    assert os.listdir(lock_dir) == [f"{sqlite_backend.worker_token}.lock"]
+
+
+@pytest.mark.parametrize("make_backend", ["memory", "sqlite"])
+def test_depth_counts_jobs_held_back_by_the_throttle(make_backend, sqlite_backend):
+    backend = InMemoryJobBackend() if make_backend == "memory" else sqlite_backend
+    released = threading.Event()
+    job_queue = JobQueue(backend, worker_count=2, throttle=lambda job: 0.0 if released.is_set() else 0.05)
+    job_queue.register_handler("noop", lambda job: None)
+    job_queue.start()
+    try:
+        jobs = [job_queue.enqueue("user", "noop", {}) for _ in range(3)]
+        # Two are claimed by the workers and wait for the throttle, one is still queued
+        assert wait_until(lambda: job_queue.get_job(jobs[1].job_id).status == JobStatus.RUNNING)
+        assert backend.depth() == 3
+        released.set()
+        assert wait_until(lambda: all(job_queue.get_job(job.job_id).status == JobStatus.DONE for job in jobs))
+        assert backend.depth() == 0
+    finally:
+        job_queue.stop()
+
+
+def test_a_failed_job_notifies_the_user(twilio):
+    from try_on_jobs import MERGE_JOB, register_try_on_handlers
+
+    job_queue = JobQueue(InMemoryJobBackend(), worker_count=1)
+    register_try_on_handlers(job_queue)
+    job = job_queue.enqueue("whatsapp:+15550001", MERGE_JOB, {
+        "person_image": "missing_person.jpeg", "garment_image": "missing_garment.jpeg"
+    })
+    assert job_queue.run_job(job_queue.backend.get_next(timeout=0.2)).status == JobStatus.FAILED
+    assert [message["to"] for message in twilio.sent] == ["whatsapp:+15550001"]
+    assert twilio.sent[0]["media_url"] is None
+
+
+def test_a_merge_job_delivers_its_result(twilio, photo):
+    from try_on_jobs import MERGE_JOB, register_try_on_handlers
+
+    job_queue = JobQueue(InMemoryJobBackend(), worker_count=1)
+    register_try_on_handlers(job_queue)
+    job = job_queue.enqueue("whatsapp:+15550002", MERGE_JOB, {
+        "person_image": photo("person.jpeg"), "garment_image": photo("garment.jpeg")
+    })
+    job = job_queue.run_job(job_queue.backend.get_next(timeout=0.2))
+    assert job.status == JobStatus.DONE
+    assert twilio.sent[0]["media_url"] == [job.result["media_url"]]
+    assert job.result["output_image"] in job.result["media_url"]
+
+
+def test_a_result_that_cannot_be_sent_notifies_the_user(twilio, photo):
+    from try_on_jobs import MERGE_JOB, register_try_on_handlers
+
+    def create(**message):
+        if message.get("media_url"):
+            raise RuntimeError("Twilio is unavailable")
+        return twilio.create(**message)
+
+    twilio.messages = SimpleNamespace(create=create)
+    job_queue = JobQueue(InMemoryJobBackend(), worker_count=1)
+    register_try_on_handlers(job_queue)
+    job = job_queue.enqueue("whatsapp:+15550003", MERGE_JOB, {
+        "person_image": photo("person.jpeg"), "garment_image": photo("garment.jpeg")
+    })
+    job = job_queue.run_job(job_queue.backend.get_next(timeout=0.2))
+    assert job.status == JobStatus.FAILED
+    assert "Twilio is unavailable" in job.error
+    assert [(message["to"], message["media_url"]) for message in twilio.sent] == [("whatsapp:+15550003", None)]
@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from near_duplicates import HammingIndex, NearDuplicateIndex, hamming_distance
+from utils import MyCustomError
+
+BITS = 64
+MAX_DISTANCE = 8
+
+
+def flip_bits(value, count, rng):
+    for bit in rng.sample(range(BITS), count):
+        value ^= 1 << bit
+    return value
+
+
+@pytest.fixture
+def near_duplicates(metadata_store):
+    return NearDuplicateIndex(metadata_store, max_distance=MAX_DISTANCE, hash_bits=BITS, enabled=True)
+
+
+def store_photo(metadata_store, content_hash, value):
+    """Record an uploaded blob with its perceptual hash, as ingest does."""
+    metadata_store.add_blob_reference(content_hash, f"{content_hash}.png", 1000)
+    metadata_store.set_blob_perceptual_hash(content_hash, f"{value:016x}")
+    return content_hash
+
+
+def test_the_index_finds_exactly_the_hashes_within_the_distance():
+    rng = random.Random(7)
+    index = HammingIndex(BITS, MAX_DISTANCE)
+    values = [rng.getrandbits(BITS) for _ in range(200)]
+    for position, value in enumerate(values):
+        index.add(value, position)
+    query = values[10]
+    at_the_distance, just_beyond = flip_bits(query, MAX_DISTANCE, rng), flip_bits(query, MAX_DISTANCE + 1, rng)
+    index.add(at_the_distance, "at the distance")
+    index.add(just_beyond, "just beyond")
+    values += [at_the_distance, just_beyond]
+
+    matches = index.search(query)
+    assert matches[0] == (0, 10)
+    assert (MAX_DISTANCE, "at the distance") in matches
+    assert "just beyond" not in [item for _, item in matches]
+    # The bands find the same hashes a full scan does
+    for value in [rng.getrandbits(BITS) for _ in range(20)] + values[:20]:
+        expected = sorted(
+            hamming_distance(value, other) for other in values if hamming_distance(value, other) <= MAX_DISTANCE
+        )
+        assert [distance for distance, _ in index.search(value)] == expected
+
+
+def test_an_index_with_more_bands_than_bits_is_refused():
+    with pytest.raises(MyCustomError):
+        HammingIndex(8, 8)
+
+
+def test_a_near_copy_of_a_users_photo_matches_it(near_duplicates, metadata_store):
+    rng = random.Random(11)
+    value = rng.getrandbits(BITS)
+    first = store_photo(metadata_store, "a" * 64, value)
+    assert near_duplicates.match("user", first, "person") == first
+
+    near_copy = store_photo(metadata_store, "b" * 64, flip_bits(value, MAX_DISTANCE, rng))
+    assert near_duplicates.nearest("user", "person", f"{flip_bits(value, MAX_DISTANCE, rng):016x}") == (
+        "user", first
+    )
+    assert near_duplicates.match("user", near_copy, "person") == first
+    # Another user's photos, photos of the other type and untyped uploads are not matched
+    assert near_duplicates.match("someone else", near_copy, "person") == near_copy
+    assert near_duplicates.match("user", near_copy, "garment") == near_copy
+    assert near_duplicates.match("user", near_copy, None) == near_copy
+
+    other_photo = store_photo(metadata_store, "c" * 64, flip_bits(value, MAX_DISTANCE + 1, rng))
+    assert near_duplicates.match("user", other_photo, "person") == other_photo
+
+
+def test_a_flat_image_is_never_matched(near_duplicates, metadata_store):
+    # Fewer than BITS / 8 bits set, as the hash of a blank or evenly lit photo has
+    flat_value = 0b1011
+    flat = store_photo(metadata_store, "d" * 64, flat_value)
+    assert near_duplicates.match("user", flat, "garment") == flat
+    flat_copy = store_photo(metadata_store, "e" * 64, flat_value)
+    assert near_duplicates.match("user", flat_copy, "garment") == flat_copy
+    assert near_duplicates.nearest("user", "garment", f"{flat_value:016x}") is None
+
+
+def test_a_copy_of_a_catalog_garment_matches_the_garment(near_duplicates, metadata_store):
+    rng = random.Random(13)
+    value = rng.getrandbits(BITS)
+    garment = store_photo(metadata_store, "f" * 64, value)
+    metadata_store.add_garment("garment-1", "Blue shirt", garment)
+    upload = store_photo(metadata_store, "0" * 64, flip_bits(value, 3, rng))
+    assert near_duplicates.match("user", upload, "garment") == garment
+    assert near_duplicates.match("user", upload, "person") == upload
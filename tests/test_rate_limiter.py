@@ -0,0 +1,59 @@
+import pytest
+
+from constants import RateLimitSettings
+from rate_limiter import ADMIT, BUSY, SHED, TokenBucketLimiter, admit_try_on
+
+
+@pytest.fixture
+def limiter(tmp_path):
+    return TokenBucketLimiter(str(tmp_path / "rate_limits.db"))
+
+
+def test_bucket_allows_its_burst_then_asks_to_wait(limiter):
+    assert [limiter.try_acquire("user", rate=1.0, burst=3, now=100.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.try_acquire("user", rate=1.0, burst=3, now=100.0) == pytest.approx(1.0)
+    # Half a second later half a token is back
+    assert limiter.try_acquire("user", rate=1.0, burst=3, now=100.5) == pytest.approx(0.5)
+    assert limiter.try_acquire("user", rate=1.0, burst=3, now=101.5) == 0.0
+
+
+def test_bucket_refills_up_to_its_burst(limiter):
+    limiter.try_acquire("user", rate=1.0, burst=2, now=0.0)
+    limiter.try_acquire("user", rate=1.0, burst=2, now=0.0)
+    assert [limiter.try_acquire("user", rate=1.0, burst=2, now=1000.0) for _ in range(3)] == [0.0, 0.0, 1.0]
+
+
+def test_buckets_are_shared_through_the_database(tmp_path, limiter):
+    other_process = TokenBucketLimiter(str(tmp_path / "rate_limits.db"))
+    assert limiter.try_acquire("user", rate=0.1, burst=1, now=0.0) == 0.0
+    assert other_process.try_acquire("user", rate=0.1, burst=1, now=0.0) == pytest.approx(10.0)
+    assert other_process.try_acquire("someone else", rate=0.1, burst=1, now=0.0) == 0.0
+
+
+def test_idle_buckets_are_pruned(limiter):
+    limiter.try_acquire("old", rate=1.0, burst=1, now=0.0)
+    limiter.try_acquire("recent", rate=1.0, burst=1, now=500.0)
+    assert limiter.prune(older_than=100.0) == 1
+    assert limiter.try_acquire("recent", rate=1.0, burst=1, now=500.0) == pytest.approx(1.0)
+
+
+def test_admission_by_queue_depth():
+    assert admit_try_on(0, 4) == (ADMIT, 1, 0.0)
+    assert admit_try_on(RateLimitSettings.BUSY_QUEUE_DEPTH.value, 4)[0] == BUSY
+    assert admit_try_on(RateLimitSettings.MAX_QUEUE_DEPTH.value, 4)[0] == SHED
+
+
+def test_admission_by_expected_wait():
+    busy_seconds = RateLimitSettings.BUSY_WAIT_SECONDS.value
+    # Third in line for two workers, the new try-on starts after two rounds of jobs
+    assert admit_try_on(2, 2, job_seconds=busy_seconds / 2) == (ADMIT, 3, busy_seconds)
+    assert admit_try_on(2, 1, job_seconds=busy_seconds / 2)[0] == BUSY
+    assert admit_try_on(2, 1, job_seconds=RateLimitSettings.MAX_WAIT_SECONDS.value)[0] == SHED
+
+
+def test_admission_expects_the_wait_of_the_start_throttle():
+    # Jobs beyond the burst start one per 1 / start_rate seconds, however many workers are free
+    decision, position, expected_wait = admit_try_on(5, 100, start_rate=0.5, start_burst=2)
+    assert position == 6
+    assert expected_wait == pytest.approx(8.0)
+    assert admit_try_on(1, 100, start_rate=0.5, start_burst=2)[2] == 0.0
@@ -0,0 +1,53 @@
+import pytest
+
+from session_state import AWAITING_GARMENT, AWAITING_IMAGES, READY, SessionStore, SessionVersions
+
+
+@pytest.fixture
+def make_store(tmp_path, metadata_store):
+    """A SessionStore as one worker process has it, every store maps the same counter file."""
+    def make():
+        return SessionStore(metadata_store, SessionVersions(str(tmp_path / "session_versions"), slots=64))
+
+    return make
+
+
+def add_image(metadata_store, user_id, image_type):
+    metadata_store.add_input_image(user_id, "media_url", f"{image_type}.jpeg", image_type)
+
+
+def test_a_change_recorded_by_one_store_invalidates_the_others(make_store, metadata_store):
+    first, second = make_store(), make_store()
+    assert first.get("user").state == second.get("user").state == AWAITING_IMAGES
+
+    add_image(metadata_store, "user", "person")
+    first.record("user", {"person": 1})
+    assert first.get("user").state == AWAITING_GARMENT
+    assert second.get("user").state == AWAITING_GARMENT
+
+    add_image(metadata_store, "user", "garment")
+    second.record("user")
+    assert first.get("user").state == second.get("user").state == READY
+
+
+def test_a_cached_session_is_used_until_the_epoch_moves(make_store, metadata_store):
+    first, second = make_store(), make_store()
+    assert second.get("user").state == AWAITING_IMAGES
+    # Written without recording it, so only a new epoch makes the change visible
+    add_image(metadata_store, "user", "person")
+    assert second.get("user").state == AWAITING_IMAGES
+
+    first.invalidate_all()
+    assert second.get("user").state == AWAITING_GARMENT
+
+
+def test_deltas_are_not_applied_on_top_of_a_change_made_elsewhere(make_store, metadata_store):
+    first, second = make_store(), make_store()
+    first.get("user")
+    add_image(metadata_store, "user", "person")
+    second.record("user", {"person": 1})
+    add_image(metadata_store, "user", "garment")
+    # The first store's cached session misses the person image, so it is reloaded rather than updated
+    first.record("user", {"garment": 1})
+    assert first.get("user").counts == {"person": 1, "garment": 1}
+    assert first.get("user").state == READY
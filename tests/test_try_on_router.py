@@ -0,0 +1,161 @@
+import threading
+import time
+
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from types import SimpleNamespace
+
+import pytest
+
+from try_on_router import (CircuitBreaker, FakeTryOnBackend, KolorsBackend, NoHealthyBackendError, TryOnRouter,
+                           TryOnTimeoutError)
+from utils import MyCustomError
+
+
+@pytest.fixture
+def make_router():
+    routers = []
+
+    def make(*backends, **kwargs):
+        router = TryOnRouter(list(backends), **kwargs)
+        routers.append(router)
+        return router
+
+    yield make
+    for router in routers:
+        router.shutdown()
+
+
+def test_circuit_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+
+def test_half_open_circuit_allows_a_single_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    # A failed trial opens the circuit again, a successful one closes it
+    breaker.record_failure()
+    assert breaker.state == "open"
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow_request() and breaker.allow_request()
+
+
+def test_backends_are_ranked_fastest_first_without_open_circuits(make_router):
+    slow, fast, broken = FakeTryOnBackend("slow"), FakeTryOnBackend("fast"), FakeTryOnBackend("broken")
+    router = make_router(slow, fast, broken)
+    router.stats["slow"].record(2.0, True)
+    router.stats["fast"].record(0.5, True)
+    for _ in range(router.breakers["broken"].failure_threshold):
+        router.breakers["broken"].record_failure()
+    assert router.ranked_backends() == ["fast", "slow"]
+
+
+def test_a_failed_backend_fails_over_to_the_next(make_router):
+    router = make_router(FakeTryOnBackend("failing", failure_rate=1.0), FakeTryOnBackend("healthy", latency=0.01))
+    assert router.run("person.jpeg", "garment.jpeg") == ("healthy", "person.jpeg")
+    assert router.stats["failing"].snapshot()["error_rate"] == 1.0
+
+
+def test_a_slow_primary_is_hedged(make_router):
+    router = make_router(
+        FakeTryOnBackend("slow", latency=2.0), FakeTryOnBackend("fast", latency=0.01),
+        default_hedge_delay=0.1, min_hedge_delay=0.1
+    )
+    started = time.monotonic()
+    assert router.run("person.jpeg", "garment.jpeg")[0] == "fast"
+    assert time.monotonic() - started < 1.0
+
+
+def test_every_backend_failing_raises_the_last_error(make_router):
+    router = make_router(FakeTryOnBackend("a", failure_rate=1.0), FakeTryOnBackend("b", failure_rate=1.0))
+    with pytest.raises(MyCustomError, match="simulated failure"):
+        router.run("person.jpeg", "garment.jpeg")
+
+
+def test_open_circuits_refuse_the_try_on(make_router):
+    router = make_router(FakeTryOnBackend("a"))
+    for _ in range(router.breakers["a"].failure_threshold):
+        router.breakers["a"].record_failure()
+    with pytest.raises(NoHealthyBackendError):
+        router.run("person.jpeg", "garment.jpeg")
+
+
+def test_hung_backends_time_out_at_the_total_deadline(make_router):
+    router = make_router(
+        FakeTryOnBackend("a", latency=5.0), FakeTryOnBackend("b", latency=5.0),
+        default_hedge_delay=0.1, min_hedge_delay=0.1, total_deadline=0.5
+    )
+    started = time.monotonic()
+    with pytest.raises(TryOnTimeoutError):
+        router.run("person.jpeg", "garment.jpeg")
+    assert time.monotonic() - started < 1.5
+    with pytest.raises(TimeoutError):
+        router.run_on("a", "person.jpeg", "garment.jpeg")
+    assert router.breakers["a"]._consecutive_failures == 2
+
+
+def test_a_hung_gradio_job_is_cancelled():
+    class HungJob:
+        cancelled = False
+
+        def result(self, timeout=None):
+            # What gradio_client's Job, a concurrent.futures.Future, raises on every Python version
+            raise FuturesTimeoutError()
+
+        def cancel(self):
+            self.cancelled = True
+            return True
+
+    job = HungJob()
+    client = SimpleNamespace(submit=lambda **kwargs: job)
+    with pytest.raises(TryOnTimeoutError, match="did not answer within the try-on deadline"):
+        KolorsBackend().predict(client, person_img="person.jpeg", garment_img="garment.jpeg")
+    assert job.cancelled
+
+
+def test_calls_still_waiting_for_a_thread_at_the_deadline_are_not_charged(make_router):
+    backend = FakeTryOnBackend("a", latency=1.0)
+    router = make_router(backend, total_deadline=0.3, max_workers=1)
+    errors = []
+
+    def run():
+        try:
+            router.run("person.jpeg", "garment.jpeg")
+        except TryOnTimeoutError as e:
+            errors.append(e)
+
+    # The second try-on waits for the only thread until the deadline, its call is cancelled
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 2
+    # The started call ends after the deadline and is not recorded a second time
+    time.sleep(1.0)
+    assert backend.calls == 1
+    assert router.breakers["a"]._consecutive_failures == 1
+    assert router.stats["a"].snapshot()["calls"] == 1
+
+
+def test_a_cancelled_trial_lets_a_half_open_circuit_try_again():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.cancel_request()
+    assert breaker.allow_request()
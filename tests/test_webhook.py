@@ -0,0 +1,77 @@
+import asyncio
+import uuid
+
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def post_message():
+    """Send form posts to the app's webhook in-process, returning the replies in order."""
+    import httpx
+
+    import app
+
+    def post(*forms):
+        async def run():
+            transport = httpx.ASGITransport(app=app.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                return [await client.post("/webhook", data=form) for form in forms]
+
+        return asyncio.run(run())
+
+    return post
+
+
+def new_user():
+    return f"whatsapp:+1555{uuid.uuid4().int % 10 ** 7:07d}"
+
+
+def test_a_redelivered_message_gets_the_original_reply(post_message):
+    from chat_history_manager import ChatHistoryManager
+
+    user = new_user()
+    form = {"From": user, "Body": "Hello", "MessageSid": f"SM{uuid.uuid4().hex}"}
+    first, redelivered = post_message(form, form)
+    assert first.status_code == redelivered.status_code == 200
+    assert redelivered.text == first.text
+    # Processed once, so the conversation shows the message once
+    assert ChatHistoryManager.get_recent_history(user) == [
+        {"user_message": "hello"},
+        {"bot_response": "Please provide an image along with its type (garment or person) to use the virtual "
+                         "try-on service."}
+    ]
+
+
+def test_a_rate_limited_message_is_recorded_with_its_reply(post_message, monkeypatch):
+    import app
+    from chat_history_manager import ChatHistoryManager
+
+    monkeypatch.setattr(app, "get_rate_limiter", lambda: SimpleNamespace(acquire_user_message=lambda user: 12.5))
+    user = new_user()
+    (reply,) = post_message({"From": user, "Body": " Person ", "MessageSid": f"SM{uuid.uuid4().hex}"})
+    assert "Please wait 13 seconds" in reply.text
+    history = ChatHistoryManager.get_recent_history(user)
+    assert history[0] == {"user_message": "person"}
+    assert "Please wait 13 seconds" in history[1]["bot_response"]
+
+
+def test_the_lifespan_starts_and_stops_the_app(monkeypatch):
+    import app
+
+    calls = []
+
+    async def close_cluster():
+        calls.append("close cluster")
+
+    monkeypatch.setattr(app, "on_startup", lambda: calls.append("startup"))
+    monkeypatch.setattr(app, "on_shutdown", lambda: calls.append("shutdown"))
+    monkeypatch.setattr(app, "get_cluster", lambda: SimpleNamespace(close=close_cluster))
+
+    async def run():
+        async with app.app.router.lifespan_context(app.app):
+            calls.append("serving")
+
+    asyncio.run(run())
+    assert calls == ["startup", "serving", "shutdown", "close cluster"]
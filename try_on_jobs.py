@@ -0,0 +1,211 @@
+import contextvars
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from chat_history_manager import ChatHistoryManager
+from constants import JobQueueSettings, PreviewSettings
+from merge_images import MergeImages
+from output_storage import get_output_storage
+from storage_lifecycle import discard_outputs
+from telemetry import span
+from twilio_messenger import TwilioMessenger
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MERGE_JOB = "merge"
+VIRTUAL_TRY_ON_JOB = "virtual_try_on"
+MERGE_BATCH_JOB = "merge_batch"
+VIRTUAL_TRY_ON_BATCH_JOB = "virtual_try_on_batch"
+# Job kind used when one person image is paired with several garments
+BATCH_JOBS = {MERGE_JOB: MERGE_BATCH_JOB, VIRTUAL_TRY_ON_JOB: VIRTUAL_TRY_ON_BATCH_JOB}
+PREVIEW_RESPONSE = "Here is a quick preview, the full virtual try-on is on its way!"
+
+# Sends previews while the job's own thread goes on to the model call
+_preview_sender = ThreadPoolExecutor(
+    max_workers=JobQueueSettings.WORKER_COUNT.value, thread_name_prefix="preview-send"
+)
+
+
+def get_media_url(file_path):
+    return get_output_storage().media_url(os.path.basename(file_path))
+
+
+def payload_input_ids(job):
+    """Ids of the input images a job consumed, released by the storage sweep once its output is fetched."""
+    input_ids = [job.payload.get("person_image_id"), job.payload.get("garment_image_id")]
+    input_ids += [garment.get("garment_image_id") for garment in job.payload.get("garments", [])]
+    return [input_id for input_id in input_ids if input_id is not None]
+
+
+def _deliver_preview(job, media_url):
+    try:
+        TwilioMessenger.send_message(job.user_id, PREVIEW_RESPONSE, media_url)
+        ChatHistoryManager.update_chat_history(job.user_id, {"bot_response": PREVIEW_RESPONSE})
+    except Exception as e:
+        logger.log(level=logging.ERROR, msg=f"Could not send the preview of job {job.job_id}. Error: [{e}]")
+
+
+def send_preview(job, make_preview):
+    """Make a preview with make_preview() and start sending it, returning the send's future or None.
+
+    make_preview returns an output path, or a merge_batch result whose contact sheet is sent. Previews
+    are best effort, the job goes on to the model whatever happens here.
+    """
+    # A job run again after a restart has sent its preview already
+    if not PreviewSettings.ENABLED.value or (job.result or {}).get("preview_image"):
+        return None
+    try:
+        with span("preview"):
+            preview = make_preview()
+        output_storage = get_output_storage()
+        if isinstance(preview, dict):
+            for file_path in preview["outputs"]:
+                output_storage.commit(file_path, job.user_id)
+            preview = preview["contact_sheet"]
+        output_storage.commit(preview, job.user_id)
+    except Exception as e:
+        logger.log(level=logging.ERROR, msg=f"Could not make the preview of job {job.job_id}. Error: [{e}]")
+        return None
+    media_url = get_media_url(preview)
+    job.record_progress(preview_image=os.path.basename(preview), preview_media_url=media_url)
+    return _preview_sender.submit(contextvars.copy_context().run, _deliver_preview, job, media_url)
+
+
+def wait_for_preview(preview_sent):
+    """Hold the next message back until the preview went out, so it cannot arrive first."""
+    if preview_sent is not None:
+        preview_sent.result()
+
+
+def send_result(job, file_paths, output_response, media_url):
+    """Send committed outputs to the user, deleting them again if the message cannot be sent."""
+    try:
+        TwilioMessenger.send_message(job.user_id, output_response, media_url)
+    except Exception:
+        # Nobody will ever fetch them, their inputs are released now instead of when they expire
+        discard_outputs(file_paths, "undelivered")
+        raise
+    try:
+        ChatHistoryManager.update_chat_history(job.user_id, {"bot_response": output_response})
+    except Exception as e:
+        # The user has the result, failing the job now would also send them an error
+        logger.log(level=logging.ERROR, msg=f"Could not record the reply of job {job.job_id}. Error: [{e}]")
+
+
+def deliver_result(job, file_path):
+    """Send the finished try-on image to the user and record it."""
+    get_output_storage().commit(file_path, job.user_id, payload_input_ids(job))
+    media_url = get_media_url(file_path)
+    send_result(job, [file_path], "Here is the virtual try-on image!", media_url)
+    # Keeps the preview recorded while the job ran
+    return {**(job.result or {}), "output_image": os.path.basename(file_path), "media_url": media_url}
+
+
+def deliver_batch_result(job, batch):
+    """Send the contact sheet followed by every individual result in one message."""
+    file_paths = [batch["contact_sheet"]] + batch["outputs"]
+    output_storage = get_output_storage()
+    # The inputs go with the contact sheet, the first image of the reply
+    output_storage.commit(batch["contact_sheet"], job.user_id, payload_input_ids(job))
+    for file_path in batch["outputs"]:
+        output_storage.commit(file_path, job.user_id)
+    media_urls = [get_media_url(file_path) for file_path in file_paths]
+    output_response = f"Here are your {len(batch['outputs'])} virtual try-on images! The first one compares them all."
+    if batch.get("failed"):
+        output_response += f" {batch['failed']} garment(s) could not be processed."
+    send_result(job, file_paths, output_response, media_urls)
+    return {
+        **(job.result or {}),
+        "output_image": os.path.basename(batch["contact_sheet"]),
+        "media_url": media_urls[0],
+        "batch_outputs": [os.path.basename(file_path) for file_path in batch["outputs"]],
+        "failed": batch.get("failed", 0)
+    }
+
+
+def deliver_failure(job):
+    output_response = "An error occurred while generating your try-on image. Please try again later."
+    try:
+        TwilioMessenger.send_message(job.user_id, output_response)
+        ChatHistoryManager.update_chat_history(job.user_id, {"bot_response": output_response})
+    except Exception as e:
+        logger.log(level=logging.ERROR, msg=f"Could not notify user about failed job {job.job_id}. Error: [{e}]")
+
+
+def run_merge_job(job):
+    try:
+        file_path = MergeImages(user_id=job.user_id).merge_images(
+            job.payload["person_image"], job.payload["garment_image"],
+            person_hash=job.payload.get("person_hash"), garment_hash=job.payload.get("garment_hash")
+        )
+        return deliver_result(job, file_path)
+    except Exception:
+        deliver_failure(job)
+        raise
+
+
+def run_virtual_try_on_job(job):
+    # Imported here so the merge-only deployment does not load the model path
+    from virtual_try_on import VirtualTryOn
+
+    person_image, garment_image = job.payload["person_image"], job.payload["garment_image"]
+    hashes = {"person_hash": job.payload.get("person_hash"), "garment_hash": job.payload.get("garment_hash")}
+    preview_sent = send_preview(
+        job, lambda: MergeImages(user_id=job.user_id, preview=True).merge_images(person_image, garment_image, **hashes)
+    )
+    try:
+        file_path = VirtualTryOn(user_id=job.user_id).process_try_on(person_image, garment_image, **hashes)
+        wait_for_preview(preview_sent)
+        return deliver_result(job, file_path)
+    except Exception:
+        wait_for_preview(preview_sent)
+        deliver_failure(job)
+        raise
+
+
+def batch_payload_garments(job):
+    garments = job.payload["garments"]
+    return [garment["garment_image"] for garment in garments], [garment.get("garment_hash") for garment in garments]
+
+
+def run_merge_batch_job(job):
+    garment_images, garment_hashes = batch_payload_garments(job)
+    try:
+        batch = MergeImages(user_id=job.user_id).merge_batch(
+            job.payload["person_image"], garment_images,
+            person_hash=job.payload.get("person_hash"), garment_hashes=garment_hashes
+        )
+        return deliver_batch_result(job, batch)
+    except Exception:
+        deliver_failure(job)
+        raise
+
+
+def run_virtual_try_on_batch_job(job):
+    from virtual_try_on import VirtualTryOn
+
+    garment_images, garment_hashes = batch_payload_garments(job)
+    person_image, person_hash = job.payload["person_image"], job.payload.get("person_hash")
+    preview_sent = send_preview(job, lambda: MergeImages(user_id=job.user_id, preview=True).merge_batch(
+        person_image, garment_images, person_hash=person_hash, garment_hashes=garment_hashes
+    ))
+    try:
+        batch = VirtualTryOn(user_id=job.user_id).process_try_on_batch(
+            person_image, garment_images, person_hash=person_hash, garment_hashes=garment_hashes
+        )
+        wait_for_preview(preview_sent)
+        return deliver_batch_result(job, batch)
+    except Exception:
+        wait_for_preview(preview_sent)
+        deliver_failure(job)
+        raise
+
+
+def register_try_on_handlers(job_queue):
+    job_queue.register_handler(MERGE_JOB, run_merge_job)
+    job_queue.register_handler(VIRTUAL_TRY_ON_JOB, run_virtual_try_on_job)
+    job_queue.register_handler(MERGE_BATCH_JOB, run_merge_batch_job)
+    job_queue.register_handler(VIRTUAL_TRY_ON_BATCH_JOB, run_virtual_try_on_batch_job)
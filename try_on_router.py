@@ -0,0 +1,384 @@
+import logging
+import random
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait
+
+from constants import BatchSettings, JobQueueSettings, TryOnRouterSettings
+from gradio_pool import IDM_VTON_BACKEND, KOLORS_BACKEND, get_gradio_pool, upload_gradio_file
+from metadata_store import get_metadata_store
+from telemetry import span
+from utils import MyCustomError
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class NoHealthyBackendError(MyCustomError):
+    pass
+
+
+class TryOnTimeoutError(MyCustomError, TimeoutError):
+    pass
+
+
+class TryOnBackend:
+    """A try-on model; run() returns the result image as a URL or a local path."""
+    name = None
+    # Inference parameters that change the output, part of the result cache key
+    params = {}
+
+    def run(self, person_media_path, garment_media_path):
+        raise NotImplementedError
+
+    def upload(self, media_path):
+        """Send an input ahead of its try-on, returning what run() takes in place of the path.
+
+        None when the backend has nothing to send ahead.
+        """
+        return None
+
+
+class GradioTryOnBackend(TryOnBackend):
+    def upload(self, media_path):
+        with get_gradio_pool(self.name).checkout() as client:
+            return upload_gradio_file(client, media_path)
+
+    def predict(self, client, **kwargs):
+        """client.predict() bounded by the try-on deadline, so a hung Space gives its client back."""
+        job = client.submit(**kwargs)
+        try:
+            return job.result(timeout=TryOnRouterSettings.TOTAL_DEADLINE_SECONDS.value)
+        except (FuturesTimeoutError, TimeoutError):
+            # The same class from Python 3.11, before that Future.result() raises only the futures one
+            job.cancel()
+            raise TryOnTimeoutError(f"{self.name} did not answer within the try-on deadline")
+
+
+class KolorsBackend(GradioTryOnBackend):
+    name = KOLORS_BACKEND
+    params = {"seed": 1, "randomize_seed": True}
+
+    def run(self, person_media_path, garment_media_path):
+        with get_gradio_pool(self.name).checkout() as client:
+            media_url, seed, response = self.predict(
+                client,
+                person_img=person_media_path,
+                garment_img=garment_media_path,
+                seed=self.params["seed"],
+                randomize_seed=self.params["randomize_seed"]
+            )
+        if response.status_code != 200:
+            raise MyCustomError(f"{self.name} returned status {response.status_code}")
+        return media_url
+
+
+class IdmVtonBackend(GradioTryOnBackend):
+    name = IDM_VTON_BACKEND
+    params = {"garment_des": "Sample garment description"}
+
+    def run(self, person_media_path, garment_media_path):
+        from gradio_client import file
+
+        with get_gradio_pool(self.name).checkout() as client:
+            media_url, seed, response = self.predict(
+                client,
+                dict={"background": file(person_media_path), "layers": [], "composite": None},
+                garm_img=file(garment_media_path),
+                garment_des=self.params["garment_des"],
+                api_name="/tryon"
+            )
+        if response.status_code != 200:
+            raise MyCustomError(f"{self.name} returned status {response.status_code}")
+        return media_url
+
+
+class FakeTryOnBackend(TryOnBackend):
+    """Local stand-in that simulates latency and failures."""
+
+    upload_prefix = "uploaded:"
+
+    def __init__(self, name, latency=0.1, jitter=0.0, failure_rate=0.0, result=None, upload_latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.result = result
+        # Seconds to send one input, paid in run() for every input not uploaded ahead, like gradio_client does
+        self.upload_latency = upload_latency
+        self.calls = 0
+        self.uploads = 0
+
+    def upload(self, media_path):
+        if not self.upload_latency:
+            return None
+        time.sleep(self.upload_latency)
+        self.uploads += 1
+        return f"{self.upload_prefix}{media_path}"
+
+    def run(self, person_media_path, garment_media_path):
+        self.calls += 1
+        for media_path in (person_media_path, garment_media_path):
+            if not media_path.startswith(self.upload_prefix):
+                time.sleep(self.upload_latency)
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.failure_rate:
+            raise MyCustomError(f"{self.name} simulated failure")
+        # Echo the person image by default, which is enough for callers that copy a local file
+        return self.result if self.result is not None else person_media_path.removeprefix(self.upload_prefix)
+
+
+class BackendStats:
+    """Rolling latency percentiles and error rate over the last window_size calls."""
+
+    def __init__(self, window_size=TryOnRouterSettings.WINDOW_SIZE.value):
+        self._calls = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+
+    def record(self, latency, success):
+        with self._lock:
+            self._calls.append((latency, success))
+
+    def percentile(self, fraction):
+        with self._lock:
+            latencies = sorted(latency for latency, success in self._calls if success)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    def error_rate(self):
+        with self._lock:
+            if not self._calls:
+                return 0.0
+            return sum(1 for _, success in self._calls if not success) / len(self._calls)
+
+    def snapshot(self):
+        with self._lock:
+            calls = len(self._calls)
+        return {
+            "calls": calls,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "error_rate": self.error_rate()
+        }
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures, half-opens after reset_timeout."""
+
+    def __init__(self, failure_threshold=TryOnRouterSettings.FAILURE_THRESHOLD.value,
+                 reset_timeout=TryOnRouterSettings.CIRCUIT_RESET_SECONDS.value):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow_request(self):
+        """Closed circuits allow everything, half-open ones a single trial call."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._trial_in_flight or self._consecutive_failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def cancel_request(self):
+        """Forget an allowed request that was never sent, so a half-open circuit can still try one."""
+        with self._lock:
+            self._trial_in_flight = False
+
+
+class TryOnRouter:
+    """Send each try-on to the fastest healthy backend, hedging slow calls on a second one."""
+
+    def __init__(self, backends, default_hedge_delay=TryOnRouterSettings.DEFAULT_HEDGE_DELAY_SECONDS.value,
+                 min_hedge_delay=TryOnRouterSettings.MIN_HEDGE_DELAY_SECONDS.value,
+                 total_deadline=TryOnRouterSettings.TOTAL_DEADLINE_SECONDS.value,
+                 max_workers=None):
+        self.backends = {backend.name: backend for backend in backends}
+        self.stats = {backend.name: BackendStats() for backend in backends}
+        self.breakers = {backend.name: CircuitBreaker() for backend in backends}
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.total_deadline = total_deadline
+        if max_workers is None:
+            # Every job worker's batch fan-out with a hedge each, a call queued behind the others
+            # would spend its deadline waiting for a thread
+            max_workers = JobQueueSettings.WORKER_COUNT.value * BatchSettings.MAX_WORKERS.value * 2
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="try-on-backend")
+
+    def ranked_backends(self):
+        """Backends whose circuit is not open, fastest first."""
+        def sort_key(name):
+            stats = self.stats[name].snapshot()
+            # Backends without samples go first so they get measured
+            p50 = stats["p50"] if stats["p50"] is not None else float("inf")
+            return (stats["calls"] > 0, p50, stats["error_rate"])
+
+        names = [name for name in self.backends if self.breakers[name].state != "open"]
+        return sorted(names, key=sort_key)
+
+    def hedge_delay(self, name):
+        p95 = self.stats[name].percentile(0.95)
+        if p95 is None:
+            return self.default_hedge_delay
+        return max(self.min_hedge_delay, p95)
+
+    def _call(self, name, person_media_path, garment_media_path, give_up_at):
+        started = time.monotonic()
+        store = get_metadata_store()
+        # Inputs uploaded ahead are passed by reference, the rest are uploaded by the call itself
+        inputs = [store.get_pre_upload(name, media_path, time.time()) or media_path
+                  for media_path in (person_media_path, garment_media_path)]
+        try:
+            with span("predict", backend=name):
+                result = self.backends[name].run(*inputs)
+        except Exception:
+            self._record(name, started, False, give_up_at)
+            # The backend may have dropped the uploads, a retry sends the files again
+            store.delete_pre_uploads(name, [person_media_path, garment_media_path])
+            raise
+        self._record(name, started, True, give_up_at)
+        return name, result
+
+    def _record(self, name, started, success, give_up_at):
+        finished = time.monotonic()
+        # A call still running at the deadline was abandoned, and counted as a failure, then
+        if finished >= give_up_at:
+            return
+        self.stats[name].record(finished - started, success)
+        if success:
+            self.breakers[name].record_success()
+        else:
+            self.breakers[name].record_failure()
+
+    def _submit_next(self, candidates, in_flight, person_media_path, garment_media_path, give_up_at):
+        while candidates:
+            name = candidates.pop(0)
+            if self.breakers[name].allow_request():
+                future = self._executor.submit(self._call, name, person_media_path, garment_media_path, give_up_at)
+                in_flight[future] = name
+                return name
+        return None
+
+    def _cancel_queued(self, in_flight):
+        """Cancel the calls still waiting for a thread, returning the rest."""
+        running = {}
+        for future, name in in_flight.items():
+            if future.cancel():
+                self.breakers[name].cancel_request()
+            else:
+                running[future] = name
+        return running
+
+    def _abandon(self, in_flight):
+        """Give up at the deadline, counting only the calls a backend received as its failures."""
+        for name in self._cancel_queued(in_flight).values():
+            logger.log(level=logging.WARNING, msg=f"Try-on backend {name} did not answer within the deadline")
+            self.stats[name].record(self.total_deadline, False)
+            self.breakers[name].record_failure()
+        raise TryOnTimeoutError(f"No try-on backend answered within {self.total_deadline:.0f}s")
+
+    def run(self, person_media_path, garment_media_path):
+        """Return (backend_name, result) from the first backend that succeeds within the total deadline."""
+        give_up_at = time.monotonic() + self.total_deadline
+        candidates = self.ranked_backends()
+        in_flight = {}
+        primary = self._submit_next(candidates, in_flight, person_media_path, garment_media_path, give_up_at)
+        if primary is None:
+            raise NoHealthyBackendError("Every try-on backend has an open circuit")
+        deadline = time.monotonic() + self.hedge_delay(primary)
+        hedged = False
+        last_error = None
+        while in_flight:
+            now = time.monotonic()
+            if now >= give_up_at:
+                self._abandon(in_flight)
+            timeout = give_up_at - now if hedged else min(deadline, give_up_at) - now
+            done, _ = wait(list(in_flight), timeout=max(0.0, timeout), return_when=FIRST_COMPLETED)
+            if not done:
+                if hedged or time.monotonic() >= give_up_at:
+                    continue
+                # The primary is slower than its p95, fire a hedge on the next backend
+                hedged = True
+                name = self._submit_next(candidates, in_flight, person_media_path, garment_media_path, give_up_at)
+                if name is not None:
+                    logger.log(level=logging.INFO, msg=f"Hedging {primary} with {name}")
+                continue
+            for future in done:
+                name = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.log(level=logging.WARNING, msg=f"Try-on backend {name} failed. Error: [{e}]")
+                    last_error = e
+                    continue
+                # A hedge that has not started yet is no longer needed
+                self._cancel_queued(in_flight)
+                return result
+            if not in_flight and time.monotonic() < give_up_at:
+                # Everything in flight failed, fail over to the next backend
+                name = self._submit_next(candidates, in_flight, person_media_path, garment_media_path, give_up_at)
+                if name is not None:
+                    deadline = time.monotonic() + self.hedge_delay(name)
+                    hedged = False
+        raise last_error or NoHealthyBackendError("No try-on backend could take the request")
+
+    def run_on(self, name, person_media_path, garment_media_path):
+        """Run on one named backend within the total deadline, still recording its stats."""
+        give_up_at = time.monotonic() + self.total_deadline
+        future = self._executor.submit(self._call, name, person_media_path, garment_media_path, give_up_at)
+        done, _ = wait([future], timeout=self.total_deadline)
+        if not done:
+            self._abandon({future: name})
+        return future.result()[1]
+
+    def backend_status(self):
+        return {
+            name: dict(self.stats[name].snapshot(), circuit=self.breakers[name].state)
+            for name in self.backends
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+_try_on_router = None
+_try_on_router_lock = threading.Lock()
+
+
+def get_try_on_router():
+    """Return the process-wide router over the gradio backends."""
+    global _try_on_router
+    if _try_on_router is None:
+        with _try_on_router_lock:
+            if _try_on_router is None:
+                _try_on_router = TryOnRouter([KolorsBackend(), IdmVtonBackend()])
+    return _try_on_router
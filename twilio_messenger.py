@@ -0,0 +1,35 @@
+import logging
+import os
+
+from telemetry import span
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class TwilioMessenger:
+    """Send outbound messages through the Twilio REST API."""
+    _client = None
+
+    @classmethod
+    def get_client(cls):
+        if cls._client is None:
+            # Imported on the first send, twilio.rest is slow to import and only replies from jobs need it
+            from twilio.rest import Client
+
+            cls._client = Client(os.getenv("TWILIO_ACCOUNT_ID"), os.getenv("TWILIO_AUTH_TOKEN"))
+        return cls._client
+
+    @classmethod
+    def send_message(cls, to_number, body, media_url=None):
+        try:
+            kwargs = {"from_": os.getenv("TWILIO_WHATSAPP_NUMBER"), "to": to_number, "body": body}
+            if media_url:
+                kwargs["media_url"] = [media_url] if isinstance(media_url, str) else list(media_url)
+            with span("send_reply"):
+                message = cls.get_client().messages.create(**kwargs)
+            return message.sid
+        except Exception as e:
+            logger.log(level=logging.ERROR, msg=f"Got an error while sending a message. "
+                       f"To: [{to_number}] Error: [{e}]")
+            raise e
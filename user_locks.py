@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import os
+import threading
+import weakref
+
+from contextlib import asynccontextmanager, contextmanager
+
+from constants import ConcurrencySettings
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on this platform, locks only hold within one process
+    fcntl = None
+
+
+class UserLocks:
+    """Per-user mutual exclusion across threads and, through flock on a lock file, across worker processes."""
+
+    def __init__(self, lock_dir, scope):
+        self.lock_dir = os.path.join(lock_dir, scope)
+        self._locks = {}
+        self._guard = threading.Lock()
+        # asyncio locks belong to one event loop, each loop gets its own table
+        self._async_locks = weakref.WeakKeyDictionary()
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def _lock_path(self, user_id):
+        # Phone numbers contain "+" and ":", hash them into a safe file name
+        return os.path.join(self.lock_dir, f"{hashlib.sha1(user_id.encode()).hexdigest()}.lock")
+
+    def _acquire_thread_lock(self, user_id):
+        with self._guard:
+            entry = self._locks.get(user_id)
+            if entry is None:
+                entry = self._locks[user_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        entry[0].acquire()
+        return entry
+
+    def _release_thread_lock(self, user_id, entry):
+        entry[0].release()
+        with self._guard:
+            entry[1] -= 1
+            # Dropped once nobody holds or waits for it, so the table only grows with active users
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    @contextmanager
+    def lock(self, user_id):
+        entry = self._acquire_thread_lock(user_id)
+        fd = None
+        try:
+            if fcntl is not None:
+                fd = os.open(self._lock_path(user_id), os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            if fd is not None:
+                # Closing the descriptor releases the flock
+                os.close(fd)
+            self._release_thread_lock(user_id, entry)
+
+    @asynccontextmanager
+    async def async_lock(self, user_id):
+        """lock() for coroutines, waiting for the user without blocking the event loop."""
+        # Only touched from the loop's own thread, so no guard is needed
+        async_locks = self._async_locks.setdefault(asyncio.get_running_loop(), {})
+        entry = async_locks.get(user_id)
+        if entry is None:
+            entry = async_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        fd = None
+        try:
+            await entry[0].acquire()
+            try:
+                if fcntl is not None:
+                    fd = os.open(self._lock_path(user_id), os.O_RDWR | os.O_CREAT, 0o644)
+                    delay = 0.005
+                    while True:
+                        try:
+                            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            break
+                        except BlockingIOError:
+                            # Held by another worker process, poll instead of parking a thread on it
+                            await asyncio.sleep(delay)
+                            delay = min(delay * 2, 0.1)
+                yield
+            finally:
+                if fd is not None:
+                    os.close(fd)
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del async_locks[user_id]
+
+
+_user_locks = {}
+_user_locks_lock = threading.Lock()
+
+
+def get_user_locks(scope):
+    """Return the process-wide UserLocks for scope, scopes never block each other."""
+    if scope not in _user_locks:
+        with _user_locks_lock:
+            if scope not in _user_locks:
+                _user_locks[scope] = UserLocks(ConcurrencySettings.LOCK_DIR.value, scope)
+    return _user_locks[scope]
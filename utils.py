@@ -8,6 +8,15 @@ class Utils:
         unique_id = hashlib.md5(unique_string.encode()).hexdigest()
         return unique_id
 
+    @staticmethod
+    def hash_file(file_path, chunk_size=64 * 1024):
+        # SHA-256 of the file content, used to address inputs and results by content
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
 
 class MyCustomError(Exception):  # Correct
     pass
\ No newline at end of file
@@ -2,100 +2,100 @@
 # import cv2
 import logging
 import os
-import json
-import requests
 import shutil
 
-from datetime import datetime
-from gradio_client import Client, file
-
 from image_handler import ImageManager
-from constants import DirectoryPath, TokensAndURLs
-from utils import Utils
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import BatchSettings
+from gradio_pool import IDM_VTON_BACKEND, KOLORS_BACKEND
+from http_client import get_media_download_client
+from image_pipeline import make_contact_sheet
+from image_workers import get_image_worker_pool
+from metadata_store import get_metadata_store
+from output_storage import get_output_storage
+from result_cache import ResultCache, get_result_cache
+from speculative import UPLOAD, get_speculative_preprocessor
+from telemetry import span
+from try_on_router import get_try_on_router
+from utils import MyCustomError
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-HUGGING_FACE_API_TOKEN = os.getenv("HF_API_TOKEN")
-
 class VirtualTryOn:
     def __init__(self, user_id):
-        self.client_1 = Client(
-            TokensAndURLs.MODEL_NAME.value,
-            hf_token=HUGGING_FACE_API_TOKEN
-        )
-        self.client_2 = Client(
-            "Nymbo/Virtual-Try-On",
-            hf_token=HUGGING_FACE_API_TOKEN
-        )
-        # self.client = Client("Nymbo/Virtual-Try-On")
-        self.output_dir = DirectoryPath.OUTPUT_DIR.value
-        self.output_metadata_dir = DirectoryPath.OUTPUT_METADATA_DIR.value
+        # Backends and their warm client pools are shared process-wide
+        self.router = get_try_on_router()
+        self.output_storage = get_output_storage()
         self.user_id = user_id
         self.image_manager_obj = ImageManager(user_id)
-        os.makedirs(self.output_dir, exist_ok=True)
+        self.metadata_store = get_metadata_store()
+        self.result_cache = get_result_cache()
         pass
 
     def get_output_path(self):
-        unique_id = Utils.generate_unique_id(
-            f"{self.user_id}_output_{datetime.now().isoformat()}"
-        )
-        return os.path.join(self.output_dir, f"{unique_id}.jpeg")
+        return self.output_storage.new_output_path(self.user_id)
 
     def save_metadata(self, metadata):
-        # Save metadata per user in a JSON file
-        metadata_path = os.path.join(
-            self.output_metadata_dir, f"{self.user_id}_metadata.json"
-        )
-
-        if os.path.exists(metadata_path):
-            with open(metadata_path, "r") as file:
-                user_metadata = json.load(file)
-        else:
-            user_metadata = []
-
-        user_metadata.append(metadata)
-
-        with open(metadata_path, "w") as file:
-            json.dump(user_metadata, file, indent=4)
+        # Save metadata per user in the metadata store
+        self.metadata_store.add_output_metadata(self.user_id, metadata)
 
     def copy_image(self, src_path, dest_path):
         """Copy an image from src_path to dest_path."""
         shutil.copy2(src_path, dest_path)
 
-    def process_try_on_1(self):
+    def fetch_result_image(self, media_url, output_path):
+        """Store the model output, which gradio_client returns as a URL or a local file."""
+        with span("fetch_result"):
+            if os.path.exists(media_url):
+                self.copy_image(media_url, output_path)
+            else:
+                get_media_download_client().download_to_file_sync(media_url, output_path)
+
+    def process_try_on(self, person_media_path=None, garment_media_path=None, backend_name=None,
+                       person_hash=None, garment_hash=None):
+        """Run the try-on on backend_name, or on whichever backend the router picks."""
         try:
-            # Fetch input images
-            person_media_path = self.image_manager_obj.fetch_latest_unused_image(
-                "person", get_url=False
+            # Fetch input images unless the caller already claimed them
+            person_media_path, person_hash = self.image_manager_obj.resolve_input_image(
+                "person", person_media_path, person_hash
             )
-            garment_media_path = self.image_manager_obj.fetch_latest_unused_image(
-                "garment", get_url=False
-            )
-
-            # Predict try-on result
-            media_url, seed, response = self.client_1.predict(
-                person_img=person_media_path,
-                garment_img=garment_media_path,
-                seed=1,
-                randomize_seed=True
+            garment_media_path, garment_hash = self.image_manager_obj.resolve_input_image(
+                "garment", garment_media_path, garment_hash
             )
-
-            # Check if API response is successful
-            if response.status_code == 200:
-                output_path = self.get_output_path()
-                image = requests.get(media_url)
-                with open(output_path, "wb") as output_file:
-                    output_file.write(image.content)
-
-                # Save metadata
-                metadata = {
-                    "person_image": person_media_path,
-                    "garment_image": garment_media_path,
-                    "output_image": output_path
-                }
-                self.save_metadata(metadata)
-                return output_path
+            output_path = self.get_output_path()
+
+            # Any backend's cached result will do for a routed request, fastest first
+            candidates = [backend_name] if backend_name else self.router.ranked_backends()
+            cached = False
+            for candidate in candidates:
+                cache_key = self.cache_key(candidate, person_hash, garment_hash)
+                if self.result_cache.get(cache_key, output_path):
+                    backend_name, cached = candidate, True
+                    break
+
+            if not cached:
+                # An upload of either input still running is waited for rather than sent a second time
+                get_speculative_preprocessor().settle([person_media_path, garment_media_path], UPLOAD)
+                # Predict try-on result
+                if backend_name is None:
+                    backend_name, media_url = self.router.run(person_media_path, garment_media_path)
+                else:
+                    media_url = self.router.run_on(backend_name, person_media_path, garment_media_path)
+                self.fetch_result_image(media_url, output_path)
+                self.result_cache.put(self.cache_key(backend_name, person_hash, garment_hash), output_path)
+
+            # Save metadata
+            metadata = {
+                "person_image": person_media_path,
+                "garment_image": garment_media_path,
+                "output_image": output_path,
+                "backend": backend_name,
+                "cached": cached
+            }
+            self.save_metadata(metadata)
+            return output_path
         except Exception as e:
             logger.log(
                 level=logging.ERROR,
@@ -104,47 +104,64 @@ class VirtualTryOn:
             )
             raise e
 
-    def process_try_on_2(self):
-        try:
-            # Fetch input images
-            person_media_path = self.image_manager_obj.fetch_latest_unused_image(
-                "person", get_url=False
-            )
-            garment_media_path = self.image_manager_obj.fetch_latest_unused_image(
-                "garment", get_url=False
-            )
+    def process_try_on_batch(self, person_media_path, garment_media_paths, person_hash=None, garment_hashes=None):
+        """Try one person image on several garments in parallel, returning the outputs and a contact sheet.
 
-            # Predict try-on result
-            media_url, seed, response = self.client_2.predict(
-                dict={"background": file(person_media_path), "layers": [], "composite": None},
-                garm_img=file(garment_media_path),
-                garment_des="Sample garment description",
-                api_name="/tryon"
+        Garments that fail are left out of the result, the batch only fails if all of them do.
+        """
+        try:
+            person_media_path, person_hash = self.image_manager_obj.resolve_input_image(
+                "person", person_media_path, person_hash
             )
-
-            # Check if API response is successful
-            if response.status_code == 200:
-                output_path = self.get_output_path()
-                image = requests.get(media_url)
-                with open(output_path, "wb") as output_file:
-                    output_file.write(image.content)
-
-                # Save metadata
-                metadata = {
-                    "person_image": person_media_path,
-                    "garment_image": garment_media_path,
-                    "output_image": output_path
-                }
-                self.save_metadata(metadata)
-                return output_path
+            garment_hashes = garment_hashes or [None] * len(garment_media_paths)
+
+            def try_on(garment):
+                garment_media_path, garment_hash = garment
+                try:
+                    return self.process_try_on(
+                        person_media_path, garment_media_path, person_hash=person_hash, garment_hash=garment_hash
+                    )
+                except Exception:
+                    return None
+
+            # Concurrency per backend is still capped by its gradio pool
+            max_workers = max(1, min(BatchSettings.MAX_WORKERS.value, len(garment_media_paths)))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(try_on, zip(garment_media_paths, garment_hashes)))
+            output_paths = [output_path for output_path in results if output_path is not None]
+            if not output_paths:
+                raise MyCustomError("Every try-on in the batch failed")
+
+            contact_sheet_path = get_image_worker_pool().run(make_contact_sheet, output_paths, self.get_output_path())
+            metadata = {
+                "person_image": person_media_path,
+                "garment_images": list(garment_media_paths),
+                "output_image": contact_sheet_path,
+                "batch_outputs": output_paths,
+                "failed": len(results) - len(output_paths)
+            }
+            self.save_metadata(metadata)
+            return {"contact_sheet": contact_sheet_path, "outputs": output_paths,
+                    "failed": len(results) - len(output_paths)}
         except Exception as e:
             logger.log(
                 level=logging.ERROR,
-                msg=f"Got an error while generating the output image. "
+                msg=f"Got an error while generating the batch output images. "
                 f"User: {self.user_id} Error: [{e}]"
             )
             raise e
 
+    def cache_key(self, backend_name, person_hash, garment_hash):
+        return ResultCache.make_key(
+            person_hash, garment_hash, backend_name, self.router.backends[backend_name].params
+        )
+
+    def process_try_on_1(self, person_media_path=None, garment_media_path=None):
+        return self.process_try_on(person_media_path, garment_media_path, backend_name=KOLORS_BACKEND)
+
+    def process_try_on_2(self, person_media_path=None, garment_media_path=None):
+        return self.process_try_on(person_media_path, garment_media_path, backend_name=IDM_VTON_BACKEND)
+
     # def process_try_on_by_hf(self):
     #     try:
     #         # Fetch input images